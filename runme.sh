@@ -6,6 +6,7 @@ FLOAT_RE='^[0-9]+([.][0-9]+)?$'
 DATASET="eng"
 TEST="a"
 RES_DIR="results"
+CACHE_DIR="$RES_DIR/cache"
 SRC_DIR="src"
 DATA_DIR="data"
 
@@ -52,11 +53,8 @@ while test $# -gt 0; do
     esac
 done
 
-cp $DATA_DIR/$DATASET/$DATASET.train $RES_DIR/train.truncated
-python $SRC_DIR/cnt.py $DATA_DIR/$DATASET/$DATASET.train > $RES_DIR/ngrams.counts
-python $SRC_DIR/fltr.py $RES_DIR/ngrams.counts $RES_DIR/train.truncated
-python $SRC_DIR/cnt.py $RES_DIR/train.truncated > $RES_DIR/ngrams.truncated.counts
-python $SRC_DIR/tag.py $RES_DIR/ngrams.truncated.counts $DATA_DIR/$DATASET/$DATASET.test$TEST > $RES_DIR/predicted.tags
+python $SRC_DIR/trn.py $DATA_DIR/$DATASET/$DATASET.train --cache $CACHE_DIR --model $RES_DIR/model.bin > $RES_DIR/ngrams.truncated.counts
+python $SRC_DIR/tag.py $RES_DIR/model.bin $DATA_DIR/$DATASET/$DATASET.test$TEST > $RES_DIR/predicted.tags
 python $SRC_DIR/cmp.py $DATA_DIR/$DATASET/$DATASET.test$TEST.orig $RES_DIR/predicted.tags
 
 exit 0
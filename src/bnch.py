@@ -0,0 +1,609 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the stages of the program.
+
+Every stage is timed separately on the datasets of the data directory:
+    - train: counting the training file (L{cnt.HMM.train});
+    - load_counts: reading the counts back (L{cnt.HMM.load_counts}), its
+      token rate being given in lines of the counts file;
+    - fltr: the substitution pass of the rare words (L{fltr.substitute_all});
+    - viterbi: tagging the first test file with L{tag.viterbi};
+    - sparse_viterbi: tagging it with L{tag.sparse_viterbi}, the default;
+    - compare: comparing the tags to the original ones
+      (L{cmp.Comparator.compare}).
+The training stages are also run on training files replicated a number of
+times (e.g. 10 and 100 times) to show how they scale. The tagging stages do
+not depend on the size of the training file and are run once per dataset.
+
+Each stage is run several times and the best wall time is kept, the garbage
+collector being disabled while timing as L{timeit} does. The corpora of each
+dataset and scale are benchmarked in a fresh process whose peak resident set
+size is read after each stage. The results can be written as JSON and
+compared to the JSON results of a previous run: a stage slower than its
+baseline by more than a tolerance is reported as a regression and the exit
+status is then 1.
+
+The equivalence check compiles the bigram, trigram and 4-gram models of
+each training file from the counts of every counting path: L{cnt.HMM.train_parallel}, L{cnt.HMM.train_spilling} and the counts
+files read into a L{pck.PackedHMM} are checked against L{cnt.HMM.train},
+and the grouped counts of L{trn.train} stored in a L{pck.PackedHMM} against
+the ones stored in an HMM, since the rare words are grouped. The paths
+whose model file differs from their reference are reported, the exit
+status being then 1.
+"""
+
+from __future__ import print_function
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from cStringIO import StringIO
+from cnt import HMM
+from cmp import Comparator
+from const import SENTENCE_START
+from evl import find_datasets
+from fltr import group_map, substitute_all
+from mdl import compile_hmm, write_model, write_sorted_model
+from pck import PackedHMM
+from rdr import tagged_tokens, word_sentences
+from tag import viterbi, sparse_viterbi
+from trn import train
+
+DEFAULT_SCALES = [1, 10]
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.1
+CHECK_JOBS = 3
+CHECK_BUFFER_SIZE = 0.05
+CHECK_ORDERS = [2, 3, 4]
+
+
+def best_time(function, repeats):
+    """Time a function several times.
+
+    @param function:
+        The function to time, called without argument.
+    @type function: function
+    @param repeats:
+        The number of runs.
+    @type repeats: int
+
+    @return: A tuple containing the best and the median wall time in
+        seconds.
+    @rtype: tuple
+    """
+    times = []
+    for i in xrange(repeats):
+        gc.collect()
+        gcWasEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+        finally:
+            if gcWasEnabled:
+                gc.enable()
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def peak_rss():
+    """Get the peak resident set size of the process.
+
+    @return: The peak resident set size in megabytes.
+    @rtype: float
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 1048576.0
+    return maxrss / 1024.0
+
+
+def replicate(path, copies, directory):
+    """Write a training file made of copies of another one.
+
+    @param path:
+        The path of the training file.
+    @type path: str
+    @param copies:
+        The number of copies.
+    @type copies: int
+    @param directory:
+        The directory where the new training file is written.
+    @type directory: str
+
+    @return: The path of the new training file.
+    @rtype: str
+    """
+    if copies == 1:
+        return path
+    with open(path, 'r') as f:
+        data = f.read().rstrip('\n') + '\n\n'
+    fd, replicaPath = tempfile.mkstemp(suffix='.train', dir=directory)
+    with os.fdopen(fd, 'w') as output:
+        for i in xrange(copies):
+            output.write(data)
+    return replicaPath
+
+
+def result(dataset, scale, stage, times, tokens, sentences):
+    """Build the result of a stage.
+
+    @param dataset:
+        The name of the dataset.
+    @type dataset: str
+    @param scale:
+        The number of copies of the training file.
+    @type scale: int
+    @param stage:
+        The name of the stage.
+    @type stage: str
+    @param times:
+        The best and median wall times given by L{best_time}.
+    @type times: tuple
+    @param tokens:
+        The number of tokens processed by the stage.
+    @type tokens: int
+    @param sentences:
+        The number of sentences processed by the stage, None if the stage
+        does not process sentences.
+    @type sentences: int
+
+    @return: The result as a JSON serializable dictionary.
+    @rtype: dict
+    """
+    best, median = times
+    return dict(
+        dataset=dataset, scale=scale, stage=stage, tokens=tokens,
+        sentences=sentences, wall_time=best, median_time=median,
+        tokens_per_second=tokens / best if best else None,
+        sentences_per_second=sentences / best
+        if best and sentences is not None else None,
+        peak_rss_mb=peak_rss())
+
+
+def bench_training(args):
+    """Benchmark the training stages in a worker process.
+
+    @param args:
+        A tuple containing the name of the dataset, the path of its training
+        file, the number of copies of the training file and of runs of each
+        stage.
+    @type args: tuple
+
+    @return: The results of the stages.
+    @rtype: list
+    """
+    dataset, trainPath, scale, repeats = args
+    directory = tempfile.mkdtemp(prefix='ner-bench-')
+    try:
+        path = replicate(trainPath, scale, directory)
+        counters = []
+
+        def count():
+            counter = HMM(3)
+            with open(path, 'r') as tknsFile:
+                counter.train(tknsFile)
+            counters[:] = [counter]
+        res = []
+        times = best_time(count, repeats)
+        counter = counters[0]
+        tokens = sum(counter.ngramCounts[0].itervalues())
+        sentences = counter.ngramCounts[1][(SENTENCE_START, SENTENCE_START)]
+        res.append(result(dataset, scale, 'train', times, tokens, sentences))
+
+        countsPath = os.path.join(directory, 'counts')
+        with open(countsPath, 'w') as output:
+            counter.output_counts(output)
+        with open(countsPath, 'r') as countsFile:
+            lines = sum(1 for line in countsFile)
+        del counters[:], counter
+
+        def load():
+            counter = HMM(3)
+            with open(countsPath, 'r') as countsFile:
+                counter.load_counts(countsFile)
+            counters[:] = [counter]
+        times = best_time(load, repeats)
+        res.append(result(dataset, scale, 'load_counts', times, lines, None))
+
+        substitutions = group_map(counters[0].wordCounts)
+        del counters[:]
+
+        def substitute():
+            with open(path, 'r') as tknsFile:
+                with open(os.devnull, 'w') as output:
+                    substitute_all(tknsFile, output, substitutions)
+        times = best_time(substitute, repeats)
+        res.append(result(dataset, scale, 'fltr', times, tokens, sentences))
+        return res
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_tagging(args):
+    """Benchmark the tagging stages in a worker process.
+
+    @param args:
+        A tuple containing the name of the dataset, the path of its training
+        file, the paths of a test file and of its original and the number of
+        runs of each stage.
+    @type args: tuple
+
+    @return: The results of the stages.
+    @rtype: list
+    """
+    dataset, trainPath, testPath, origPath, repeats = args
+    with open(trainPath, 'r') as tknsFile:
+        model = compile_hmm(train(tknsFile).reloaded())
+    with open(testPath, 'r') as testFile:
+        sentences = list(word_sentences(testFile))
+    with open(origPath, 'r') as origFile:
+        original = list(tagged_tokens(origFile))
+    tokens = sum(len(sentence) for sentence in sentences)
+    res = []
+    predicted = []
+    for stage, decoder in (('viterbi', viterbi),
+                           ('sparse_viterbi', sparse_viterbi)):
+        def decode():
+            predicted[:] = [decoder(model, s) for s in sentences]
+        times = best_time(decode, repeats)
+        res.append(result(dataset, 1, stage, times, tokens, len(sentences)))
+
+    lines = StringIO()
+    for sentence, tags in zip(sentences, predicted):
+        for word, (tag, logProb) in zip(sentence, tags):
+            lines.write('%s %s %s\n' % (word, tag, logProb))
+        lines.write('\n')
+    lines.seek(0)
+    prediction = list(tagged_tokens(lines, addProb=True))
+
+    def compare():
+        Comparator().compare(iter(original), iter(prediction))
+    times = best_time(compare, repeats)
+    res.append(result(dataset, 1, 'compare', times, tokens, len(sentences)))
+    return res
+
+
+def model_bytes(counter, spilled=False):
+    """Compile the model of an HMM and get its binary model file.
+
+    @param counter:
+        The trained HMM.
+    @type counter: L{cnt.HMM}
+    @param spilled:
+        If set, the emission counts are L{cnt.SpilledCounts} and the model is
+        written by L{mdl.write_sorted_model}.
+    @type spilled: bool
+
+    @return: The content of the binary model file.
+    @rtype: str
+    """
+    with tempfile.TemporaryFile() as output:
+        if spilled:
+            write_sorted_model(counter, counter.emission_counts.iteritems(),
+                               output)
+        else:
+            write_model(compile_hmm(counter.reloaded()), output)
+        output.seek(0)
+        return output.read()
+
+
+def counts_bytes(counter, packed=False):
+    """Write the counts of an HMM, read them back and get the model file.
+
+    @param counter:
+        The trained HMM.
+    @type counter: L{cnt.HMM}
+    @param packed:
+        If set, the counts are read into a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The content of the binary model file.
+    @rtype: str
+    """
+    with tempfile.TemporaryFile() as countsFile:
+        counter.output_counts(countsFile)
+        countsFile.seek(0)
+        loaded = (PackedHMM if packed else HMM)(counter.n)
+        loaded.load_counts(countsFile)
+    return model_bytes(loaded)
+
+
+def check_counts(args):
+    """Check that every counting path gives the same model.
+
+    The check runs in the current process since L{cnt.HMM.train_parallel}
+    starts its own worker processes.
+
+    @param args:
+        A tuple containing the name of the dataset, the path of its training
+        file and the n-gram cardinality.
+    @type args: tuple
+
+    @return: The names of the counting paths whose model differs from the
+        model of their reference path.
+    @rtype: list
+    """
+    dataset, trainPath, n = args
+    counter = HMM(n)
+    with open(trainPath, 'r') as tknsFile:
+        counter.train(tknsFile)
+    plain = model_bytes(counter)
+    models = [('packed counts', counts_bytes(counter, packed=True), plain)]
+    del counter
+
+    counter = HMM(n)
+    counter.train_parallel(trainPath, CHECK_JOBS)
+    models.append(('train_parallel', model_bytes(counter), plain))
+    del counter
+
+    counter = HMM(n)
+    with open(trainPath, 'r') as tknsFile:
+        counter.train_spilling(tknsFile, CHECK_BUFFER_SIZE)
+    try:
+        models.append(('train_spilling counts', counts_bytes(counter), plain))
+        models.append(('train_spilling model',
+                       model_bytes(counter, spilled=True), plain))
+    finally:
+        counter.emission_counts.close()
+    del counter
+
+    with open(trainPath, 'r') as tknsFile:
+        grouped = model_bytes(train(tknsFile, n))
+    with open(trainPath, 'r') as tknsFile:
+        models.append(('trn packed',
+                       model_bytes(train(tknsFile, n, packed=True)), grouped))
+    return [name for name, model, reference in models if model != reference]
+
+
+def run_checks(datasets, orders=CHECK_ORDERS, log=sys.stderr):
+    """Check the counting paths on every dataset.
+
+    @param datasets:
+        The datasets given by L{evl.find_datasets}.
+    @type datasets: list
+    @param orders:
+        The n-gram cardinalities of the models.
+    @type orders: list
+    @param log:
+        The output where the progress is written.
+    @type log: Stream
+
+    @return: A list of tuples containing the name of a dataset, the n-gram
+        cardinality and the names of its counting paths whose model differs.
+    @rtype: list
+    """
+    res = []
+    for name, trainPath, tests in datasets:
+        for n in orders:
+            print('%s n=%i: checking the counting paths...' % (name, n),
+                  file=log)
+            res.append((name, n, check_counts((name, trainPath, n))))
+    return res
+
+
+def run_in_process(function, args):
+    """Run a function in a new process.
+
+    @param function:
+        The function to run.
+    @type function: function
+    @param args:
+        The argument of the function.
+    @type args: tuple
+
+    @return: The result of the function.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, (args,))
+    finally:
+        pool.terminate()
+
+
+def run_benchmarks(datasets, scales, repeats, log=sys.stderr):
+    """Benchmark every stage on every dataset.
+
+    @param datasets:
+        The datasets given by L{evl.find_datasets}.
+    @type datasets: list
+    @param scales:
+        The numbers of copies of the training files.
+    @type scales: list
+    @param repeats:
+        The number of runs of each stage.
+    @type repeats: int
+    @param log:
+        The output where the progress is written.
+    @type log: Stream
+
+    @return: The results of every stage.
+    @rtype: list
+    """
+    res = []
+    for name, trainPath, tests in datasets:
+        for scale in scales:
+            print('%s x%i: training stages...' % (name, scale), file=log)
+            res.extend(run_in_process(
+                bench_training, (name, trainPath, scale, repeats)))
+        testName, testPath, origPath = tests[0]
+        print('%s %s: tagging stages...' % (name, testName), file=log)
+        res.extend(run_in_process(
+            bench_tagging, (name, trainPath, testPath, origPath, repeats)))
+    return res
+
+
+def environment():
+    """Describe the machine running the benchmarks.
+
+    @return: A JSON serializable dictionary.
+    @rtype: dict
+    """
+    return dict(python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                platform=platform.platform(), machine=platform.machine(),
+                cpus=multiprocessing.cpu_count())
+
+
+def compare_baseline(results, baseline, tolerance):
+    """Compare the wall times of the stages to the ones of a baseline.
+
+    @param results:
+        The results of L{run_benchmarks}.
+    @type results: list
+    @param baseline:
+        The results of a previous run.
+    @type baseline: list
+    @param tolerance:
+        The relative slowdown above which a stage is a regression.
+    @type tolerance: float
+
+    @return: A list of tuples containing the dataset, the scale, the stage,
+        the baseline wall time, the wall time and True if the stage is a
+        regression, for the stages present in both results.
+    @rtype: list
+    """
+    key = lambda r: (r['dataset'], r['scale'], r['stage'])
+    previous = dict((key(r), r['wall_time']) for r in baseline)
+    res = []
+    for r in results:
+        if key(r) in previous:
+            base = previous[key(r)]
+            res.append(key(r) + (base, r['wall_time'],
+                                 r['wall_time'] > base * (1 + tolerance)))
+    return res
+
+
+def print_results(results, output=sys.stdout):
+    """Write the results of the benchmarks as a table.
+
+    @param results:
+        The results of L{run_benchmarks}.
+    @type results: list
+    @param output:
+        The output where the table will be written.
+    @type output: Stream
+    """
+    output.write('%-8s %5s %-15s %10s %12s %12s %10s\n' % (
+        'dataset', 'scale', 'stage', 'time (s)', 'tokens/s', 'sentences/s',
+        'RSS (MB)'))
+    for r in results:
+        rates = ['%.0f' % rate if rate is not None else '-' for rate in
+                 (r['tokens_per_second'], r['sentences_per_second'])]
+        output.write('%-8s %5i %-15s %10.3f %12s %12s %10.1f\n' % tuple(
+            [r['dataset'], r['scale'], r['stage'], r['wall_time']] + rates +
+            [r['peak_rss_mb']]))
+
+
+def print_comparison(comparison, output=sys.stdout):
+    """Write the comparison of the results to a baseline as a table.
+
+    @param comparison:
+        The comparison given by L{compare_baseline}.
+    @type comparison: list
+    @param output:
+        The output where the table will be written.
+    @type output: Stream
+    """
+    output.write('%-8s %5s %-15s %10s %10s %8s\n' % (
+        'dataset', 'scale', 'stage', 'base (s)', 'time (s)', 'change'))
+    for dataset, scale, stage, base, wallTime, regression in comparison:
+        output.write('%-8s %5i %-15s %10.3f %10.3f %+7.1f%%%s\n' % (
+            dataset, scale, stage, base, wallTime,
+            100.0 * (wallTime - base) / base if base else 0,
+            ' REGRESSION' if regression else ''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Time every stage of the program on the datasets and on '
+        'replicated training files.')
+    parser.add_argument(
+        'data_dir', nargs='?', default='data',
+        help='directory holding one folder per dataset (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '-d', '--dataset', action='append', metavar='NAME',
+        help='benchmark this dataset only, may be repeated')
+    parser.add_argument(
+        '-s', '--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+        metavar='N', help='numbers of copies of the training files '
+        '(default: %s)' % ' '.join(map(str, DEFAULT_SCALES)))
+    parser.add_argument(
+        '-r', '--repeats', type=int, default=DEFAULT_REPEATS, metavar='N',
+        help='number of runs of each stage (default: %(default)s)')
+    parser.add_argument(
+        '-o', '--output', metavar='PATH',
+        help='write the results as JSON to PATH')
+    parser.add_argument(
+        '-B', '--baseline', metavar='PATH',
+        help='compare the results to the JSON results of a previous run')
+    parser.add_argument(
+        '-t', '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        metavar='T', help='relative slowdown tolerated by --baseline '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-c', '--check', action='store_true',
+        help='check that every counting path compiles the same model '
+        'instead of timing the stages')
+    parser.add_argument(
+        '-n', '--orders', type=int, nargs='+', default=CHECK_ORDERS,
+        metavar='N', help='n-gram cardinalities of the models of --check '
+        '(default: %s)' % ' '.join(map(str, CHECK_ORDERS)))
+    args = parser.parse_args()
+    try:
+        datasets = [d for d in find_datasets(args.data_dir)
+                    if not args.dataset or d[0] in args.dataset]
+    except OSError:
+        print('ERROR: Cannot read data directory %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    if not datasets:
+        print('ERROR: No dataset found in %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    if args.check:
+        mismatches = False
+        if min(args.orders) < 2:
+            parser.error('--orders must be at least 2')
+        for name, n, paths in run_checks(datasets, args.orders):
+            print('%-8s n=%i %s' % (name, n, 'differs: ' + ', '.join(paths)
+                                    if paths else 'ok'))
+            mismatches = mismatches or bool(paths)
+        sys.exit(1 if mismatches else 0)
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)['results']
+        except (IOError, ValueError, KeyError):
+            print('ERROR: Cannot read baseline file %s.' % args.baseline,
+                  file=sys.stderr)
+            sys.exit(1)
+    results = run_benchmarks(datasets, args.scales, max(args.repeats, 1))
+    print_results(results)
+    if args.output:
+        try:
+            with open(args.output, 'w') as output:
+                json.dump(dict(environment=environment(),
+                               repeats=args.repeats, results=results),
+                          output, indent=2, sort_keys=True)
+        except IOError:
+            print('ERROR: Cannot write output file %s.' % args.output,
+                  file=sys.stderr)
+            sys.exit(1)
+    if baseline is not None:
+        comparison = compare_baseline(results, baseline, args.tolerance)
+        print()
+        print_comparison(comparison)
+        if any(c[-1] for c in comparison):
+            sys.exit(1)
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Batched Viterbi decoding with NumPy.
+
+This decoding engine produces the same tags as L{tag.viterbi} but advances
+a whole batch of sentences per time step. The trellis of the batch is held
+in a NumPy array of shape (B, S+1, S+1) indexed by the last two tags (u, v)
+of the histories, the last index being the sentence start symbol. Each step
+is one broadcast maximum over the w axis of the (B, w, u, v) candidates
+followed by one argmax over the (u, v) axes.
+
+Sentences are sorted by length and cut into batches so that the sentences of
+a batch have close lengths. The shorter sentences of a batch are padded and a
+mask tells which positions hold real tokens.
+
+The L{ForwardBackward} engine runs the forward-backward algorithm over the
+same trellis, the maxima being replaced by sums of probabilities computed in
+log space. It gives the posterior probability of every tag at every position
+of a sentence, i.e. the probability of the tag given the whole sentence.
+
+@note: NumPy is required by this module only. The rest of the program works
+without it.
+"""
+
+from __future__ import print_function
+from const import DEFAULT_BATCH_SIZE
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def log_sum_exp(a, axis):
+    """Compute the logarithm of the sum of the exponentials of log values.
+
+    @param a:
+        The log values.
+    @type a: numpy.ndarray
+    @param axis:
+        The axis of the sum.
+    @type axis: int
+
+    @return: The log of the sums, -inf where every value is -inf.
+    @rtype: numpy.ndarray
+    """
+    m = a.max(axis=axis)
+    m[~np.isfinite(m)] = 0.0
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(a - np.expand_dims(m, axis)).sum(axis=axis)) + m
+
+
+def shifted_exp(a):
+    """Exponentiate the log values of each sentence shifted by their maximum.
+
+    @param a:
+        The log values of shape (B, N, N).
+    @type a: numpy.ndarray
+
+    @return: A tuple containing the exponentials, whose maximum is 1 for each
+        sentence, and the array of shape (B,) of the shifts.
+    @rtype: tuple
+    """
+    m = a.reshape(a.shape[0], -1).max(axis=1)
+    m[~np.isfinite(m)] = 0.0
+    return np.exp(a - m[:, np.newaxis, np.newaxis]), m
+
+
+def length_buckets(sentences, batchSize):
+    """Group the sentences of close lengths into batches.
+
+    @param sentences:
+        A list of sentences, each sentence being a list of tokens.
+    @type sentences: list
+    @param batchSize:
+        The maximum number of sentences in a batch.
+    @type batchSize: int
+
+    @return: An iterator generating lists of sentence indexes.
+    @rtype: generator
+    """
+    order = sorted(xrange(len(sentences)), key=lambda i: len(sentences[i]))
+    for i in xrange(0, len(order), batchSize):
+        yield order[i:i + batchSize]
+
+
+class BatchViterbi(object):
+    """NumPy Viterbi decoder working on batches of sentences."""
+
+    def __init__(self, model, batchSize=DEFAULT_BATCH_SIZE):
+        """BatchViterbi creator.
+
+        @param model:
+            The compiled model.
+        @type model: L{mdl.Model}
+        @param batchSize:
+            The maximum number of sentences decoded together.
+        @type batchSize: int
+
+        @raise ImportError: If NumPy is not installed.
+        @raise ValueError: If the batch size is null or if the model is not a
+            trigram model.
+        """
+        if np is None:
+            raise ImportError('The batched decoder requires NumPy.')
+        if batchSize < 1:
+            raise ValueError('The batch size must be 1 or more.')
+        if model.transitions is None:
+            raise ValueError('The batched decoder requires a trigram model.')
+        self.model = model
+        self.batchSize = batchSize
+        S = len(model.states)
+        startCol = np.full((S + 1, S + 1, 1), -np.inf)
+        self.transitions = np.concatenate(
+            (np.array(model.transitions, dtype=np.float64), startCol), axis=2)
+        startCol = np.full((len(model.emissions), 1), -np.inf)
+        self.emissions = np.concatenate(
+            (np.array(model.emissions, dtype=np.float64), startCol), axis=1)
+
+    def encode_batch(self, sentences):
+        """Get the emission rows of the tokens of padded sentences.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+
+        @return: A tuple containing the array of shape (B, T) of the emission
+            rows and the mask of the same shape of the real tokens.
+        @rtype: tuple
+        """
+        B = len(sentences)
+        T = max(len(s) for s in sentences)
+        ids = np.zeros((B, T), dtype=np.intp)
+        mask = np.zeros((B, T), dtype=bool)
+        for b, sentence in enumerate(sentences):
+            ids[b, :len(sentence)] = \
+                [self.model.emission_index(word) for word in sentence]
+            mask[b, :len(sentence)] = True
+        return ids, mask
+
+    def decode_batch(self, sentences):
+        """Decode sentences together.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+
+        @return: A list containing for each sentence a list of tuples made
+            of the predicted tag of each token and the log probability of the
+            tagged sequence up to this token.
+        @rtype: list
+        """
+        model = self.model
+        ids, mask = self.encode_batch(sentences)
+        B, T = ids.shape
+        N = model.start + 1
+        pi = np.full((B, N, N), -np.inf)
+        pi[:, model.start, model.start] = 0.0
+        rows = np.arange(B)
+        bestTags = np.empty((B, T), dtype=np.intp)
+        bestProbs = np.empty((B, T))
+        for t in xrange(T):
+            cand = pi[:, :, :, np.newaxis] + self.transitions[np.newaxis]
+            pi = cand.max(axis=1) + self.emissions[ids[:, t]][:, np.newaxis]
+            flat = pi.reshape(B, N * N)
+            best = flat.argmax(axis=1)
+            bestTags[:, t] = best % N
+            bestProbs[:, t] = flat[rows, best]
+        res = []
+        for b in xrange(B):
+            tags = bestTags[b, mask[b]]
+            probs = bestProbs[b, mask[b]]
+            res.append([
+                (model.states[v], float(p) if p != -np.inf else 0)
+                for v, p in zip(tags, probs)])
+        return res
+
+    def decode(self, sentences):
+        """Decode sentences by batches of sentences of close lengths.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+
+        @return: The decoding results of L{decode_batch}, in the order of the
+            input sentences.
+        @rtype: list
+        """
+        res = [None] * len(sentences)
+        for bucket in length_buckets(sentences, self.batchSize):
+            for i, tags in zip(
+                    bucket, self.decode_batch([sentences[i] for i in bucket])):
+                res[i] = tags
+        return res
+
+
+class ForwardBackward(BatchViterbi):
+    """NumPy forward-backward working on batches of sentences."""
+
+    def posteriors_batch(self, sentences):
+        """Compute the posterior probabilities of the tags of sentences.
+
+        The forward scores of the histories (u, v) ending at each position
+        sum the probabilities of every tagging of the tokens up to it, the
+        backward scores the ones of every tagging of the following tokens.
+        Their product, divided by the probability of the sentence, is the
+        posterior probability of the history; the one of a tag v is the sum
+        over u.
+
+        The scores are kept in log space. At each step the scores of a
+        sentence are shifted by their maximum before being exponentiated, so
+        that the sum over the histories is a product by the transition
+        probabilities (C{numpy.einsum}) which neither overflows nor loses the
+        best histories.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+
+        @return: A list containing for each sentence an array of shape
+            (length, S) of the posterior probability of each tag at each
+            position, null if no tagging of the sentence is possible.
+        @rtype: list
+        """
+        model = self.model
+        ids, mask = self.encode_batch(sentences)
+        B, T = ids.shape
+        N = model.start + 1
+        rows = np.arange(B)
+        last = mask.sum(axis=1) - 1
+        emissions = self.emissions[ids]
+        q = np.exp(self.transitions)
+        alphas = np.empty((T, B, N, N))
+        alpha = np.full((B, N, N), -np.inf)
+        alpha[:, model.start, model.start] = 0.0
+        betas = np.empty((T, B, N, N))
+        beta = np.zeros((B, N, N))
+        with np.errstate(divide='ignore'):
+            for t in xrange(T):
+                p, m = shifted_exp(alpha)
+                alpha = np.log(np.einsum('bwu,wuv->buv', p, q)) + \
+                    m[:, np.newaxis, np.newaxis] + \
+                    emissions[:, t][:, np.newaxis]
+                alphas[t] = alpha
+            for t in xrange(T - 1, -1, -1):
+                if t < T - 1:
+                    p, m = shifted_exp(
+                        emissions[:, t + 1][:, np.newaxis] + beta)
+                    beta = np.log(np.einsum('uvw,bvw->buv', q, p)) + \
+                        m[:, np.newaxis, np.newaxis]
+                beta[last == t] = 0.0
+                betas[t] = beta
+        logZ = log_sum_exp(alphas[last, rows].reshape(B, N * N), axis=1)
+        possible = np.isfinite(logZ)
+        logZ[~possible] = 0.0
+        gamma = log_sum_exp(alphas + betas, axis=2)[:, :, :model.start]
+        posteriors = np.exp(gamma - logZ[:, np.newaxis])
+        posteriors[:, ~possible] = 0.0
+        return [posteriors[:last[b] + 1, b] for b in xrange(B)]
+
+    def posteriors(self, sentences):
+        """Compute the posterior probabilities by batches of close lengths.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+
+        @return: The results of L{posteriors_batch}, in the order of the
+            input sentences.
+        @rtype: list
+        """
+        res = [None] * len(sentences)
+        for bucket in length_buckets(sentences, self.batchSize):
+            for i, probs in zip(bucket, self.posteriors_batch(
+                    [sentences[i] for i in bucket])):
+                res[i] = probs
+        return res
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Cache of the training artifacts.
+
+The counts and the model of a training file only depend on its content and on
+the settings of the training: the n-gram cardinality, the storage of the
+counts (L{pck}) and the rules grouping the rare words, i.e. C{UNCOMMON_LIMIT},
+the group tokens of L{const} and the functions of L{fltr} and L{shp} which
+sort the words into the groups. L{training_key} hashes all of them, so that
+an artifact stored under a key can be reused as long as none of them changes.
+
+An L{ArtifactCache} is a directory holding one folder per key, each folder
+holding the artifacts of a training under fixed names (L{COUNTS},
+L{RAW_COUNTS}, L{MODEL}). The artifacts are written to temporary files
+renamed in place, so that a concurrent reader never sees a partial file.
+When the artifacts take more than the size of the cache, the least recently
+used folders are removed.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import inspect
+import hashlib
+import tempfile
+import fltr
+import shp
+from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
+from const import UNCOMMON_LIMIT
+
+CACHE_VERSION = 3
+DEFAULT_CACHE_SIZE = 256
+HASH_BLOCK_SIZE = 1 << 20
+COUNTS = 'counts'
+RAW_COUNTS = 'raw.counts'
+MODEL = 'model.bin'
+GROUPING_RULES = (fltr.word_groups, fltr.group_map, shp.tkn_cap_first,
+                  shp.tkn_all_caps, shp.tkn_num_punct)
+
+
+def file_digest(path):
+    """Hash the content of a file.
+
+    @param path:
+        The path of the file.
+    @type path: str
+
+    @return: The SHA-1 digest of the file, in hexadecimal.
+    @rtype: str
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = f.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def training_key(path, n, packed=False):
+    """Compute the key of the artifacts of a training.
+
+    @param path:
+        The path of the training file.
+    @type path: str
+    @param n:
+        The n-gram cardinality.
+    @type n: int
+    @param packed:
+        If set, the counts are stored in a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The SHA-1 digest of the training file and of the settings, in
+        hexadecimal.
+    @rtype: str
+    """
+    digest = hashlib.sha1()
+    settings = (CACHE_VERSION, file_digest(path), n, bool(packed),
+                UNCOMMON_LIMIT, UNCOMMON, PROPER_NOUN, CAPITALIZED,
+                PUNCTUATION)
+    digest.update(repr(settings))
+    for rule in GROUPING_RULES:
+        digest.update(inspect.getsource(rule))
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """Directory of artifacts stored by key, evicted in LRU order."""
+
+    def __init__(self, directory, maxSize=DEFAULT_CACHE_SIZE << 20):
+        """ArtifactCache creator.
+
+        @param directory:
+            The directory of the cache, created if needed.
+        @type directory: str
+        @param maxSize:
+            The size in bytes beyond which the least recently used entries
+            are removed.
+        @type maxSize: int
+
+        @raise OSError: If the directory cannot be created.
+        """
+        self.directory = directory
+        self.maxSize = maxSize
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def entry_path(self, key):
+        """Get the folder of the artifacts of a key.
+
+        @param key:
+            The key of the artifacts.
+        @type key: str
+
+        @return: The path of the folder.
+        @rtype: str
+        """
+        return os.path.join(self.directory, key)
+
+    def touch(self, key):
+        """Mark the artifacts of a key as used now.
+
+        @param key:
+            The key of the artifacts.
+        @type key: str
+        """
+        try:
+            os.utime(self.entry_path(key), None)
+        except OSError:
+            pass
+
+    def lookup(self, key, names):
+        """Find the artifacts of a key.
+
+        @param key:
+            The key of the artifacts.
+        @type key: str
+        @param names:
+            The names of the wanted artifacts.
+        @type names: list
+
+        @return: The folder holding the artifacts, None if one of them is
+            missing.
+        @rtype: str
+        """
+        entry = self.entry_path(key)
+        for name in names:
+            if not os.path.isfile(os.path.join(entry, name)):
+                return None
+        self.touch(key)
+        return entry
+
+    def store(self, key, artifacts):
+        """Write artifacts under a key, then evict the oldest entries.
+
+        @param key:
+            The key of the artifacts.
+        @type key: str
+        @param artifacts:
+            The dictionary mapping the names of the artifacts to functions
+            writing them to a binary file object.
+        @type artifacts: dict
+
+        @return: The folder holding the artifacts.
+        @rtype: str
+        """
+        entry = self.entry_path(key)
+        try:
+            os.mkdir(entry)
+        except OSError:
+            if not os.path.isdir(entry):
+                raise
+        for name, write in artifacts.iteritems():
+            fd, tmpPath = tempfile.mkstemp(prefix=name + '.', dir=entry)
+            try:
+                with os.fdopen(fd, 'wb') as output:
+                    write(output)
+                os.rename(tmpPath, os.path.join(entry, name))
+            except BaseException:
+                os.remove(tmpPath)
+                raise
+        self.touch(key)
+        self.evict(keep=key)
+        return entry
+
+    def entries(self):
+        """List the entries of the cache.
+
+        @return: A list of tuples containing the last use time, the size in
+            bytes and the key of each entry, least recently used first.
+        @rtype: list
+        """
+        res = []
+        for key in os.listdir(self.directory):
+            entry = self.entry_path(key)
+            try:
+                used = os.path.getmtime(entry)
+                size = sum(os.path.getsize(os.path.join(entry, name))
+                           for name in os.listdir(entry))
+            except OSError:
+                continue
+            res.append((used, size, key))
+        res.sort()
+        return res
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries beyond the size of the cache.
+
+        @param keep:
+            The key of an entry which is never removed, e.g. the one just
+            stored, even if it is alone larger than the cache.
+        @type keep: str
+        """
+        entries = self.entries()
+        total = sum(size for used, size, key in entries)
+        for used, size, key in entries:
+            if total <= self.maxSize:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
@@ -4,6 +4,8 @@
 from __future__ import print_function
 import sys
 from const import TAG_CLASSES, TAG_IN_PREFIX, TAG_BOUNDARY_PREFIX, TAG_NONE
+from strm import open_stream
+from rdr import tagged_tokens
 
 """Compare the predicted tags to the original tags.
 
@@ -56,47 +58,11 @@ def usage():
         "USAGE: python eval_ne_tagger.py [key_file] [prediction_file]"
         "    Evaluate the NE-tagger output in prediction_file against"
         "    the gold standard in key_file. Output accuracy, precision,"
-        "    recall and F1-Score for each NE tag type.\n"
+        "    recall and F1-Score for each NE tag type. Either file can be"
+        "    '-' for the standard input.\n"
     )
 
 
-def token_generator(tknsFile, addProb=False):
-    """Create an iterator object for each token of the tokens file.
-
-    The elements of the iterator are tuples containing a token and its
-    associated tag. It looks like:
-    C{(David, I-PER)}
-
-    @note: Iterator elements representing empty lines are tuple with token
-    and associated tag set to None.
-
-    @warning: The input file must contain one token per line.
-
-    @param tknsFile:
-        The file containing the tokens.
-    @type tknsFile: FILE
-
-    @return: An iterator generating tuples of tokens and token tags.
-    @rtype: generator
-    """
-    l = tknsFile.readline()
-    tagfield = addProb and -2 or -1
-    try:
-        while l:
-            line = l.strip()
-            if line:
-                fields = line.split(' ')
-                tag = fields[tagfield]
-                word = ' '.join(fields[:tagfield])
-                yield word, tag
-            else:
-                yield (None, None)
-            l = tknsFile.readline()
-    except IndexError:
-        print("Could not read line: %s" % line, file=sys.stderr)
-        sys.exit(1)
-
-
 class EntityCounter(object):
     """Counts for each named enity class."""
 
@@ -134,6 +100,39 @@ class Comparator(object):
         for c in TAG_CLASSES:
             self.class_counts[c] = EntityCounter()
 
+    def get_precision(self):
+        """Compute precision of every predicted named entities.
+
+        @return: The precision, 1 if no named entity was predicted.
+        @rtype: float
+        """
+        if self.tp + self.fp == 0:
+            return 1
+        return self.tp / float(self.tp + self.fp)
+
+    def get_recall(self):
+        """Compute recall rate of every predicted named entities.
+
+        @return: The recall rate, 1 if the original dataset has no named
+            entity.
+        @rtype: float
+        """
+        if self.tp + self.fn == 0:
+            return 1
+        return self.tp / float(self.tp + self.fn)
+
+    def get_fscore(self):
+        """Compute F score of every predicted named entities.
+
+        @return: The F score.
+        @rtype: float
+        """
+        prec = self.get_precision()
+        rec = self.get_recall()
+        if prec + rec == 0:
+            return 0
+        return (2 * prec * rec) / (prec + rec)
+
     def check_end(self, currPredType, currOrigType, predTag, origTag, predType,
                   origType):
         """Check if we reach the end of a named entity.
@@ -241,6 +240,9 @@ class Comparator(object):
         @param predictionTknsTags:
             Generator of token/tag tuples.
         @type predictionTknsTags: generator
+
+        @raise ValueError: If the tokens of the original and prediction do
+            not correspond.
         """
         currPredType = None
         currPredStart = None
@@ -250,11 +252,9 @@ class Comparator(object):
         for origTkn, origTag in originalTknsTags:
             predTkn, predTag = predictionTknsTags.next()
             if origTkn != predTkn:
-                print('Original and prediction fils do not correspond.')
-                print(origTkn)
-                print(predTkn)
-                print('Exiting now...')
-                sys.exit(1)
+                raise ValueError('Original and prediction files do not '
+                                 'correspond (%s and %s).' % (origTkn,
+                                                              predTkn))
             origType = origTag is None and TAG_NONE or origTag.split("-")[-1]
             predType = predTag is None and TAG_NONE or predTag.split("-")[-1]
             predEnds, origEnds = self.check_end(
@@ -307,17 +307,11 @@ class Comparator(object):
         else:
             acc = (self.tp + self.tn) / float(
                 self.tp + self.tn + self.fp + self.fn)
-        if self.tp+self.fp == 0:
-            avgPrec = 1
-        else:
-            avgPrec = self.tp / float(self.tp + self.fp)
-        if self.tp+self.fn == 0:
-            avgRec = 1
-        else:
-            avgRec = self.tp / float(self.tp + self.fn)
+        avgPrec = self.get_precision()
+        avgRec = self.get_recall()
+        avgFscore = self.get_fscore()
         print('class\t| precision\t| recall\t| F')
         print('--------+---------------+---------------+------')
-        avgFscore = (2 * avgPrec * avgRec) / (avgPrec + avgRec)
         for c in TAG_CLASSES:
             c_tp = self.class_counts[c].tp
             c_tn = self.class_counts[c].tn
@@ -363,8 +357,18 @@ if __name__ == "__main__":
     if len(sys.argv) != 3:
         usage()
         sys.exit(1)
-    origIterator = token_generator(file(sys.argv[1]))
-    predIterator = token_generator(file(sys.argv[2]), addProb=True)
+    try:
+        origFile = open_stream(sys.argv[1])
+        predFile = open_stream(sys.argv[2])
+    except IOError as e:
+        print('ERROR: Cannot read input file (%s).' % e, file=sys.stderr)
+        sys.exit(1)
+    origIterator = tagged_tokens(origFile)
+    predIterator = tagged_tokens(predFile, addProb=True)
     evaluator = Comparator()
-    evaluator.compare(origIterator, predIterator)
+    try:
+        evaluator.compare(origIterator, predIterator)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
     evaluator.print_res_table()
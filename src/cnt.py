@@ -2,11 +2,23 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import os
 import sys
+import heapq
+import argparse
+import tempfile
+import multiprocessing
 from collections import defaultdict
 import math
-from const import TOKEN_TAG, SENTENCE_START, SENTENCE_END
+from const import TOKEN_TAG, NGRAM_ORDER, SENTENCE_START, SENTENCE_END
 from const import DEFAULT_NGRAM_CARDINALITY
+from mdl import compile_hmm, write_model, write_sorted_model
+from rdr import SentenceReader, tagged_sentences
+from strm import is_plain_file, open_stream, close_stream
+
+SHARD_SEEK_WINDOW = 1 << 16
+SPILL_ENTRY_SIZE = 200
+MERGE_FANIN = 64
 
 """Functions and class to count frequencies of n-grams in a file.
 
@@ -23,75 +35,6 @@ This is done thanks to a Hidden Markov Model.
 """
 
 
-def usage():
-    """Print a usage message."""
-    print(
-        "USAGE: python cnt.py [input_file]\n"
-        "   Produce counts of tokens and n-grams from the input_file."
-    )
-
-
-def token_generator(tknsFile):
-    """Create an iterator object for each token of the tokens file.
-
-    The elements of the iterator are tuples containing a token and its
-    associated tag. It looks like:
-    C{(David, I-PER)}
-
-    @note: Iterator elements representing empty lines are tuple with token
-    and associated tag set to None.
-
-    @warning: The input file must contain one token per line.
-
-    @param tknsFile:
-        The file containing the tokens.
-    @type tknsFile: FILE
-
-    @return: An iterator generating tuples of tokens and token tags.
-    @rtype: generator
-    """
-    l = tknsFile.readline()
-    while l:
-        line = l.strip()
-        if line:
-            fields = line.split(" ")
-            ne_tag = fields[-1]
-            word = " ".join(fields[:-1])
-            yield word, ne_tag
-        else:
-            yield (None, None)
-        l = tknsFile.readline()
-
-
-def sentence_generator(toknIterator):
-    """Create an iterator object for each sentence of the generated tokens.
-
-    The elements of the iterator are lists of tuples. Every tuples are
-    containing a token and its associated tag. It looks like:
-    C{[('3.', 'O'), ('Goulnara', 'I-PER'), ('Fatkoullina', 'I-PER'),
-    ('Russia', 'I-LOC')]}
-
-    @param toknIterator:
-        A generator iterating on each token of a file.
-    @type toknIterator: generator
-
-    @return: An iterator generating lists of tuples of tokens and token tags.
-    @rtype: generator
-    """
-    current_sentence = []
-    for l in toknIterator:
-        if l == (None, None):
-            if current_sentence:
-                yield current_sentence
-                current_sentence = []
-            else:
-                raise StopIteration
-        else:
-            current_sentence.append(l)
-    if current_sentence:
-        yield current_sentence
-
-
 def ngram_generator(sntncIterator, n):
     """Create an iterator object for each n-gram generated from tokens lists.
 
@@ -120,6 +63,279 @@ def ngram_generator(sntncIterator, n):
             yield n_gram
 
 
+def shard_boundaries(path, nshards):
+    """Split a tokens file into byte ranges aligned on sentence boundaries.
+
+    Every range but the first starts right after an empty line so that each
+    range holds whole sentences.
+
+    @param path:
+        The path of the tokens file.
+    @type path: str
+    @param nshards:
+        The wanted number of ranges.
+    @type nshards: int
+
+    @return: A list of tuples containing the start and end offsets of the
+        ranges. There may be less ranges than wanted for small files.
+    @rtype: list
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in xrange(1, nshards):
+            target = max(size * i // nshards, bounds[-1])
+            f.seek(max(target - 1, 0))
+            window = f.read(SHARD_SEEK_WINDOW)
+            pos = window.find('\n\n')
+            while pos < 0 and len(window) == SHARD_SEEK_WINDOW:
+                f.seek(-1, os.SEEK_CUR)
+                window = f.read(SHARD_SEEK_WINDOW)
+                pos = window.find('\n\n')
+            if pos < 0:
+                break
+            bound = f.tell() - len(window) + pos + 2
+            if bound >= size:
+                break
+            if bound > bounds[-1]:
+                bounds.append(bound)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+class FileRange(object):
+    """Byte range of an open file, read as a file by L{rdr.SentenceReader}."""
+
+    def __init__(self, f, start, end):
+        """FileRange creator.
+
+        @param f:
+            The open file, whose position is moved to the start of the range.
+        @type f: FILE
+        @param start:
+            The offset of the first byte of the range.
+        @type start: int
+        @param end:
+            The offset following the last byte of the range.
+        @type end: int
+        """
+        f.seek(start)
+        self.f = f
+        self.left = end - start
+
+    def read(self, size):
+        """Read at most C{size} bytes, stopping at the end of the range.
+
+        @param size:
+            The number of bytes wanted.
+        @type size: int
+
+        @return: The bytes read, empty at the end of the range.
+        @rtype: str
+        """
+        data = self.f.read(min(size, self.left))
+        self.left -= len(data)
+        return data
+
+
+def count_shard(args):
+    """Count the n-grams of a byte range of a tokens file.
+
+    @param args:
+        A tuple containing the path of the tokens file, the start and end
+        offsets of the range and the n-gram cardinality.
+    @type args: tuple
+
+    @return: A tuple containing the emission counts and the n-grams counts of
+        the range, as lists of items in order of first occurrence, and True
+        if the reading stopped before the end of the range on two
+        consecutive empty lines, as a L{rdr.SentenceReader} does.
+    @rtype: tuple
+    """
+    path, start, end, n = args
+    counter = HMM(n)
+    counter.emission_counts = OrderedCounts()
+    counter.ngramCounts = [OrderedCounts() for i in xrange(n)]
+    with open(path, 'rb') as f:
+        reader = SentenceReader(FileRange(f, start, end))
+        counter.train_sentences(reader.tagged())
+    stopped = reader.stopped
+    return counter.emission_counts.ordered_items(), \
+        [counts.ordered_items() for counts in counter.ngramCounts], stopped
+
+
+def run_key(item):
+    """Get the sort key of the count of a token/tag association in a run.
+
+    The counts are sorted by the first field of their token, then by token
+    and tag, so that the tokens of a word are read in a row.
+
+    @param item:
+        A tuple of a token/tag association and its count.
+    @type item: tuple
+
+    @return: A tuple of the first field, the token and the tag.
+    @rtype: tuple
+    """
+    (word, ne_tag), count = item
+    return word.split(' ')[0], word, ne_tag
+
+
+def write_run(emission_counts, directory=None):
+    """Write emission counts to a temporary run file, sorted by L{run_key}.
+
+    @param emission_counts:
+        The counts of token/tag associations.
+    @type emission_counts: dict
+    @param directory:
+        The directory of the run file, the default temporary directory if
+        not set.
+    @type directory: str
+
+    @return: The path of the run file.
+    @rtype: str
+    """
+    fd, path = tempfile.mkstemp(prefix='ner-run-', suffix='.run',
+                                dir=directory)
+    with os.fdopen(fd, 'wb') as run:
+        for (word, ne_tag), count in sorted(emission_counts.iteritems(),
+                                            key=run_key):
+            run.write('%s %s %i\n' % (word, ne_tag, count))
+    return path
+
+
+def read_run(path):
+    """Create an iterator object for each count of a run file.
+
+    @param path:
+        The path of the run file.
+    @type path: str
+
+    @return: An iterator generating tuples of the first field of a token, the
+        token, its tag and the count of the association, in sorted order.
+    @rtype: generator
+    """
+    with open(path, 'rb') as run:
+        for line in run:
+            word, ne_tag, count = line[:-1].rsplit(' ', 2)
+            yield word.split(' ')[0], word, ne_tag, int(count)
+
+
+def merge_runs(paths):
+    """Merge sorted run files, adding the counts of the same association.
+
+    @param paths:
+        The paths of the run files.
+    @type paths: list
+
+    @return: An iterator generating tuples of a token/tag association and its
+        total count, sorted by L{run_key}.
+    @rtype: generator
+    """
+    key, total = None, 0
+    for first, word, ne_tag, count in heapq.merge(
+            *[read_run(p) for p in paths]):
+        if (word, ne_tag) != key:
+            if key is not None:
+                yield key, total
+            key, total = (word, ne_tag), 0
+        total += count
+    if key is not None:
+        yield key, total
+
+
+def write_merged_run(paths, directory=None):
+    """Merge sorted run files into a new run file.
+
+    @param paths:
+        The paths of the run files.
+    @type paths: list
+    @param directory:
+        The directory of the new run file.
+    @type directory: str
+
+    @return: The path of the new run file.
+    @rtype: str
+    """
+    fd, path = tempfile.mkstemp(prefix='ner-run-', suffix='.run',
+                                dir=directory)
+    with os.fdopen(fd, 'wb') as run:
+        for (word, ne_tag), count in merge_runs(paths):
+            run.write('%s %s %i\n' % (word, ne_tag, count))
+    return path
+
+
+class SpilledCounts(object):
+    """Emission counts spilled to sorted run files.
+
+    The counts are read back by a k-way merge of the runs. At most
+    C{MERGE_FANIN} runs are merged at once: the first runs are merged into
+    larger runs until there are few enough.
+    """
+
+    def __init__(self, runs, directory=None):
+        """SpilledCounts creator.
+
+        @param runs:
+            The paths of the run files, which are removed by L{close}.
+        @type runs: list
+        @param directory:
+            The directory of the merged run files.
+        @type directory: str
+        """
+        self.runs = list(runs)
+        while len(self.runs) > MERGE_FANIN:
+            group = self.runs[:MERGE_FANIN]
+            self.runs[:MERGE_FANIN] = [write_merged_run(group, directory)]
+            for path in group:
+                os.remove(path)
+
+    def __iter__(self):
+        for key, count in self.iteritems():
+            yield key
+
+    def iteritems(self):
+        """Create an iterator object for each count.
+
+        @return: An iterator generating tuples of a token/tag association and
+            its count, sorted by L{run_key}.
+        @rtype: generator
+        """
+        return merge_runs(self.runs)
+
+    def close(self):
+        """Remove the run files."""
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+
+
+class OrderedCounts(dict):
+    """Counts dictionary remembering the order in which the keys were added.
+
+    Adding counts to a dictionary in that order gives the same iteration
+    order as counting directly into it.
+    """
+
+    def __init__(self):
+        """OrderedCounts creator."""
+        dict.__init__(self)
+        self.order = []
+
+    def __missing__(self, key):
+        self.order.append(key)
+        return 0
+
+    def ordered_items(self):
+        """Get the counts in the order in which the keys were added.
+
+        @return: A list of tuples containing the keys and their counts.
+        @rtype: list
+        """
+        return [(key, self[key]) for key in self.order]
+
+
 class HMM(object):
     """Stores counts for n-grams and their probabilities."""
 
@@ -134,12 +350,28 @@ class HMM(object):
             print('ERROR: N-gram cardinality must be 2 or more.',
                   file=sys.stderr)
         self.n = n
+        self.clear()
+
+    def clear(self):
+        """Remove every count of the HMM."""
         self.emission_counts = defaultdict(int)
         self.wordCounts = defaultdict(int)
-        self.ngramCounts = [defaultdict(int) for i in xrange(self.n)]
+        self.ngramCounts = [self.counts_table(i + 1) for i in xrange(self.n)]
         self.states = set()
         self.words = set()
 
+    def counts_table(self, order):
+        """Create an empty table of n-grams counts.
+
+        @param order:
+            The cardinality of the n-grams of the table.
+        @type order: int
+
+        @return: The dictionary mapping n-grams to their counts.
+        @rtype: dict
+        """
+        return defaultdict(int)
+
     def train(self, tknsFile):
         """Count n-grams frequencies and probabilities from a tokens file.
 
@@ -150,8 +382,102 @@ class HMM(object):
             The file containing the tokens.
         @type tknsFile: FILE
         """
-        ngram_iterator = ngram_generator(
-            sentence_generator(token_generator(tknsFile)), self.n)
+        self.train_sentences(tagged_sentences(tknsFile))
+
+    def train_parallel(self, path, jobs):
+        """Count n-grams frequencies of a tokens file in worker processes.
+
+        The file is split into byte ranges of whole sentences which are
+        counted by a pool of processes. The counts of the ranges are merged
+        in order so that the result is the same as the one of L{train}.
+
+        @param path:
+            The path of the file containing the tokens.
+        @type path: str
+        @param jobs:
+            The number of worker processes.
+        @type jobs: int
+        """
+        shards = [(path, start, end, self.n)
+                  for start, end in shard_boundaries(path, jobs)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for emission_counts, ngramCounts, stopped in \
+                    pool.imap(count_shard, shards):
+                self.merge_counts(emission_counts, ngramCounts)
+                if stopped:
+                    break
+        finally:
+            pool.terminate()
+
+    def train_spilling(self, tknsFile, bufferSize, directory=None):
+        """Count n-grams frequencies of a tokens file with bounded memory.
+
+        Whenever the emission counts reach about C{bufferSize} megabytes,
+        they are written to a run file sorted by L{run_key} and counting
+        goes on with empty emission counts. The n-grams counts only hold
+        tags, so they stay in memory. If any run was written, the emission
+        counts become L{SpilledCounts}, which can be written by
+        L{output_counts}, compiled by L{mdl.write_sorted_model} or read by
+        L{reloaded}, and must be closed.
+
+        @param tknsFile:
+            The file containing the tokens.
+        @type tknsFile: FILE
+        @param bufferSize:
+            The memory budget of the emission counts, in megabytes.
+        @type bufferSize: float
+        @param directory:
+            The directory of the run files, the default temporary directory
+            if not set.
+        @type directory: str
+        """
+        maxEntries = max(int(bufferSize * (1 << 20) / SPILL_ENTRY_SIZE), 1)
+        runs = []
+
+        def spilling(sntncIterator):
+            for sentence in sntncIterator:
+                yield sentence
+                if len(self.emission_counts) >= maxEntries:
+                    runs.append(write_run(self.emission_counts, directory))
+                    self.emission_counts = defaultdict(int)
+
+        try:
+            self.train_sentences(
+                spilling(tagged_sentences(tknsFile)))
+            if runs:
+                if self.emission_counts:
+                    runs.append(write_run(self.emission_counts, directory))
+                self.emission_counts = SpilledCounts(runs, directory)
+        except BaseException:
+            for path in runs:
+                os.remove(path)
+            raise
+
+    def merge_counts(self, emission_counts, ngramCounts):
+        """Add emission and n-grams counts to the counts of the HMM.
+
+        @param emission_counts:
+            The items of the counts of token/tag associations.
+        @type emission_counts: list
+        @param ngramCounts:
+            The items of the counts of n-grams of each order.
+        @type ngramCounts: list
+        """
+        for key, count in emission_counts:
+            self.emission_counts[key] += count
+        for counts, items in zip(self.ngramCounts, ngramCounts):
+            for ngram, count in items:
+                counts[ngram] += count
+
+    def train_sentences(self, sntncIterator):
+        """Count n-grams frequencies and probabilities from sentences.
+
+        @param sntncIterator:
+            An iterator generating lists of tuples of tokens and token tags.
+        @type sntncIterator: generator
+        """
+        ngram_iterator = ngram_generator(sntncIterator, self.n)
         for ngram in ngram_iterator:
             if len(ngram) != self.n:
                 print('ERROR: Wrong n-gram cardinality (expected %i, get %i).'
@@ -168,54 +494,120 @@ class HMM(object):
                 self.ngramCounts[self.n - 2][tuple((self.n - 1) *
                                                     [SENTENCE_START])] += 1
 
-    def output_counts(self, output, printngrams=[1, 2, 3]):
+    def output_counts(self, output, printngrams=None):
         """Writes the n-grams counts on the output.
 
+        The first line records the n-gram cardinality, e.g. C{3 ORDER}.
+
         @param output:
             The output where the results will be written.
         @type output: Stream
         @param printngrams:
-            Format of the output: n-grams order.
+            Format of the output: n-grams order, every order up to n by
+            default.
         @type printngrams: list
         """
-        for word, ne_tag in self.emission_counts:
+        if printngrams is None:
+            printngrams = range(1, self.n + 1)
+        output.write("%i %s\n" % (self.n, NGRAM_ORDER))
+        for (word, ne_tag), count in self.emission_counts.iteritems():
             output.write(
-                "%i %s %s %s\n" %
-                (self.emission_counts[(word, ne_tag)], TOKEN_TAG, ne_tag, word))
+                "%i %s %s %s\n" % (count, TOKEN_TAG, ne_tag, word))
         for n in printngrams:
             for ngram in self.ngramCounts[n-1]:
                 ngramstr = " ".join(ngram)
                 output.write("%i %i-GRAM %s\n" %
                              (self.ngramCounts[n-1][ngram], n, ngramstr))
 
-    def load_counts(self, tknsFile):
+    def load_counts(self, tknsFile, raw=False):
         """Read n-grams counts from a tokens file.
 
+        The n-gram cardinality is the one recorded by L{output_counts} or,
+        for the counts files which do not record it, the highest order of
+        the n-grams read.
+
         @param tknsFile:
             The file containing the tokens.
         @type tknsFile: FILE
+        @param raw:
+            If set, the counts are read as integers and the tokens are kept
+            whole, as L{train} counts them, the words counts being still
+            indexed by the first field of the tokens.
+        @type raw: bool
         """
-        self.n = 3
-        self.emission_counts = defaultdict(int)
-        self.wordCounts = defaultdict(int)
-        self.ngramCounts = [defaultdict(int) for i in xrange(self.n)]
-        self.states = set()
-        self.words = set()
+        self.clear()
+        order = None
+        highest = 0
 
         for line in tknsFile:
             parts = line.strip().split(" ")
-            count = float(parts[0])
+            if raw:
+                count = int(parts[0])
+            else:
+                count = float(parts[0])
             if parts[1] == TOKEN_TAG:
-                ne_tag = parts[2]
-                word = parts[3]
-                self.emission_counts[(word, ne_tag)] = count
-                self.wordCounts[word] += count
-                self.states.add(ne_tag)
-                self.words.add(word)
+                if raw:
+                    parts[3] = " ".join(parts[3:])
+                self.load_emission(parts[3], parts[2], count, raw)
             elif parts[1].endswith('GRAM'):
                 n = int(parts[1].replace('-GRAM', ''))
+                while len(self.ngramCounts) < n:
+                    self.ngramCounts.append(
+                        self.counts_table(len(self.ngramCounts) + 1))
                 ngram = tuple(parts[2:])
                 self.ngramCounts[n-1][ngram] = count
+                highest = max(highest, n)
+            elif parts[1] == NGRAM_ORDER:
+                order = int(parts[0])
+        self.n = order or max(highest, 2)
+        while len(self.ngramCounts) < self.n:
+            self.ngramCounts.append(
+                self.counts_table(len(self.ngramCounts) + 1))
+        del self.ngramCounts[self.n:]
+
+    def load_emission(self, word, ne_tag, count, raw=False):
+        """Store the count of a token/tag association read from counts.
+
+        Only the first field of the token is kept: the extra columns of a
+        training file (e.g. the part of speech tags of the dutch dataset)
+        are dropped, unless the counts are read raw. The counts of the
+        tokens sharing their first field and tag are added, so that the
+        counts do not depend on the order of the lines.
+
+        @param word:
+            The token.
+        @type word: str
+        @param ne_tag:
+            The named entity tag.
+        @type ne_tag: str
+        @param count:
+            The number of occurrences of the token/tag association.
+        @type count: float
+        @param raw:
+            If set, the whole token is kept.
+        @type raw: bool
+        """
+        first = word.split(" ")[0]
+        if not raw:
+            word = first
+        self.emission_counts[(word, ne_tag)] += count
+        self.wordCounts[first] += count
+        self.states.add(ne_tag)
+        self.words.add(word)
+
+    def reloaded(self):
+        """Get the HMM as L{load_counts} would read it from L{output_counts}.
+
+        @return: A new HMM holding the counts of this one.
+        @rtype: L{HMM}
+        """
+        counter = type(self)(self.n)
+        for (word, ne_tag), count in self.emission_counts.iteritems():
+            counter.load_emission(word, ne_tag, float(count))
+        for i in xrange(self.n):
+            for ngram, count in self.ngramCounts[i].iteritems():
+                counter.ngramCounts[i][ngram] = float(count)
+        return counter
 
     def emission_prob(self, tkn, tag):
         """Compute emission probability.
@@ -238,41 +630,106 @@ class HMM(object):
         tagCount = self.ngramCounts[0][(tag,)]
         return float(self.emission_counts[(tkn, tag)]) / tagCount
 
-    def mle(self, trigram):
+    def mle(self, ngram):
         """Compute the HMM maximum likelihood estimation.
 
         The maximum likelihood estimation (MLE) is an algorithm of the Hidden
         Markov Model.
 
-        @param trigram:
-            A list of 3 tokens.
-        @type trigram: list
+        @param ngram:
+            A list of n tags: the history of n-1 tags and the next tag.
+        @type ngram: list
 
         @return: The computed maximum likelihood estimation for the given
-            3-gram.
+            n-gram.
         @rtype: float
 
         @see: http://webcourse.cs.technion.ac.il/236522/Spring2008/ho/WCFiles/class08-m8.pdf
         """
-        trigram = tuple(trigram)
-        bigram = tuple(trigram[:2])
-        tknTagCount = self.ngramCounts[2][trigram]
+        ngram = tuple(ngram)
+        history = ngram[:-1]
+        tknTagCount = self.ngramCounts[len(ngram) - 1].get(ngram, 0)
         if float(tknTagCount) == 0.0:
             return float(tknTagCount)
         else:
-            tagCount = self.ngramCounts[1][bigram]
+            tagCount = self.ngramCounts[len(history) - 1][history]
             return float(tknTagCount) / tagCount
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        usage()
+    parser = argparse.ArgumentParser(
+        description='Produce counts of tokens and n-grams from the input_file.')
+    parser.add_argument('input_file', help="training file, '-' for stdin")
+    parser.add_argument(
+        '-o', '--output', default='-', metavar='PATH',
+        help='where to write the counts, compressed if PATH ends with .gz, '
+        '.bz2 or .xz (default: stdout)')
+    parser.add_argument(
+        '-m', '--model', metavar='PATH',
+        help='also write the compiled binary model file to PATH')
+    parser.add_argument(
+        '-n', '--order', type=int, default=DEFAULT_NGRAM_CARDINALITY,
+        metavar='N', help='n-gram cardinality of the tags model, 2 for '
+        'bigrams, 4 for 4-grams (default: %(default)s)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, metavar='N',
+        help='count the input_file in N worker processes (uncompressed '
+        'files only)')
+    parser.add_argument(
+        '-S', '--buffer-size', type=float, metavar='MB',
+        help='keep about MB megabytes of counts in memory, spilling sorted '
+        'runs to temporary files beyond')
+    parser.add_argument(
+        '-T', '--temporary-directory', metavar='DIR',
+        help='directory of the runs of --buffer-size (default: the system '
+        'temporary directory)')
+    args = parser.parse_args()
+    if args.order < 2:
+        parser.error('the n-gram cardinality must be at least 2')
+    if args.buffer_size is not None and args.jobs > 1:
+        parser.error('--buffer-size cannot be used with --jobs')
+    if args.buffer_size is not None and args.buffer_size <= 0:
+        parser.error('the buffer size must be positive')
+    try:
+        input = open_stream(args.input_file)
+    except IOError:
+        print("ERROR: Cannot read inputfile %s." % args.input_file,
+              file=sys.stderr)
         sys.exit(1)
     try:
-        input = file(sys.argv[1], 'r')
+        output = open_stream(args.output, 'w')
     except IOError:
-        print("ERROR: Cannot read inputfile %s." % sys.argv[1], file=sys.stderr)
+        print("ERROR: Cannot write output file %s." % args.output,
+              file=sys.stderr)
+        sys.exit(1)
+    counter = HMM(args.order)
+    try:
+        if args.buffer_size is not None:
+            counter.train_spilling(input, args.buffer_size,
+                                   args.temporary_directory)
+        elif args.jobs > 1 and is_plain_file(args.input_file):
+            counter.train_parallel(args.input_file, args.jobs)
+        else:
+            counter.train(input)
+    except (IOError, OSError) as e:
+        print("ERROR: Cannot write run file (%s)." % e, file=sys.stderr)
         sys.exit(1)
-    counter = HMM(3)
-    counter.train(input)
-    counter.output_counts(sys.stdout)
+    try:
+        counter.output_counts(output)
+        close_stream(output)
+        if args.model:
+            try:
+                with open(args.model, 'wb') as output:
+                    if isinstance(counter.emission_counts, SpilledCounts):
+                        write_sorted_model(
+                            counter, counter.emission_counts.iteritems(),
+                            output, directory=args.temporary_directory)
+                    else:
+                        write_model(compile_hmm(counter.reloaded()), output)
+            except (IOError, OSError):
+                print("ERROR: Cannot write model file %s." % args.model,
+                      file=sys.stderr)
+                sys.exit(1)
+    finally:
+        if isinstance(counter.emission_counts, SpilledCounts):
+            counter.emission_counts.close()
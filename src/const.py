@@ -6,6 +6,7 @@ PROPER_NOUN = '_PROPER_NOUN_'
 CAPITALIZED = '_CAPITALIZED_'
 PUNCTUATION = '_PUNCTUATION_'
 TOKEN_TAG = 'TOKEN'
+NGRAM_ORDER = 'ORDER'
 SENTENCE_START = '*'
 SENTENCE_END = 'END'
 TAG_CLASSES = ['PER', 'ORG', 'LOC', 'MISC']
@@ -14,3 +15,4 @@ TAG_IN_PREFIX = 'I'
 TAG_BOUNDARY_PREFIX = 'B'
 UNCOMMON_LIMIT = 5
 DEFAULT_NGRAM_CARDINALITY = 3
+DEFAULT_BATCH_SIZE = 256
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Evaluation of every dataset against every of its test files.
+
+The datasets are the folders of the data directory. Each folder "lang" holds
+a training file lang.train and pairs of test files lang.testN and
+lang.testN.orig (see the README). The model of each dataset is trained once
+(L{trn}), or taken from the cache of the trainings (L{cch}) if one is given,
+and written as a binary model file in a temporary directory, then
+every test file of the dataset is tagged and compared to its original tags
+(L{cmp.Comparator}). Both the trainings and the evaluations are run in a pool
+of worker processes.
+
+The results are printed as a single table with one row per test file and a
+last row summing the named entities of every test file. They can also be
+written as JSON.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from btch import np
+from cch import ArtifactCache, DEFAULT_CACHE_SIZE, MODEL
+from cmp import Comparator
+from const import TAG_CLASSES
+from mdl import compile_hmm, write_model, load_model
+from strm import open_stream, close_stream
+from const import DEFAULT_NGRAM_CARDINALITY
+from rdr import tagged_tokens, word_sentences
+from tag import tag_sentences
+from trn import train, cached_train
+
+TEST_SUFFIX = '.test'
+ORIG_SUFFIX = '.orig'
+
+
+def find_datasets(dataDir):
+    """Find the datasets and their pairs of test files.
+
+    @param dataDir:
+        The directory holding one folder per dataset.
+    @type dataDir: str
+
+    @return: A list of tuples containing the name of a dataset, the path of
+        its training file and the list of its test files, each being a tuple
+        of the test name (e.g. 'testa'), the path of the test file and the
+        path of the original test file.
+    @rtype: list
+    """
+    datasets = []
+    for name in sorted(os.listdir(dataDir)):
+        folder = os.path.join(dataDir, name)
+        trainPath = os.path.join(folder, name + '.train')
+        if not os.path.isfile(trainPath):
+            continue
+        tests = []
+        prefix = name + TEST_SUFFIX
+        for fileName in sorted(os.listdir(folder)):
+            origPath = os.path.join(folder, fileName + ORIG_SUFFIX)
+            if fileName.startswith(prefix) and \
+                    not fileName.endswith(ORIG_SUFFIX) and \
+                    os.path.isfile(origPath):
+                tests.append((fileName[len(name) + 1:],
+                              os.path.join(folder, fileName), origPath))
+        if tests:
+            datasets.append((name, trainPath, tests))
+    return datasets
+
+
+def train_dataset(args):
+    """Train the model of a dataset in a worker process.
+
+    @param args:
+        A tuple containing the path of the training file, the path where
+        the binary model file will be written, the n-gram cardinality and
+        the directory and size in MB of the cache of the trainings, or None.
+    @type args: tuple
+
+    @return: The training time in seconds.
+    @rtype: float
+    """
+    trainPath, modelPath, n, cacheDir, cacheSize = args
+    start = time.time()
+    if cacheDir is not None:
+        entry = cached_train(ArtifactCache(cacheDir, cacheSize << 20),
+                             trainPath, n, model=True)
+        shutil.copyfile(os.path.join(entry, MODEL), modelPath)
+        return time.time() - start
+    tknsFile = open_stream(trainPath)
+    counter = train(tknsFile, n)
+    close_stream(tknsFile)
+    with open(modelPath, 'wb') as output:
+        write_model(compile_hmm(counter.reloaded()), output)
+    return time.time() - start
+
+
+def evaluate(args):
+    """Tag a test file and compare it to its original in a worker process.
+
+    @param args:
+        A tuple containing the path of the binary model file, the path of the
+        test file, the path of the original test file and the decoding options
+        of L{tag.tag_sentences}.
+    @type args: tuple
+
+    @return: A tuple containing the comparator holding the counts of named
+        entities and the tagging time in seconds.
+    @rtype: tuple
+
+    @raise ValueError: If the tokens of the test files do not correspond.
+    """
+    modelPath, testPath, origPath, options = args
+    start = time.time()
+    model = load_model(modelPath)
+    testFile = open_stream(testPath)
+    predicted = []
+    for sentence, tags in tag_sentences(
+            model, word_sentences(testFile), **options):
+        predicted.extend(zip(sentence, [tag for tag, logProb in tags]))
+        predicted.append((None, None))
+    close_stream(testFile)
+    elapsed = time.time() - start
+    origFile = open_stream(origPath)
+    evaluator = Comparator()
+    try:
+        evaluator.compare(tagged_tokens(origFile), iter(predicted))
+    except ValueError as e:
+        raise ValueError('%s and %s: %s' % (testPath, origPath, e))
+    finally:
+        close_stream(origFile)
+    return evaluator, elapsed
+
+
+def run_matrix(datasets, workers, n=DEFAULT_NGRAM_CARDINALITY, cacheDir=None,
+               cacheSize=DEFAULT_CACHE_SIZE, **options):
+    """Train every dataset and evaluate every test file.
+
+    @param datasets:
+        The datasets given by L{find_datasets}.
+    @type datasets: list
+    @param workers:
+        The number of worker processes.
+    @type workers: int
+    @param n:
+        The n-gram cardinality of the models.
+    @type n: int
+    @param cacheDir:
+        The directory of the cache of the trainings, None to train every
+        model.
+    @type cacheDir: str
+    @param cacheSize:
+        The size of the cache in MB.
+    @type cacheSize: int
+    @param options:
+        The decoding options of L{tag.tag_sentences}.
+    @type options: dict
+
+    @return: A list of tuples containing the name of a dataset, the name of a
+        test file, its comparator, the training time of the dataset and the
+        tagging time of the test file.
+    @rtype: list
+    """
+    modelDir = tempfile.mkdtemp(prefix='ner-models-')
+    pool = multiprocessing.Pool(workers)
+    try:
+        models = [os.path.join(modelDir, name + '.bin')
+                  for name, trainPath, tests in datasets]
+        trainTimes = pool.map(train_dataset, [
+            (trainPath, model, n, cacheDir, cacheSize)
+            for (name, trainPath, tests), model in
+            zip(datasets, models)])
+        jobs = []
+        for (name, trainPath, tests), model, trainTime in \
+                zip(datasets, models, trainTimes):
+            for testName, testPath, origPath in tests:
+                jobs.append((name, testName, trainTime,
+                             (model, testPath, origPath, options)))
+        results = pool.map(evaluate, [job[-1] for job in jobs])
+    finally:
+        pool.terminate()
+        shutil.rmtree(modelDir)
+    return [(name, testName, evaluator, trainTime, tagTime)
+            for (name, testName, trainTime, args), (evaluator, tagTime)
+            in zip(jobs, results)]
+
+
+def total_comparator(results):
+    """Sum the named entities counts of every evaluation.
+
+    @param results:
+        The results given by L{run_matrix}.
+    @type results: list
+
+    @return: A comparator holding the counts of every test file.
+    @rtype: L{cmp.Comparator}
+    """
+    total = Comparator()
+    for name, testName, evaluator, trainTime, tagTime in results:
+        for attr in ('tp', 'tn', 'fp', 'fn'):
+            setattr(total, attr, getattr(total, attr) +
+                    getattr(evaluator, attr))
+            for c in TAG_CLASSES:
+                setattr(total.class_counts[c], attr,
+                        getattr(total.class_counts[c], attr) +
+                        getattr(evaluator.class_counts[c], attr))
+    return total
+
+
+def print_matrix(results, output=sys.stdout):
+    """Write the precision, recall and F value of every evaluation.
+
+    @param results:
+        The results given by L{run_matrix}.
+    @type results: list
+    @param output:
+        The output where the table will be written.
+    @type output: Stream
+    """
+    rows = [('%s %s' % (name, testName), evaluator)
+            for name, testName, evaluator, trainTime, tagTime in results]
+    rows.append(('TOTAL', total_comparator(results)))
+    output.write('test\t\t| precision\t| recall\t| F\t| entities\n')
+    output.write('----------------+---------------+---------------+-------'
+                 '+---------\n')
+    for label, evaluator in rows:
+        if label == 'TOTAL':
+            output.write('----------------+---------------+---------------+'
+                         '-------+---------\n')
+        output.write('%s\t| %.2f%%\t| %.2f%%\t| %.2f\t| %i\n' % (
+            label.ljust(14), evaluator.get_precision() * 100,
+            evaluator.get_recall() * 100, evaluator.get_fscore() * 100,
+            evaluator.tp + evaluator.fn))
+
+
+def results_json(results):
+    """Convert the results of the evaluations to JSON serializable objects.
+
+    @param results:
+        The results given by L{run_matrix}.
+    @type results: list
+
+    @return: A list holding one dictionary per evaluation.
+    @rtype: list
+    """
+    res = []
+    for name, testName, evaluator, trainTime, tagTime in results:
+        classes = {}
+        for c in TAG_CLASSES:
+            counts = evaluator.class_counts[c]
+            classes[c] = dict(tp=counts.tp, fp=counts.fp, fn=counts.fn)
+        res.append(dict(
+            dataset=name, test=testName,
+            precision=evaluator.get_precision(),
+            recall=evaluator.get_recall(), fscore=evaluator.get_fscore(),
+            tp=evaluator.tp, fp=evaluator.fp, fn=evaluator.fn,
+            classes=classes, train_time=trainTime, tag_time=tagTime))
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Train every dataset of the data directory once, tag '
+        'and score every of its test files in parallel and print the '
+        'results in a single table.')
+    parser.add_argument(
+        'data_dir', nargs='?', default='data',
+        help='directory holding one folder per dataset (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        metavar='N', help='number of worker processes (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '-n', '--order', type=int, default=DEFAULT_NGRAM_CARDINALITY,
+        metavar='N', help='n-gram cardinality of the tags models '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, metavar='N',
+        help='decode batches of N sentences with NumPy, trigram models only')
+    parser.add_argument(
+        '-j', '--json', metavar='PATH',
+        help="also write the results as JSON to PATH, '-' for stdout")
+    parser.add_argument(
+        '-c', '--cache', metavar='DIR',
+        help='reuse the models of previous trainings stored in DIR, or store '
+        'them there (see src/trn.py)')
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_SIZE, metavar='MB',
+        help='size of the cache beyond which the least recently used '
+        'trainings are removed (default: %(default)s)')
+    args = parser.parse_args()
+    if args.cache_size <= 0:
+        parser.error('the size of the cache must be positive')
+    if args.order < 2:
+        parser.error('the n-gram cardinality must be at least 2')
+    if args.batch_size and args.order != 3:
+        parser.error('--batch-size requires trigram models')
+    if args.batch_size and np is None:
+        parser.error('--batch-size requires NumPy')
+    try:
+        datasets = find_datasets(args.data_dir)
+    except OSError:
+        print('ERROR: Cannot read data directory %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    if not datasets:
+        print('ERROR: No dataset found in %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    try:
+        results = run_matrix(datasets, max(args.workers, 1), args.order,
+                             args.cache, args.cache_size,
+                             batchSize=args.batch_size)
+    except (IOError, OSError, ValueError) as e:
+        print('ERROR: %s' % e, file=sys.stderr)
+        sys.exit(1)
+    if args.json == '-':
+        json.dump(results_json(results), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_matrix(results)
+        if args.json:
+            try:
+                with open(args.json, 'w') as output:
+                    json.dump(results_json(results), output, indent=2)
+            except IOError:
+                print('ERROR: Cannot write JSON file %s.' % args.json,
+                      file=sys.stderr)
+                sys.exit(1)
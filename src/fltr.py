@@ -49,64 +49,20 @@ the word categories along with their remplacement GROUP TOKENS::
 """
 
 from __future__ import print_function
+import os
 import sys
 import math
-import string
-import fileinput
+import shutil
+import argparse
 from collections import defaultdict
 from cnt import HMM
+from pck import PackedHMM
+from mdl import is_model_file, load_model
+from shp import tkn_cap_first, tkn_all_caps, tkn_num_punct
+from strm import STDIO, is_plain_file, open_stream, close_stream
+from strm import temporary_path
 from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
-
-
-def usage():
-    """Print a usage message."""
-    print(
-        "USAGE: python group_rare.py [counts_file] [input_file]"
-        "    Read in named entity tagged training input file"
-        "    and corresponding counts_file and group words"
-        "    based on defined criteria. Replace all grouped"
-        "    words in the training symbol for a common symbol"
-        "    for said group in the form _GROUPID_."
-    )
-
-
-def tkn_cap_first(tkn):
-    """Check if a token starts with a capitalized letter.
-
-    @param tkn:
-        The token to check.
-    @type tkn: str
-
-    @return: True or False wether the token do starts with a capitalized letter.
-    @rtype: bool
-    """
-    return tkn.istitle()
-
-
-def tkn_all_caps(tkn):
-    """Check if a token contains only capitalized letters.
-
-    @param tkn:
-        The token to check.
-    @type tkn: str
-
-    @return: True or False wether the token contains only capitalized letters.
-    @rtype: bool
-    """
-    return tkn.isupper()
-
-
-def tkn_num_punct(tkn):
-    """Check if a token contains only punctuation or digits.
-
-    @param tkn:
-        The token to check.
-    @type tkn: str
-
-    @return: True or False wether the token contains only punctuation/digits.
-    @rtype: bool
-    """
-    return all(c in string.punctuation or c.isdigit() for c in tkn)
+from const import UNCOMMON_LIMIT
 
 
 def remove_sub_dict(subdict, dictionary):
@@ -124,56 +80,138 @@ def remove_sub_dict(subdict, dictionary):
         dictionary.pop(key, None)
 
 
-def replace_all(toknTagFile, wordsToReplace, substitute):
-    """Replace all instances of every words of a list with subsitute in a file.
-
-    @param toknTagFile:
-        The path of the file containing token/tag associations which will be
-        modified.
-    @type toknTagFile: str
-    @param wordsToReplace:
-        The dictionary containing the words to replace as keys.
-    @type wordsToReplace: dict
-    @param substitute:
-        The substitution string which will replace every instances of of
-        every words in 'wordsToReplace'.
-    @type substitute: str
+def word_groups(wordCounts, limit=UNCOMMON_LIMIT):
+    """Split the uncommon words into the replacement groups.
+
+    @param wordCounts:
+        The dictionary mapping the words to their number of occurrences.
+    @type wordCounts: dict
+    @param limit:
+        The number of occurrences under which a word is uncommon.
+    @type limit: int
+
+    @return: A list of tuples containing a dictionary of words to replace and
+        their substitution group token, in order of replacement.
+    @rtype: list
+    """
+    uncommon = dict((k, v) for k, v in wordCounts.iteritems() if v < limit)
+    cf = dict((k, v) for k, v in uncommon.iteritems() if tkn_cap_first(k))
+    np = dict((k, v) for k, v in uncommon.iteritems() if tkn_num_punct(k))
+    ac = dict((k, v) for k, v in uncommon.iteritems() if tkn_all_caps(k))
+    remove_sub_dict(cf, uncommon)
+    remove_sub_dict(np, uncommon)
+    remove_sub_dict(ac, uncommon)
+    return [(uncommon, UNCOMMON), (cf, PROPER_NOUN), (np, PUNCTUATION),
+            (ac, CAPITALIZED)]
+
+
+def group_map(wordCounts, limit=UNCOMMON_LIMIT):
+    """Merge the replacement groups into a single substitution map.
+
+    The groups are applied in order to every word, just like successive
+    replacements of the whole file would do.
+
+    @param wordCounts:
+        The dictionary mapping the words to their number of occurrences.
+    @type wordCounts: dict
+    @param limit:
+        The number of occurrences under which a word is uncommon.
+    @type limit: int
+
+    @return: The dictionary mapping the words to replace to their
+        substitution group token.
+    @rtype: dict
+    """
+    groups = word_groups(wordCounts, limit)
+    substitutions = {}
+    for word in set().union(*(words for words, tkn in groups)):
+        tkn = word
+        for words, substitute in groups:
+            if tkn in words:
+                tkn = substitute
+        substitutions[word] = tkn
+    return substitutions
+
+
+def substitute_all(tknsFile, output, substitutions):
+    """Replace the words of a token/tag file in a single pass.
+
+    Only the first field of a token is replaced, the groups being merged
+    by L{group_map}.
+
+    @param tknsFile:
+        The file containing token/tag associations.
+    @type tknsFile: FILE
+    @param output:
+        The output where the modified lines will be written.
+    @type output: Stream
+    @param substitutions:
+        The dictionary mapping the words to replace to their substitute.
+    @type substitutions: dict
     """
-    for line in fileinput.input(toknTagFile, inplace=True):
-        parts = line.strip().split(" ")
-        if parts[0] in wordsToReplace:
-            parts[0] = substitute
+    write = output.write
+    for line in tknsFile:
+        if line.strip().split(" ", 1)[0] in substitutions:
+            parts = line.strip().split(" ")
+            parts[0] = substitutions[parts[0]]
             line = " ".join(parts) + "\n"
-        sys.stdout.write(line)
+        write(line)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        usage()
+    parser = argparse.ArgumentParser(
+        description='Read in named entity tagged training input file and '
+        'corresponding counts_file (or binary model file) and group words '
+        'based on defined criteria. Replace all grouped words in the '
+        'training file by a common symbol for said group in the form '
+        '_GROUPID_.')
+    parser.add_argument('counts_file')
+    parser.add_argument('input_file')
+    parser.add_argument(
+        'output_file', nargs='?',
+        help="where to write the result, '-' for the standard output "
+        "(default: rewrite input_file, or write to the standard output if "
+        "input_file is '-')")
+    parser.add_argument(
+        '-p', '--packed', action='store_true',
+        help='store the counts in arrays of integers, which takes less '
+        'memory on large counts files')
+    args = parser.parse_args()
+    try:
+        if is_plain_file(args.counts_file) and \
+                is_model_file(args.counts_file):
+            wordCounts = load_model(args.counts_file).word_counts()
+        else:
+            counter = PackedHMM() if args.packed else HMM()
+            countsFile = open_stream(args.counts_file)
+            counter.load_counts(countsFile)
+            close_stream(countsFile)
+            wordCounts = counter.wordCounts
+    except (IOError, ValueError):
+        print('ERROR: Cannot read input file %s.' % args.counts_file,
+              file=sys.stderr)
         sys.exit(1)
     try:
-        input = file(sys.argv[1], 'r')
+        tknsFile = open_stream(args.input_file)
     except IOError:
-        print(
-            'ERROR: Cannot read input file %s.' % sys.argv[1], file=sys.stderr)
+        print('ERROR: Cannot read input file %s.' % args.input_file,
+              file=sys.stderr)
         sys.exit(1)
+    outputPath = args.output_file
+    if not outputPath and args.input_file == STDIO:
+        outputPath = STDIO
     try:
-        output = sys.argv[2]
-    except IOError:
-        print(
-            'ERROR: Cannot read input file %s.' % sys.argv[2], file=sys.stderr)
+        if outputPath:
+            output = open_stream(outputPath, 'w')
+        else:
+            tmpPath = temporary_path(args.input_file)
+            output = open_stream(tmpPath, 'w')
+    except (IOError, OSError):
+        print('ERROR: Cannot write output file %s.' % (
+            outputPath or args.input_file), file=sys.stderr)
         sys.exit(1)
-    counter = HMM(3)
-    counter.load_counts(input)
-    uncommon = dict((k, v) for k, v in counter.wordCounts.iteritems() if v < 5)
-    common = dict((k, v) for k, v in counter.wordCounts.iteritems() if v > 5)
-    cf = dict((k, v) for k, v in uncommon.iteritems() if tkn_cap_first(k))
-    np = dict((k, v) for k, v in uncommon.iteritems() if tkn_num_punct(k))
-    ac = dict((k, v) for k, v in uncommon.iteritems() if tkn_all_caps(k))
-    remove_sub_dict(cf, uncommon)
-    remove_sub_dict(np, uncommon)
-    remove_sub_dict(ac, uncommon)
-    replace_all(output, uncommon, UNCOMMON)
-    replace_all(output, cf, PROPER_NOUN)
-    replace_all(output, np, PUNCTUATION)
-    replace_all(output, ac, CAPITALIZED)
+    substitute_all(tknsFile, output, group_map(wordCounts))
+    close_stream(output)
+    if not outputPath:
+        shutil.copymode(args.input_file, tmpPath)
+        os.rename(tmpPath, args.input_file)
@@ -0,0 +1,734 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Frozen, integer-indexed model used by the tagger.
+
+A trained L{cnt.HMM} stores its counts in dictionaries keyed by strings and
+tuples of strings. Looking those up in the innermost loop of the Viterbi
+algorithm is slow: each step rebuilds tuples, hashes them and repeats a
+division. This module "compiles" a loaded HMM into a frozen model where:
+    - the states (tags) are mapped to small integers, the sentence start
+      symbol being the last index;
+    - the vocabulary is mapped to rows of a dense log-emission table;
+    - the transition probabilities are stored as one row of S
+      log-probabilities per history of n-1 tags, only for the histories seen
+      in the training file: most of the S^(n-1) histories never occur. The
+      transitions of a trigram model are also available as a dense
+      (S+1)x(S+1)xS log-transition table.
+
+Probabilities are stored as natural logarithms, a null probability being
+stored as C{float('-inf')}.
+
+A compiled model can be written to a versioned binary model file. The file is
+made of a header, string tables for the tags and the words and flat arrays of
+little-endian doubles::
+    header        magic, version, n, S, V (words), C (common words)
+    tags          u32 size + the S tags separated by newlines
+    words         u32 size + the V words separated by newlines, the C common
+                  words first
+    word counts   V doubles
+    emissions     (C+4) x S doubles, one row per common word then one row per
+                  group token
+    transitions   u32 H + H histories, each made of the n-1 u32 identifiers
+                  of its tags (S for the sentence start) and S doubles
+    word index    u32 K + V+1 u32 offsets of the words in their string
+                  table + K u32 slots of a hash table of the common words,
+                  holding the identifier of a word plus one (0 if empty)
+The loader maps the file in memory: the emission rows, the words, their
+counts and the vocabulary of the common words are read from the mapping when
+needed, so that the file is never parsed entry by entry and the processes
+loading the same file share its pages instead of each building its own
+dictionaries. Only the transition rows, S doubles per observed history, are
+copied.
+"""
+
+from __future__ import print_function
+import math
+import mmap
+import zlib
+import struct
+import tempfile
+from array import array
+from itertools import izip, groupby
+from collections import defaultdict
+from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
+from const import SENTENCE_START, UNCOMMON_LIMIT, DEFAULT_NGRAM_CARDINALITY
+from shp import wordClassifier
+
+NEG_INF = float('-inf')
+GROUP_TOKENS = (UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION)
+MODEL_MAGIC = 'NERMODEL'
+MODEL_VERSION = 3
+HEADER = struct.Struct('<8s5I')
+SIZE = struct.Struct('<I')
+SPAN = struct.Struct('<2I')
+DOUBLE = struct.Struct('<d')
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def safe_log(prob):
+    """Compute the natural logarithm of a probability.
+
+    @param prob:
+        A probability.
+    @type prob: float
+
+    @return: The logarithm of the probability or -inf if it is null.
+    @rtype: float
+    """
+    if prob <= 0:
+        return NEG_INF
+    return math.log(prob)
+
+
+class MappedTable(object):
+    """Read-only table of doubles stored row by row in a memory map."""
+
+    def __init__(self, buf, offset, nrows, ncols):
+        """MappedTable creator.
+
+        @param buf:
+            The memory map holding the table.
+        @type buf: mmap
+        @param offset:
+            The offset of the first row in the memory map.
+        @type offset: int
+        @param nrows:
+            The number of rows.
+        @type nrows: int
+        @param ncols:
+            The number of doubles per row.
+        @type ncols: int
+        """
+        self.buf = buf
+        self.offset = offset
+        self.nrows = nrows
+        self.row = struct.Struct('<%id' % ncols)
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.nrows
+        if not 0 <= i < self.nrows:
+            raise IndexError('row index out of range')
+        return self.row.unpack_from(self.buf, self.offset + i * self.row.size)
+
+
+class MappedArray(object):
+    """Read-only array of doubles stored in a memory map."""
+
+    def __init__(self, buf, offset, size):
+        """MappedArray creator.
+
+        @param buf:
+            The memory map holding the array.
+        @type buf: mmap
+        @param offset:
+            The offset of the first double in the memory map.
+        @type offset: int
+        @param size:
+            The number of doubles.
+        @type size: int
+        """
+        self.buf = buf
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('array index out of range')
+        return DOUBLE.unpack_from(self.buf, self.offset + i * DOUBLE.size)[0]
+
+
+class MappedStrings(object):
+    """Read-only list of the strings of a string table of a memory map."""
+
+    def __init__(self, buf, offset, spans, size):
+        """MappedStrings creator.
+
+        @param buf:
+            The memory map holding the string table.
+        @type buf: mmap
+        @param offset:
+            The offset of the first string in the memory map.
+        @type offset: int
+        @param spans:
+            The offset in the memory map of the size+1 u32 offsets of the
+            strings in the table, each string being followed by a newline.
+        @type spans: int
+        @param size:
+            The number of strings.
+        @type size: int
+        """
+        self.buf = buf
+        self.offset = offset
+        self.spans = spans
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('list index out of range')
+        start, end = SPAN.unpack_from(self.buf, self.spans + i * SIZE.size)
+        return self.buf[self.offset + start:self.offset + end - 1]
+
+
+class MappedVocabulary(object):
+    """Read-only hash table mapping the common words to their row.
+
+    The words are hashed with C{zlib.crc32}, the collisions being resolved
+    by linear probing.
+    """
+
+    def __init__(self, words, buf, offset, nslots, size):
+        """MappedVocabulary creator.
+
+        @param words:
+            Every word of the model, the common words first.
+        @type words: L{MappedStrings}
+        @param buf:
+            The memory map holding the hash table.
+        @type buf: mmap
+        @param offset:
+            The offset of the first slot in the memory map.
+        @type offset: int
+        @param nslots:
+            The number of slots, a power of two.
+        @type nslots: int
+        @param size:
+            The number of common words.
+        @type size: int
+        """
+        self.words = words
+        self.buf = buf
+        self.offset = offset
+        self.mask = nslots - 1
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in xrange(self.size):
+            yield self.words[i]
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def get(self, word, default=None):
+        i = zlib.crc32(word) & self.mask
+        while True:
+            row, = SIZE.unpack_from(self.buf, self.offset + i * SIZE.size)
+            if not row:
+                return default
+            if self.words[row - 1] == word:
+                return row - 1
+            i = (i + 1) & self.mask
+
+
+def slot_count(size):
+    """Get the number of slots of the hash table of L{MappedVocabulary}.
+
+    @param size:
+        The number of common words.
+    @type size: int
+
+    @return: The smallest power of two at least twice the number of words.
+    @rtype: int
+    """
+    nslots = 1
+    while nslots < 2 * size:
+        nslots <<= 1
+    return nslots
+
+
+def hash_slots(words):
+    """Build the slots of the hash table of L{MappedVocabulary}.
+
+    @param words:
+        The common words, in order of row.
+    @type words: list
+
+    @return: The slots, at least twice as many as the words.
+    @rtype: array
+    """
+    nslots = slot_count(len(words))
+    slots = array('I', [0]) * nslots
+    mask = nslots - 1
+    for row, word in enumerate(words):
+        i = zlib.crc32(word) & mask
+        while slots[i]:
+            i = (i + 1) & mask
+        slots[i] = row + 1
+    return slots
+
+
+class Model(object):
+    """Integer-indexed log-probability tables of an n-gram HMM."""
+
+    def __init__(self, states, vocab, groups, emissions, histories,
+                 words=None, wordCounts=None, n=DEFAULT_NGRAM_CARDINALITY):
+        """Model creator.
+
+        @param states:
+            The tags, the index of a tag in this list is its identifier.
+        @type states: list
+        @param vocab:
+            The dictionary mapping common words to their emission row.
+        @type vocab: dict
+        @param groups:
+            The dictionary mapping group tokens to their emission row.
+        @type groups: dict
+        @param emissions:
+            The log-emission table: one row of S log-probabilities per word.
+        @type emissions: list
+        @param histories:
+            The dictionary mapping the observed histories, tuples of the n-1
+            previous tags, to their row of S log-transition probabilities.
+        @type histories: dict
+        @param words:
+            Every word of the training set, the common words first in the
+            order of their emission rows.
+        @type words: list
+        @param wordCounts:
+            The number of occurrences of each word of C{words}.
+        @type wordCounts: list
+        @param n:
+            The n-gram cardinality.
+        @type n: int
+        """
+        self.states = states
+        self.vocab = vocab
+        self.groups = groups
+        self.emissions = emissions
+        self.histories = histories
+        self.words = words or []
+        self.wordCounts = wordCounts or []
+        self.n = n
+        self.start = len(states)
+        self.startHistory = (self.start,) * (n - 1)
+        self.tagDictionary = {}
+        self.historyIndex = None
+        self.transitions = None
+        if n == 3:
+            empty = (NEG_INF,) * self.start
+            self.transitions = [
+                [histories.get((w, u), empty) for u in xrange(self.start + 1)]
+                for w in xrange(self.start + 1)]
+
+    def emission_index(self, word):
+        """Get the index of the log-emission row of a word.
+
+        Words which are unknown or rare are replaced by their group token,
+        given by the shared L{shp.wordClassifier}.
+
+        @param word:
+            A token of the sentence to tag.
+        @type word: str
+
+        @return: The index of the word row in the log-emission table.
+        @rtype: int
+        """
+        row = self.vocab.get(word)
+        if row is None:
+            row = self.groups[wordClassifier.group(word)]
+        return row
+
+    def emission_row(self, word):
+        """Get the log-emission row of a word.
+
+        @param word:
+            A token of the sentence to tag.
+        @type word: str
+
+        @return: The S log-emission probabilities of the word.
+        @rtype: tuple
+        """
+        return self.emissions[self.emission_index(word)]
+
+    def row_tags(self, row):
+        """Get the tags a word of the tag dictionary was seen with.
+
+        The tags of a row are the ones of non null log-emission probability,
+        that is the ones the word (or the group token) was counted with in the
+        training file. They are computed once per row.
+
+        @param row:
+            The index of a row of the log-emission table.
+        @type row: int
+
+        @return: The tags of non null emission probability.
+        @rtype: tuple
+        """
+        tags = self.tagDictionary.get(row)
+        if tags is None:
+            e = self.emissions[row]
+            tags = self.tagDictionary[row] = tuple(
+                v for v in xrange(self.start) if e[v] != NEG_INF)
+        return tags
+
+    def history_table(self):
+        """Get the transitions of each observed history.
+
+        @return: The dictionary mapping each history to a tuple containing
+            its log-transition row, the tags v of non null transition
+            probability and the list of the histories following it, the one
+            reached with v being C{history[1:] + (v,)}.
+        @rtype: dict
+        """
+        if self.historyIndex is None:
+            self.historyIndex = dict(
+                (h, (r, tuple(v for v in xrange(self.start)
+                              if r[v] != NEG_INF),
+                     [h[1:] + (v,) for v in xrange(self.start)]))
+                for h, r in self.histories.iteritems())
+        return self.historyIndex
+
+    def is_mapped(self):
+        """Check if the tables of the model are read from a memory map.
+
+        @return: True or False wether the model was loaded by L{load_model}.
+        @rtype: bool
+        """
+        return isinstance(self.emissions, MappedTable)
+
+    def word_counts(self):
+        """Get the number of occurrences of each word of the training set.
+
+        @return: The dictionary mapping words to their number of occurrences.
+        @rtype: dict
+        """
+        return dict(izip(self.words, self.wordCounts))
+
+
+def compile_hmm(counter, limit=UNCOMMON_LIMIT):
+    """Compile a loaded HMM into a frozen, integer-indexed model.
+
+    Only the histories seen in the training file, that is the (n-1)-grams
+    of tags counted by the HMM, are given a transition row, unless every
+    transition from it has a null probability.
+
+    @param counter:
+        An n-gram HMM whose counts have been loaded.
+    @type counter: L{cnt.HMM}
+    @param limit:
+        The number of occurrences under which a word is uncommon, i.e. the
+        one the rare words of the counts were grouped with.
+    @type limit: int
+
+    @return: The compiled model.
+    @rtype: L{Model}
+    """
+    states = sorted(counter.states)
+    common = sorted(
+        w for w in counter.words if counter.wordCounts[w] >= limit)
+    rare = sorted(
+        w for w in counter.words if counter.wordCounts[w] < limit)
+    vocab = {}
+    groups = {}
+    emissions = []
+    for word in common:
+        vocab[word] = len(emissions)
+        emissions.append(tuple(
+            safe_log(counter.emission_prob(word, v)) for v in states))
+    for word in GROUP_TOKENS:
+        groups[word] = len(emissions)
+        if word in counter.words:
+            emissions.append(tuple(
+                safe_log(counter.emission_prob(word, v)) for v in states))
+        else:
+            emissions.append(tuple(NEG_INF for v in states))
+
+    words = common + rare
+    return Model(states, vocab, groups, emissions,
+                 compile_histories(counter, states), words,
+                 [counter.wordCounts[w] for w in words], counter.n)
+
+
+def compile_histories(counter, states):
+    """Compute the log-transition rows of the histories of an HMM.
+
+    @param counter:
+        An n-gram HMM whose counts have been loaded.
+    @type counter: L{cnt.HMM}
+    @param states:
+        The tags, in order of identifier.
+    @type states: list
+
+    @return: The dictionary mapping the histories of non null probability,
+        tuples of n-1 tag identifiers, to their row of S log-transition
+        probabilities.
+    @rtype: dict
+    """
+    ids = dict((tag, i) for i, tag in enumerate(states))
+    ids[SENTENCE_START] = len(states)
+    histories = {}
+    for history in counter.ngramCounts[counter.n - 2]:
+        if not all(tag in ids for tag in history):
+            continue
+        row = tuple(safe_log(counter.mle(history + (v,))) for v in states)
+        if any(p != NEG_INF for p in row):
+            histories[tuple(ids[tag] for tag in history)] = row
+    return histories
+
+
+def is_model_file(path):
+    """Check if a file is a binary model file.
+
+    @param path:
+        The path of the file.
+    @type path: str
+
+    @return: True or False wether the file starts with the model magic.
+    @rtype: bool
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+
+
+def write_model(model, output):
+    """Write a compiled model as a binary model file.
+
+    @param model:
+        The compiled model.
+    @type model: L{Model}
+    @param output:
+        The binary output where the model will be written.
+    @type output: Stream
+    """
+    S = len(model.states)
+    C = len(model.vocab)
+    output.write(HEADER.pack(MODEL_MAGIC, MODEL_VERSION, model.n, S,
+                             len(model.words), C))
+    for strings in (model.states, model.words):
+        blob = '\n'.join(strings)
+        output.write(SIZE.pack(len(blob)))
+        output.write(blob)
+    array('d', model.wordCounts).tofile(output)
+    for i in xrange(C + len(GROUP_TOKENS)):
+        array('d', model.emissions[i]).tofile(output)
+    write_histories(model.histories, output)
+    slots = hash_slots([model.words[i] for i in xrange(C)])
+    spans = array('I', [0])
+    for word in model.words:
+        spans.append(spans[-1] + len(word) + 1)
+    output.write(SIZE.pack(len(slots)))
+    spans.tofile(output)
+    slots.tofile(output)
+
+
+def write_histories(histories, output):
+    """Write the transitions section of a binary model file.
+
+    @param histories:
+        The dictionary mapping the histories to their log-transition row.
+    @type histories: dict
+    @param output:
+        The binary output where the transitions will be written.
+    @type output: Stream
+    """
+    output.write(SIZE.pack(len(histories)))
+    for history in sorted(histories):
+        array('I', history).tofile(output)
+        array('d', histories[history]).tofile(output)
+
+
+def copy_bytes(source, output, size):
+    """Copy the first bytes of a temporary file to an output.
+
+    @param source:
+        The temporary file.
+    @type source: FILE
+    @param output:
+        The binary output.
+    @type output: Stream
+    @param size:
+        The number of bytes to copy.
+    @type size: int
+    """
+    source.seek(0)
+    while size > 0:
+        block = source.read(min(size, COPY_BLOCK_SIZE))
+        if not block:
+            break
+        output.write(block)
+        size -= len(block)
+
+
+def write_sorted_model(counter, emissions, output, limit=UNCOMMON_LIMIT,
+                       directory=None):
+    """Compile sorted emission counts into a binary model file.
+
+    The file is the one written by L{write_model} for the model compiled by
+    L{compile_hmm} from the counts as L{cnt.HMM.load_counts} reads them, but
+    neither the emission counts nor the compiled tables are held in memory.
+    The emission counts are read once, grouped by the first field of their
+    tokens: the words, their counts and the emission rows of the common words
+    are written to temporary files which are then copied to the output, and
+    the hash table of the vocabulary is built in a memory-mapped temporary
+    file. Only the n-grams counts, which only hold tags, are kept in memory.
+    As in L{cnt.HMM.emission_prob}, the sentence start symbol is emitted with
+    a probability of 1 by every tag. The tags are the ones of the unigram
+    counts but for the start history which the bigram models count there.
+
+    @param counter:
+        The HMM holding the n-grams counts, its emission counts being unused.
+    @type counter: L{cnt.HMM}
+    @param emissions:
+        An iterator generating tuples of a token/tag association and its
+        count, sorted by the first field of the token.
+    @type emissions: generator
+    @param output:
+        The binary output file where the model will be written.
+    @type output: FILE
+    @param limit:
+        The number of occurrences under which a word is uncommon.
+    @type limit: int
+    @param directory:
+        The directory of the temporary files, the default temporary directory
+        if not set.
+    @type directory: str
+    """
+    states = sorted(ngram[0] for ngram in counter.ngramCounts[0]
+                    if ngram[0] != SENTENCE_START)
+    tagCounts = [float(counter.ngramCounts[0][(v,)]) for v in states]
+    names = ('common', 'rare', 'commonCounts', 'rareCounts', 'rows',
+             'slots')
+    files = dict((name, tempfile.TemporaryFile(dir=directory))
+                 for name in names)
+    try:
+        groupRows = {}
+        sizes = {'common': 0, 'rare': 0}
+        for word, items in groupby(
+                emissions, lambda ((token, ne_tag), count):
+                token.split(' ')[0]):
+            counts = defaultdict(float)
+            for (token, ne_tag), count in items:
+                counts[ne_tag] += count
+            if word == SENTENCE_START:
+                row = (0.0,) * len(states)
+            else:
+                row = tuple(safe_log(counts.get(v, 0.0) / tagCount)
+                            for v, tagCount in izip(states, tagCounts))
+            total = sum(counts.itervalues())
+            kind = 'common' if total >= limit else 'rare'
+            files[kind].write(word + '\n')
+            array('d', [total]).tofile(files[kind + 'Counts'])
+            sizes[kind] += 1
+            if kind == 'common':
+                array('d', row).tofile(files['rows'])
+            if word in GROUP_TOKENS:
+                groupRows[word] = row
+        C, V = sizes['common'], sizes['common'] + sizes['rare']
+        S = len(states)
+        output.write(HEADER.pack(MODEL_MAGIC, MODEL_VERSION, counter.n, S, V,
+                                 C))
+        blob = '\n'.join(states)
+        output.write(SIZE.pack(len(blob)))
+        output.write(blob)
+        common, rare = files['common'].tell(), files['rare'].tell()
+        output.write(SIZE.pack(max(common + rare - 1, 0)))
+        copy_bytes(files['common'], output, common - (not rare))
+        copy_bytes(files['rare'], output, rare - 1)
+        for name in ('commonCounts', 'rareCounts', 'rows'):
+            copy_bytes(files[name], output, files[name].tell())
+        for word in GROUP_TOKENS:
+            array('d', groupRows.get(word, (NEG_INF,) * S)).tofile(output)
+        write_histories(compile_histories(counter, states), output)
+
+        nslots = slot_count(C)
+        output.write(SIZE.pack(nslots))
+        offset = 0
+        spans = array('I', [offset])
+        for name in ('common', 'rare'):
+            files[name].seek(0)
+            for line in files[name]:
+                offset += len(line)
+                spans.append(offset)
+                if len(spans) >= COPY_BLOCK_SIZE >> 2:
+                    spans.tofile(output)
+                    del spans[:]
+        spans.tofile(output)
+        files['slots'].truncate(nslots * SIZE.size)
+        buf = mmap.mmap(files['slots'].fileno(), nslots * SIZE.size)
+        try:
+            mask = nslots - 1
+            files['common'].seek(0)
+            for row, line in enumerate(files['common']):
+                i = zlib.crc32(line[:-1]) & mask
+                while SIZE.unpack_from(buf, i * SIZE.size)[0]:
+                    i = (i + 1) & mask
+                SIZE.pack_into(buf, i * SIZE.size, row + 1)
+            for start in xrange(0, len(buf), COPY_BLOCK_SIZE):
+                output.write(buf[start:start + COPY_BLOCK_SIZE])
+        finally:
+            buf.close()
+    finally:
+        for f in files.itervalues():
+            f.close()
+
+
+def load_model(path):
+    """Load a binary model file through a read-only memory map.
+
+    @param path:
+        The path of the binary model file.
+    @type path: str
+
+    @return: The compiled model, its tables reading the mapping but for the
+        transitions.
+    @rtype: L{Model}
+
+    @raise ValueError: If the file is not a binary model file of the current
+        version.
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf.size() < HEADER.size:
+        raise ValueError('%s is not a binary model file.' % path)
+    magic, version, n, S, V, C = HEADER.unpack_from(buf, 0)
+    if magic != MODEL_MAGIC:
+        raise ValueError('%s is not a binary model file.' % path)
+    if version != MODEL_VERSION:
+        raise ValueError('Unsupported model file version %i.' % version)
+    offset = HEADER.size
+    size, = SIZE.unpack_from(buf, offset)
+    offset += SIZE.size
+    states = buf[offset:offset + size].split('\n') if S else []
+    offset += size
+    size, = SIZE.unpack_from(buf, offset)
+    offset += SIZE.size
+    wordsOffset = offset
+    offset += size
+    wordCounts = MappedArray(buf, offset, V)
+    offset += 8 * V
+    groups = dict((w, C + i) for i, w in enumerate(GROUP_TOKENS))
+    emissions = MappedTable(buf, offset, C + len(GROUP_TOKENS), S)
+    offset += 8 * S * len(emissions)
+    histories = {}
+    H, = SIZE.unpack_from(buf, offset)
+    offset += SIZE.size
+    entry = struct.Struct('<%iI%id' % (n - 1, S))
+    for i in xrange(H):
+        values = entry.unpack_from(buf, offset + i * entry.size)
+        histories[values[:n - 1]] = values[n - 1:]
+    offset += H * entry.size
+    nslots, = SIZE.unpack_from(buf, offset)
+    offset += SIZE.size
+    words = MappedStrings(buf, wordsOffset, offset, V)
+    offset += SIZE.size * (V + 1)
+    vocab = MappedVocabulary(words, buf, offset, nslots, C)
+    return Model(states, vocab, groups, emissions, histories, words,
+                 wordCounts, n)
+
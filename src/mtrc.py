@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Runtime metrics of the tagger.
+
+A L{Metrics} object collects, while L{tag} decodes:
+    - the time spent loading the model;
+    - the decoding latency of each sentence, as histograms bucketed by
+      sentence length;
+    - the number of tokens which are unknown to the model, that is missing
+      from the vocabulary of its common words, and the number of them
+      replaced by each group token;
+    - the number of trellis cells evaluated, a cell being a history of n-1
+      tags, e.g. a pair of tags (u, v), whose score is computed at a
+      position;
+    - the hits and misses of the shared L{shp.wordClassifier}, the ones of
+      the worker processes being sent with their metrics.
+The metrics can be written as a short text, as JSON or in the text format of
+Prometheus.
+
+The metrics are only collected when a L{Metrics} object is given to the
+decoders: otherwise the decoders only test once per token that there is none.
+"""
+
+from __future__ import print_function
+import os
+import json
+import tempfile
+from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
+from shp import wordClassifier, word_group
+
+LENGTH_BUCKETS = (5, 10, 20, 40, 80, float('inf'))
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   float('inf'))
+GROUPS = (UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION)
+METRICS_FORMATS = ('text', 'json', 'prometheus')
+PROMETHEUS_PREFIX = 'ner_'
+
+
+def bucket_index(buckets, value):
+    """Get the index of the first bucket holding a value.
+
+    @param buckets:
+        The increasing upper bounds of the buckets, the last being infinite.
+    @type buckets: tuple
+    @param value:
+        The value.
+    @type value: float
+
+    @return: The index of the first upper bound greater or equal to value.
+    @rtype: int
+    """
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            return i
+    return len(buckets) - 1
+
+
+def bucket_label(bound):
+    """Get the label of a bucket upper bound.
+
+    @param bound:
+        The upper bound.
+    @type bound: float
+
+    @return: The bound as Prometheus writes it.
+    @rtype: str
+    """
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound) if isinstance(bound, float) else str(bound)
+
+
+def format_for(path):
+    """Guess the format of a metrics file from its extension.
+
+    @param path:
+        The path of the metrics file.
+    @type path: str
+
+    @return: 'json' for .json files, 'prometheus' for .prom files and 'text'
+        otherwise.
+    @rtype: str
+    """
+    if path.endswith('.json'):
+        return 'json'
+    if path.endswith('.prom'):
+        return 'prometheus'
+    return 'text'
+
+
+class Metrics(object):
+    """Counters and histograms of the tagging of sentences."""
+
+    def __init__(self):
+        """Metrics creator."""
+        self.loadTime = 0.0
+        self.sentences = 0
+        self.tokens = 0
+        self.unknown = 0
+        self.substitutions = dict((group, 0) for group in GROUPS)
+        self.cells = 0
+        self.latency = [[0] * len(LATENCY_BUCKETS) for b in LENGTH_BUCKETS]
+        self.latencySum = [0.0] * len(LENGTH_BUCKETS)
+        self.classifierHits = 0
+        self.classifierMisses = 0
+
+    def observe(self, model, sentence, elapsed):
+        """Record the decoding of a sentence.
+
+        @param model:
+            The compiled model.
+        @type model: L{mdl.Model}
+        @param sentence:
+            A list of tokens (strings) representing a sentence.
+        @type sentence: list
+        @param elapsed:
+            The decoding time in seconds.
+        @type elapsed: float
+        """
+        self.sentences += 1
+        self.tokens += len(sentence)
+        length = bucket_index(LENGTH_BUCKETS, len(sentence))
+        self.latency[length][bucket_index(LATENCY_BUCKETS, elapsed)] += 1
+        self.latencySum[length] += elapsed
+        vocab = model.vocab
+        for word in sentence:
+            if word not in vocab:
+                self.unknown += 1
+                self.substitutions[word_group(word)] += 1
+
+    def merge(self, other):
+        """Add the counts of other metrics, e.g. the ones of a worker.
+
+        @param other:
+            The metrics to add.
+        @type other: L{Metrics}
+        """
+        self.sentences += other.sentences
+        self.tokens += other.tokens
+        self.unknown += other.unknown
+        for group, count in other.substitutions.iteritems():
+            self.substitutions[group] += count
+        self.cells += other.cells
+        self.classifierHits += other.classifierHits
+        self.classifierMisses += other.classifierMisses
+        for counts, otherCounts in zip(self.latency, other.latency):
+            for i, count in enumerate(otherCounts):
+                counts[i] += count
+        for i, value in enumerate(other.latencySum):
+            self.latencySum[i] += value
+
+    def collect_classifier(self):
+        """Move the counts of the shared word classifier to the metrics.
+
+        This is done by the worker processes before sending their metrics.
+        """
+        self.classifierHits += wordClassifier.hits
+        self.classifierMisses += wordClassifier.misses
+        wordClassifier.hits = wordClassifier.misses = 0
+
+    def classifier_counts(self):
+        """Get the hits and misses of the shared word classifier.
+
+        @return: A tuple containing the number of hits and of misses.
+        @rtype: tuple
+        """
+        return (self.classifierHits + wordClassifier.hits,
+                self.classifierMisses + wordClassifier.misses)
+
+    def rate(self, count):
+        """Compute a rate per token.
+
+        @param count:
+            A number of tokens.
+        @type count: int
+
+        @return: The count divided by the number of tokens, 0 if no token was
+            tagged.
+        @rtype: float
+        """
+        return count / float(self.tokens) if self.tokens else 0.0
+
+    def to_dict(self):
+        """Convert the metrics to a JSON serializable dictionary.
+
+        @return: The metrics, the latency buckets being cumulative.
+        @rtype: dict
+        """
+        histograms = []
+        for bound, counts, total in zip(LENGTH_BUCKETS, self.latency,
+                                        self.latencySum):
+            cumulative = 0
+            buckets = []
+            for le, count in zip(LATENCY_BUCKETS, counts):
+                cumulative += count
+                buckets.append([bucket_label(le), cumulative])
+            histograms.append(dict(max_length=bucket_label(bound),
+                                   buckets=buckets, sum=total,
+                                   count=cumulative))
+        return dict(
+            model_load_seconds=self.loadTime, sentences=self.sentences,
+            tokens=self.tokens, unknown_words=self.unknown,
+            unknown_rate=self.rate(self.unknown),
+            substituted_words=self.substitutions,
+            trellis_cells=self.cells, decode_latency=histograms,
+            word_classifier=dict(zip(('hits', 'misses'),
+                                     self.classifier_counts())))
+
+    def to_text(self):
+        """Format the metrics as a short human readable text.
+
+        @return: The text.
+        @rtype: str
+        """
+        lines = [
+            'model load time: %.3fs' % self.loadTime,
+            'sentences: %i, tokens: %i, trellis cells: %i' % (
+                self.sentences, self.tokens, self.cells),
+            'unknown words: %i (%.2f%%)' % (
+                self.unknown, 100 * self.rate(self.unknown)),
+            'substituted words: %s' % ', '.join(
+                '%s %i (%.2f%%)' % (group, self.substitutions[group],
+                                    100 * self.rate(self.substitutions[group]))
+                for group in GROUPS),
+            'word classifier: %i hits, %i misses' %
+            self.classifier_counts(),
+            'decode latency by sentence length:']
+        low = 1
+        for bound, counts, total in zip(LENGTH_BUCKETS, self.latency,
+                                        self.latencySum):
+            count = sum(counts)
+            if count:
+                lines.append('  %3i-%-4s %6i sentences, mean %.3fms' % (
+                    low, bucket_label(bound) if bound != float('inf')
+                    else '', count, 1000 * total / count))
+            low = int(bound) + 1 if bound != float('inf') else low
+        return '\n'.join(lines) + '\n'
+
+    def to_prometheus(self):
+        """Format the metrics in the text format of Prometheus.
+
+        @return: The text.
+        @rtype: str
+        """
+        p = PROMETHEUS_PREFIX
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s%s %s' % (p, name, help))
+            lines.append('# TYPE %s%s %s' % (p, name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % label for label in labels)
+                lines.append('%s%s%s%s %r' % (
+                    p, name, suffix, labels and '{%s}' % labels, value))
+
+        metric('model_load_seconds', 'gauge', 'Time spent loading the model.',
+               [('', [], self.loadTime)])
+        metric('sentences_total', 'counter', 'Tagged sentences.',
+               [('', [], self.sentences)])
+        metric('tokens_total', 'counter', 'Tagged tokens.',
+               [('', [], self.tokens)])
+        metric('unknown_words_total', 'counter',
+               'Tokens missing from the vocabulary of the model.',
+               [('', [], self.unknown)])
+        metric('substituted_words_total', 'counter',
+               'Tokens replaced by a group token.',
+               [('', [('group', group)], self.substitutions[group])
+                for group in GROUPS])
+        metric('trellis_cells_total', 'counter',
+               'Trellis cells evaluated by the decoder.',
+               [('', [], self.cells)])
+        hits, misses = self.classifier_counts()
+        metric('word_classifier_lookups_total', 'counter',
+               'Lookups of the word shape cache.',
+               [('', [('result', 'hit')], hits),
+                ('', [('result', 'miss')], misses)])
+        samples = []
+        for bound, counts, total in zip(LENGTH_BUCKETS, self.latency,
+                                        self.latencySum):
+            length = ('length', bucket_label(bound))
+            cumulative = 0
+            for le, count in zip(LATENCY_BUCKETS, counts):
+                cumulative += count
+                samples.append(('_bucket', [length, ('le', bucket_label(le))],
+                                cumulative))
+            samples.append(('_sum', [length], total))
+            samples.append(('_count', [length], cumulative))
+        metric('decode_seconds', 'histogram',
+               'Decoding latency of a sentence by maximum sentence length.',
+               samples)
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fmt, output):
+        """Write the metrics.
+
+        @param fmt:
+            One of 'text', 'json' or 'prometheus'.
+        @type fmt: str
+        @param output:
+            The output where the metrics will be written.
+        @type output: Stream
+        """
+        if fmt == 'json':
+            json.dump(self.to_dict(), output, indent=2, sort_keys=True)
+            output.write('\n')
+        elif fmt == 'prometheus':
+            output.write(self.to_prometheus())
+        else:
+            output.write(self.to_text())
+        output.flush()
+
+    def dump_file(self, fmt, path):
+        """Replace a metrics file by the current metrics.
+
+        The metrics are written to a temporary file renamed over the metrics
+        file so that a reader never sees a partial file.
+
+        @param fmt:
+            One of 'text', 'json' or 'prometheus'.
+        @type fmt: str
+        @param path:
+            The path of the metrics file.
+        @type path: str
+        """
+        fd, tmpPath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'w') as output:
+            self.dump(fmt, output)
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, path)
@@ -0,0 +1,554 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Compact, integer-encoded counts of an HMM.
+
+A L{cnt.HMM} keeps its counts in dictionaries keyed by tuples of strings:
+every count of a token/tag association or of an n-gram costs a tuple, a
+dictionary entry and an integer object. On large training files the memory
+of the HMM, not its speed, is the limit. A L{PackedHMM} holds the same
+counts with a few Python objects per word instead of several per count:
+    - the words and the tags are numbered in a L{Vocabulary}, in order of
+      first occurrence;
+    - the emission counts of each tag are stored in an C{array} indexed by
+      word identifier, as are the words counts;
+    - an n-gram of tags is packed into a single integer, C{TAG_BITS} bits per
+      tag, and its count is stored in an C{array} (L{PackedCounts}).
+The counts are read and written through views which behave like the
+dictionaries of L{cnt.HMM} (L{EmissionCounts}, L{NgramCounts},
+L{WordCounts}), so that a L{PackedHMM} can be trained, written, read,
+grouped (L{fltr}) and compiled (L{mdl.compile_hmm}) like an HMM.
+
+The buffers are C{array} objects rather than NumPy arrays since NumPy is an
+optional dependency of the program.
+
+@note: The emission counts are iterated by word identifier, i.e. in order of
+first occurrence of the words, and the n-grams in the order in which their
+packed keys were added to their L{PackedCounts}, so a counts file written
+from a L{PackedHMM} holds the same lines as the one of an HMM, in another
+order. Reading the counts does not depend on that order: the lines of the
+tokens sharing their first field and tag are added
+(L{cnt.HMM.load_emission}).
+"""
+
+from array import array
+from itertools import repeat
+from collections import MutableMapping, Set, defaultdict
+from cnt import HMM
+from const import SENTENCE_START, SENTENCE_END
+
+TAG_BITS = 8
+TAG_MASK = (1 << TAG_BITS) - 1
+MAX_TAGS = 1 << TAG_BITS
+
+
+def pack(ids):
+    """Pack tag identifiers into a single integer.
+
+    @param ids:
+        The identifiers of the tags of an n-gram.
+    @type ids: list
+
+    @return: The packed n-gram, the last tag in the lowest bits.
+    @rtype: int
+    """
+    key = 0
+    for i in ids:
+        key = key << TAG_BITS | i
+    return key
+
+
+def unpack(key, n):
+    """Unpack the tag identifiers of an n-gram.
+
+    @param key:
+        The packed n-gram.
+    @type key: int
+    @param n:
+        The cardinality of the n-gram.
+    @type n: int
+
+    @return: The identifiers of the tags of the n-gram.
+    @rtype: list
+    """
+    ids = [0] * n
+    for i in xrange(n - 1, -1, -1):
+        ids[i] = key & TAG_MASK
+        key >>= TAG_BITS
+    return ids
+
+
+class Vocabulary(object):
+    """Strings numbered in order of first occurrence."""
+
+    def __init__(self, limit=None):
+        """Vocabulary creator.
+
+        @param limit:
+            If set, the maximum number of strings.
+        @type limit: int
+        """
+        self.ids = {}
+        self.strings = []
+        self.limit = limit
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __iter__(self):
+        return iter(self.strings)
+
+    def __contains__(self, string):
+        return string in self.ids
+
+    def get(self, string):
+        """Get the identifier of a string.
+
+        @param string:
+            The string.
+        @type string: str
+
+        @return: The identifier of the string, None if it is unknown.
+        @rtype: int
+        """
+        return self.ids.get(string)
+
+    def add(self, string):
+        """Get the identifier of a string, numbering it if it is new.
+
+        @param string:
+            The string.
+        @type string: str
+
+        @return: The identifier of the string.
+        @rtype: int
+
+        @raise ValueError: If the vocabulary is full.
+        """
+        i = self.ids.get(string)
+        if i is None:
+            if self.limit is not None and len(self.strings) >= self.limit:
+                raise ValueError('Too many distinct values (at most %i).'
+                                 % self.limit)
+            i = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+
+class PackedCounts(object):
+    """Counts of packed n-grams stored in an array."""
+
+    def __init__(self):
+        """PackedCounts creator."""
+        self.slots = {}
+        self.keys = []
+        self.counts = array('l')
+
+    def add(self, key, count):
+        """Add to the count of a packed n-gram.
+
+        @param key:
+            The packed n-gram.
+        @type key: int
+        @param count:
+            The count to add.
+        @type count: int
+        """
+        slot = self.slots.get(key)
+        if slot is None:
+            self.slots[key] = len(self.counts)
+            self.keys.append(key)
+            self.counts.append(count)
+        else:
+            self.counts[slot] += count
+
+    def get(self, key):
+        """Get the count of a packed n-gram.
+
+        @param key:
+            The packed n-gram.
+        @type key: int
+
+        @return: The count, 0 if the n-gram was not counted.
+        @rtype: int
+        """
+        slot = self.slots.get(key)
+        return 0 if slot is None else self.counts[slot]
+
+    def set(self, key, count):
+        """Set the count of a packed n-gram.
+
+        @param key:
+            The packed n-gram.
+        @type key: int
+        @param count:
+            The count.
+        @type count: int
+        """
+        slot = self.slots.get(key)
+        if slot is None:
+            self.add(key, count)
+        else:
+            self.counts[slot] = count
+
+
+class NgramCounts(MutableMapping):
+    """View of L{PackedCounts} as a dictionary keyed by tuples of tags.
+
+    Like a C{defaultdict(int)}, the count of an unknown n-gram is 0. Only the
+    n-grams of non null count are iterated.
+    """
+
+    def __init__(self, tags, order):
+        """NgramCounts creator.
+
+        @param tags:
+            The vocabulary of the tags.
+        @type tags: L{Vocabulary}
+        @param order:
+            The cardinality of the n-grams.
+        @type order: int
+        """
+        self.tags = tags
+        self.order = order
+        self.table = PackedCounts()
+
+    def key(self, ngram):
+        """Get the packed key of a known n-gram.
+
+        @param ngram:
+            A tuple of tags.
+        @type ngram: tuple
+
+        @return: The packed n-gram, None if one of its tags is unknown.
+        @rtype: int
+        """
+        key = 0
+        for tag in ngram:
+            i = self.tags.ids.get(tag)
+            if i is None:
+                return None
+            key = key << TAG_BITS | i
+        return key
+
+    def __getitem__(self, ngram):
+        key = self.key(ngram)
+        return 0 if key is None else self.table.get(key)
+
+    def get(self, ngram, default=None):
+        count = self[ngram]
+        return count if count else default
+
+    def __contains__(self, ngram):
+        return bool(self[ngram])
+
+    def __setitem__(self, ngram, count):
+        self.table.set(pack(self.tags.add(tag) for tag in ngram), int(count))
+
+    def __delitem__(self, ngram):
+        key = self.key(ngram)
+        if key is not None:
+            self.table.set(key, 0)
+
+    def __iter__(self):
+        strings = self.tags.strings
+        counts = self.table.counts
+        for slot, key in enumerate(self.table.keys):
+            if counts[slot]:
+                yield tuple(strings[i] for i in unpack(key, self.order))
+
+    def __len__(self):
+        return sum(1 for count in self.table.counts if count)
+
+
+class EmissionCounts(MutableMapping):
+    """View of the emission arrays of a L{PackedHMM} keyed by (token, tag)."""
+
+    def __init__(self, hmm):
+        """EmissionCounts creator.
+
+        @param hmm:
+            The HMM holding the arrays.
+        @type hmm: L{PackedHMM}
+        """
+        self.hmm = hmm
+
+    def __getitem__(self, key):
+        hmm = self.hmm
+        w = hmm.vocabulary.ids.get(key[0])
+        t = hmm.tags.ids.get(key[1])
+        if w is None or t is None or t >= len(hmm.emissions):
+            return 0
+        counts = hmm.emissions[t]
+        return counts[w] if w < len(counts) else 0
+
+    def get(self, key, default=None):
+        count = self[key]
+        return count if count else default
+
+    def __contains__(self, key):
+        return bool(self[key])
+
+    def __setitem__(self, key, count):
+        hmm = self.hmm
+        counts = hmm.emission_array(hmm.tags.add(key[1]))
+        w = hmm.vocabulary.add(key[0])
+        grow(counts, w)
+        counts[w] = int(count)
+
+    def __delitem__(self, key):
+        if key in self:
+            self[key] = 0
+
+    def __iter__(self):
+        hmm = self.hmm
+        tagged = [(hmm.tags.strings[t], counts)
+                  for t, counts in enumerate(hmm.emissions) if counts]
+        for w, word in enumerate(hmm.vocabulary.strings):
+            for tag, counts in tagged:
+                if w < len(counts) and counts[w]:
+                    yield word, tag
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+
+class WordCounts(MutableMapping):
+    """View of the words counts array of a L{PackedHMM} keyed by word."""
+
+    def __init__(self, hmm):
+        """WordCounts creator.
+
+        @param hmm:
+            The HMM holding the array.
+        @type hmm: L{PackedHMM}
+        """
+        self.hmm = hmm
+
+    def __getitem__(self, word):
+        w = self.hmm.vocabulary.ids.get(word)
+        counts = self.hmm.wordCountArray
+        return counts[w] if w is not None and w < len(counts) else 0
+
+    def get(self, word, default=None):
+        count = self[word]
+        return count if count else default
+
+    def __contains__(self, word):
+        return bool(self[word])
+
+    def __setitem__(self, word, count):
+        w = self.hmm.vocabulary.add(word)
+        grow(self.hmm.wordCountArray, w)
+        self.hmm.wordCountArray[w] = int(count)
+
+    def __delitem__(self, word):
+        if word in self:
+            self[word] = 0
+
+    def __iter__(self):
+        strings = self.hmm.vocabulary.strings
+        for w, count in enumerate(self.hmm.wordCountArray):
+            if count:
+                yield strings[w]
+
+    def __len__(self):
+        return sum(1 for count in self.hmm.wordCountArray if count)
+
+
+class Words(Set):
+    """View of the tokens of a L{PackedHMM} which have an emission count."""
+
+    def __init__(self, hmm):
+        """Words creator.
+
+        @param hmm:
+            The HMM holding the arrays.
+        @type hmm: L{PackedHMM}
+        """
+        self.hmm = hmm
+
+    def __contains__(self, word):
+        w = self.hmm.vocabulary.ids.get(word)
+        return w is not None and any(
+            w < len(counts) and counts[w] for counts in self.hmm.emissions
+            if counts)
+
+    def __iter__(self):
+        seen = bytearray(len(self.hmm.vocabulary))
+        for counts in self.hmm.emissions:
+            if counts:
+                for w, count in enumerate(counts):
+                    if count:
+                        seen[w] = 1
+        strings = self.hmm.vocabulary.strings
+        for w, flag in enumerate(seen):
+            if flag:
+                yield strings[w]
+
+    def __len__(self):
+        return sum(1 for word in self)
+
+
+def grow(counts, index):
+    """Extend an array of counts with zeros up to an index.
+
+    @param counts:
+        The array of counts.
+    @type counts: array
+    @param index:
+        The index which must be in the array.
+    @type index: int
+    """
+    missing = index + 1 - len(counts)
+    if missing > 0:
+        counts.extend(repeat(0, missing))
+
+
+class PackedHMM(HMM):
+    """HMM storing its counts in arrays of integers.
+
+    The emission counts array of a tag only extends up to the last token
+    counted with that tag, the missing counts being null.
+    """
+
+    def clear(self):
+        """Remove every count of the HMM."""
+        self.vocabulary = Vocabulary()
+        self.tags = Vocabulary(MAX_TAGS)
+        self.emissions = []
+        self.wordCountArray = array('i')
+        self.emission_counts = EmissionCounts(self)
+        self.wordCounts = WordCounts(self)
+        self.words = Words(self)
+        self.ngramCounts = [self.counts_table(i + 1) for i in xrange(self.n)]
+        self.states = set()
+
+    def counts_table(self, order):
+        """Create an empty table of n-grams counts.
+
+        @param order:
+            The cardinality of the n-grams of the table.
+        @type order: int
+
+        @return: The view of the packed n-grams counts.
+        @rtype: L{NgramCounts}
+        """
+        return NgramCounts(self.tags, order)
+
+    def emission_array(self, t):
+        """Get the emission counts array of a tag, creating it if needed.
+
+        @param t:
+            The identifier of the tag.
+        @type t: int
+
+        @return: The emission counts of the tag indexed by token identifier.
+        @rtype: array
+        """
+        while len(self.emissions) <= t:
+            self.emissions.append(None)
+        if self.emissions[t] is None:
+            self.emissions[t] = array('i')
+        return self.emissions[t]
+
+    def train_sentences(self, sntncIterator):
+        """Count n-grams frequencies and probabilities from sentences.
+
+        The counts are the ones of L{cnt.HMM.train_sentences}, the tags being
+        packed as they are read. The n-grams, which are few, are counted in
+        dictionaries of packed keys before being added to the arrays.
+
+        @param sntncIterator:
+            An iterator generating lists of tuples of tokens and token tags.
+        @type sntncIterator: generator
+        """
+        n = self.n
+        keyCounts = [defaultdict(int) for i in xrange(n)]
+        start = self.tags.add(SENTENCE_START)
+        stop = self.tags.add(SENTENCE_END)
+        startKey = pack([start] * (n - 1))
+        shifts = [(i, TAG_BITS * i) for i in xrange(1, n)]
+        tagIds, wordIds = self.tags.ids, self.vocabulary.ids
+        for sentence in sntncIterator:
+            ids = [start] * (n - 1)
+            for word, ne_tag in sentence:
+                t = tagIds.get(ne_tag)
+                if t is None:
+                    t = self.tags.add(ne_tag)
+                counts = self.emission_array(t)
+                w = wordIds.get(word)
+                if w is None:
+                    w = self.vocabulary.add(word)
+                if w < len(counts):
+                    counts[w] += 1
+                else:
+                    grow(counts, w)
+                    counts[w] = 1
+                ids.append(t)
+            ids.append(stop)
+            last = len(ids) - 1
+            for j in xrange(n - 1, len(ids)):
+                key = ids[j]
+                if j < last:
+                    keyCounts[0][key] += 1
+                for i, shift in shifts:
+                    key |= ids[j - i] << shift
+                    keyCounts[i][key] += 1
+            keyCounts[n - 2][startKey] += 1
+        for counts, keys in zip(self.ngramCounts, keyCounts):
+            for key, count in keys.iteritems():
+                counts.table.add(key, count)
+
+    def load_emission(self, word, ne_tag, count, raw=False):
+        """Store the count of a token/tag association read from counts.
+
+        @param word:
+            The token.
+        @type word: str
+        @param ne_tag:
+            The named entity tag.
+        @type ne_tag: str
+        @param count:
+            The number of occurrences of the token/tag association.
+        @type count: float
+        @param raw:
+            If set, the whole token is kept.
+        @type raw: bool
+
+        @see: L{cnt.HMM.load_emission}
+        """
+        first = word.split(" ")[0]
+        if not raw:
+            word = first
+        count = int(count)
+        counts = self.emission_array(self.tags.add(ne_tag))
+        w = self.vocabulary.add(word)
+        grow(counts, w)
+        counts[w] += count
+        if first != word:
+            w = self.vocabulary.add(first)
+        grow(self.wordCountArray, w)
+        self.wordCountArray[w] += count
+        self.states.add(ne_tag)
+
+    def emission_prob(self, tkn, tag):
+        """Compute emission probability.
+
+        @param tkn:
+            A token.
+        @type tkn: str
+        @param tag:
+            A named entity tag.
+        @type tag: str
+
+        @return: The computed emission probability for the given token and tag.
+        @rtype: float
+
+        @see: L{cnt.HMM.emission_prob}
+        """
+        if tkn == SENTENCE_START:
+            return float(1)
+        t = self.tags.ids[tag]
+        return float(self.emission_counts[(tkn, tag)]) / \
+            self.ngramCounts[0].table.get(t)
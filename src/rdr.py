@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Bulk reader of the tokens files.
+
+The training, test and tagged files share the same format: one token per
+line, the fields of a line being separated by spaces, and an empty line at
+the end of each sentence. The last field of a line is its tag, or the last
+but one when the line ends with a log probability (the output of L{tag}).
+
+Instead of reading and stripping one line at a time, a L{SentenceReader}
+reads the file by blocks of C{BLOCK_SIZE} bytes, splits each block into its
+stripped lines at once and groups them into sentences with
+C{itertools.groupby}. A sentence is the list of its stripped lines, from
+which the columns are taken in bulk by L{token_columns}. The consumers which
+only need identifiers take them straight from the columns with L{encode}, and
+the tags column can be read alone with L{tag_column}, without splitting the
+tokens.
+
+Like the readers it replaces, a L{SentenceReader} stops at the first empty
+sentence, i.e. at two consecutive empty lines or at an empty first line.
+"""
+
+from __future__ import print_function
+import sys
+from array import array
+from itertools import chain, groupby
+
+BLOCK_SIZE = 1 << 20
+
+
+def line_blocks(tknsFile, blockSize=BLOCK_SIZE):
+    """Read the stripped lines of a file by blocks.
+
+    @param tknsFile:
+        The file containing the tokens.
+    @type tknsFile: FILE
+    @param blockSize:
+        The number of bytes read at once.
+    @type blockSize: int
+
+    @return: An iterator generating lists of stripped lines, the lines of a
+        block.
+    @rtype: generator
+    """
+    rest = ''
+    while True:
+        block = tknsFile.read(blockSize)
+        if not block:
+            break
+        end = block.rfind('\n') + 1
+        if not end:
+            rest += block
+            continue
+        lines = (rest + block[:end]).split('\n')
+        lines.pop()
+        rest = block[end:]
+        yield map(str.strip, lines)
+    if rest:
+        yield [rest.strip()]
+
+
+def token_columns(lines, addProb=False):
+    """Split the lines of a sentence into columns.
+
+    @param lines:
+        The stripped lines of a sentence.
+    @type lines: list
+    @param addProb:
+        If set, the lines end with a log probability after the tag.
+    @type addProb: bool
+
+    @return: A tuple containing the list of the tokens and the list of their
+        tags, and the list of the log probabilities if addProb is set.
+    @rtype: tuple
+
+    @raise ValueError: If a line has no tag before its log probability.
+    """
+    if addProb:
+        heads = []
+        probs = []
+        for line in lines:
+            head, sep, prob = line.rpartition(' ')
+            if not sep:
+                raise ValueError('Could not read line: %s' % line)
+            heads.append(head)
+            probs.append(prob)
+        words, tags = token_columns(heads)
+        return words, tags, probs
+    parts = [line.rpartition(' ') for line in lines]
+    return [p[0] for p in parts], [p[2] for p in parts]
+
+
+def tag_column(lines):
+    """Get the tags of the lines of a sentence without splitting the tokens.
+
+    @param lines:
+        The stripped lines of a sentence.
+    @type lines: list
+
+    @return: The list of the tags.
+    @rtype: list
+    """
+    return [line[line.rfind(' ') + 1:] for line in lines]
+
+
+def encode(column, ids, strings):
+    """Map a column of strings to their identifiers.
+
+    The new strings are numbered after the known ones.
+
+    @param column:
+        The strings, e.g. the tags of a sentence.
+    @type column: list
+    @param ids:
+        The dictionary mapping the known strings to their identifier.
+    @type ids: dict
+    @param strings:
+        The known strings, in order of identifier.
+    @type strings: list
+
+    @return: The identifiers of the strings.
+    @rtype: array
+    """
+    codes = map(ids.get, column)
+    if None in codes:
+        for i, code in enumerate(codes):
+            if code is None:
+                code = ids.get(column[i])
+                if code is None:
+                    code = ids[column[i]] = len(strings)
+                    strings.append(column[i])
+                codes[i] = code
+    return array('i', codes)
+
+
+class SentenceReader(object):
+    """Sentences of a tokens file read by blocks."""
+
+    def __init__(self, tknsFile, blockSize=BLOCK_SIZE):
+        """SentenceReader creator.
+
+        @param tknsFile:
+            The file containing the tokens.
+        @type tknsFile: FILE
+        @param blockSize:
+            The number of bytes read at once.
+        @type blockSize: int
+        """
+        self.tknsFile = tknsFile
+        self.blockSize = blockSize
+        self.stopped = False
+
+    def __iter__(self):
+        """Create an iterator object for each sentence of the file.
+
+        The reading stops at the first empty sentence, C{stopped} being then
+        set.
+
+        @return: An iterator generating lists of the stripped lines of a
+            sentence.
+        @rtype: generator
+        """
+        current = []
+        for lines in line_blocks(self.tknsFile, self.blockSize):
+            for filled, group in groupby(lines, bool):
+                if filled:
+                    current.extend(group)
+                    continue
+                if not current:
+                    self.stopped = True
+                    return
+                yield current
+                current = []
+                if sum(1 for line in group) > 1:
+                    self.stopped = True
+                    return
+        if current:
+            yield current
+
+    def tagged(self):
+        """Create an iterator object for each sentence of a tagged file.
+
+        @return: An iterator generating lists of tuples of tokens and token
+            tags, e.g. C{[('EU', 'I-ORG'), ('rejects', 'O')]}.
+        @rtype: generator
+        """
+        for lines in self:
+            yield [(word, tag) for word, sep, tag in
+                   [line.rpartition(' ') for line in lines]]
+
+    def columns(self, addProb=False):
+        """Create an iterator object for the columns of each sentence.
+
+        @param addProb:
+            If set, the lines end with a log probability after the tag.
+        @type addProb: bool
+
+        @return: An iterator generating the columns given by
+            L{token_columns}.
+        @rtype: generator
+        """
+        for lines in self:
+            yield token_columns(lines, addProb)
+
+    def tag_ids(self, ids, strings):
+        """Create an iterator object for the tag identifiers of each sentence.
+
+        @param ids:
+            The dictionary mapping the known tags to their identifier.
+        @type ids: dict
+        @param strings:
+            The known tags, in order of identifier.
+        @type strings: list
+
+        @return: An iterator generating arrays of tag identifiers.
+        @rtype: generator
+        """
+        for lines in self:
+            yield encode(tag_column(lines), ids, strings)
+
+
+def tagged_sentences(tknsFile):
+    """Create an iterator object for each sentence of a tagged file.
+
+    @param tknsFile:
+        The file containing the tokens.
+    @type tknsFile: FILE
+
+    @return: An iterator generating lists of tuples of tokens and token tags.
+    @rtype: generator
+    """
+    return SentenceReader(tknsFile).tagged()
+
+
+def word_sentences(tknsFile):
+    """Create an iterator object for each sentence of a file to tag.
+
+    The tokens are the whole lines. A warning is printed if the reading
+    stops before the end of the file.
+
+    @param tknsFile:
+        The file containing the tokens.
+    @type tknsFile: FILE
+
+    @return: An iterator generating lists of tokens.
+    @rtype: generator
+    """
+    reader = SentenceReader(tknsFile)
+    for sentence in reader:
+        yield sentence
+    if reader.stopped:
+        print('WARNING: Got empty input file/stream.', file=sys.stderr)
+
+
+def block_tokens(lines, addProb=False):
+    """Split the lines of a block into tokens and tags.
+
+    @param lines:
+        The stripped lines of a block.
+    @type lines: list
+    @param addProb:
+        If set, the lines end with a log probability after the tag.
+    @type addProb: bool
+
+    @return: A list of tuples of tokens and token tags, the empty lines
+        giving C{(None, None)}.
+    @rtype: list
+
+    @raise ValueError: If a line has no tag before its log probability.
+    """
+    if addProb:
+        heads = []
+        for line in lines:
+            head, sep, prob = line.rpartition(' ')
+            if line and not sep:
+                raise ValueError('Could not read line: %s' % line)
+            heads.append(head)
+        lines = heads
+    return [(word, tag) if tag else (None, None)
+            for word, sep, tag in [line.rpartition(' ') for line in lines]]
+
+
+def tagged_tokens(tknsFile, addProb=False):
+    """Create an iterator object for each token of a tagged file.
+
+    Unlike the sentences, the tokens are read until the end of the file.
+
+    @param tknsFile:
+        The file containing the tokens.
+    @type tknsFile: FILE
+    @param addProb:
+        If set, the lines end with a log probability after the tag.
+    @type addProb: bool
+
+    @return: An iterator generating tuples of tokens and token tags, the
+        empty lines giving C{(None, None)}.
+    @rtype: iterator
+
+    @raise ValueError: If a line has no tag before its log probability.
+    """
+    return chain.from_iterable(block_tokens(lines, addProb)
+                               for lines in line_blocks(tknsFile))
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Registry of the models of several languages in a single process.
+
+A L{ModelRegistry} loads the models when they are first asked for, by name
+or by path: the names, e.g. C{eng}, C{esp} and C{dut}, are mapped to the
+paths of their counts file or binary model file, any other string being
+taken as a path. The loaded models are kept from the least to the most
+recently used; when a model is loaded beyond the number of models or the
+memory allowed, the least recently used ones are evicted, never the one just
+loaded.
+
+The memory of a model is estimated by L{model_size} when it is loaded. The
+registry counts its loads, hits and evictions, given by L{ModelRegistry.stats}.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from mdl import MappedVocabulary
+from tag import load_model_file
+
+DEFAULT_MAX_MODELS = 4
+
+
+def model_size(model):
+    """Estimate the memory taken by a compiled model.
+
+    The estimate sums the sizes of the vocabulary, of the words and of the
+    log-probability tables. The tables of a binary model file are counted as
+    the size of its memory map. The tables built lazily while decoding, e.g.
+    the tag dictionary, are not counted.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
+
+    @return: The estimated size in bytes.
+    @rtype: int
+    """
+    floatSize = sys.getsizeof(0.0)
+    if model.is_mapped():
+        size = len(model.emissions.buf)
+    else:
+        size = sys.getsizeof(model.emissions)
+        size += sum(sys.getsizeof(row) + floatSize * len(row)
+                    for row in model.emissions)
+    if not isinstance(model.vocab, MappedVocabulary):
+        size += sys.getsizeof(model.vocab) + sys.getsizeof(model.words)
+        size += sum(sys.getsizeof(word) for word in model.words)
+        size += sys.getsizeof(model.wordCounts)
+        if isinstance(model.wordCounts, list):
+            size += floatSize * len(model.wordCounts)
+    size += sys.getsizeof(model.histories)
+    size += sum(sys.getsizeof(h) + sys.getsizeof(row) + floatSize * len(row)
+                for h, row in model.histories.iteritems())
+    if model.transitions is not None:
+        size += sys.getsizeof(model.transitions)
+        size += sum(sys.getsizeof(row) for row in model.transitions)
+    return size
+
+
+class ModelRegistry(object):
+    """Models loaded lazily by name or path and evicted in LRU order."""
+
+    def __init__(self, paths=None, maxModels=DEFAULT_MAX_MODELS,
+                 maxMemory=None, packed=False):
+        """ModelRegistry creator.
+
+        @param paths:
+            The dictionary mapping the names of the models to the paths of
+            their counts file or binary model file.
+        @type paths: dict
+        @param maxModels:
+            The maximum number of models kept in memory.
+        @type maxModels: int
+        @param maxMemory:
+            If set, the size in bytes beyond which the least recently used
+            models are evicted.
+        @type maxMemory: int
+        @param packed:
+            If set, the counts files are read into a L{pck.PackedHMM}.
+        @type packed: bool
+        """
+        self.paths = dict(paths or {})
+        self.maxModels = maxModels
+        self.maxMemory = maxMemory
+        self.packed = packed
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.loadTime = 0.0
+
+    def resolve(self, name):
+        """Get the path of a model.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+
+        @return: The path of the counts file or binary model file.
+        @rtype: str
+        """
+        path = self.paths.get(name, name)
+        if path == '-':
+            return path
+        return os.path.realpath(path)
+
+    def get(self, name):
+        """Get a model, loading it if it is not in memory.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+
+        @return: The compiled model.
+        @rtype: L{mdl.Model}
+
+        @raise IOError: If the file cannot be read.
+        @raise ValueError: If the binary model file is not valid.
+        """
+        path = self.resolve(name)
+        with self.lock:
+            entry = self.models.pop(path, None)
+            if entry is not None:
+                self.models[path] = entry
+                self.hits += 1
+                return entry[0]
+            return self.load(path)
+
+    def reload(self, name):
+        """Load a model again from its file, even if it is in memory.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+
+        @return: The compiled model.
+        @rtype: L{mdl.Model}
+
+        @raise IOError: If the file cannot be read.
+        @raise ValueError: If the binary model file is not valid.
+        """
+        path = self.resolve(name)
+        with self.lock:
+            return self.load(path)
+
+    def load(self, path):
+        """Load a model and evict the least recently used ones if needed.
+
+        The lock must be held.
+
+        @param path:
+            The path of the counts file or binary model file.
+        @type path: str
+
+        @return: The compiled model.
+        @rtype: L{mdl.Model}
+
+        @raise IOError: If the file cannot be read.
+        @raise ValueError: If the binary model file is not valid.
+        """
+        start = time.time()
+        model = load_model_file(path, self.packed)
+        self.loadTime += time.time() - start
+        self.loads += 1
+        self.models.pop(path, None)
+        self.models[path] = (model, model_size(model))
+        self.evict(keep=path)
+        return model
+
+    def discard(self, name):
+        """Remove a model from memory, without counting an eviction.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+        """
+        with self.lock:
+            self.models.pop(self.resolve(name), None)
+
+    def memory(self):
+        """Get the estimated memory taken by the loaded models.
+
+        @return: The size in bytes.
+        @rtype: int
+        """
+        return sum(size for model, size in self.models.itervalues())
+
+    def evict(self, keep=None):
+        """Evict the least recently used models beyond the limits.
+
+        The lock must be held.
+
+        @param keep:
+            The path of a model which is never evicted, e.g. the one just
+            loaded, even if it is alone larger than the memory allowed.
+        @type keep: str
+        """
+        total = self.memory()
+        for path in list(self.models):
+            if len(self.models) <= self.maxModels and \
+                    (self.maxMemory is None or total <= self.maxMemory):
+                break
+            if path == keep:
+                continue
+            model, size = self.models.pop(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Get the counters of the registry.
+
+        @return: A dictionary holding the numbers of loads, hits and
+            evictions, the time spent loading in seconds, the estimated
+            memory in bytes and the paths of the loaded models, least
+            recently used first.
+        @rtype: dict
+        """
+        with self.lock:
+            return {'loads': self.loads, 'hits': self.hits,
+                    'evictions': self.evictions, 'load_time': self.loadTime,
+                    'memory': self.memory(), 'models': list(self.models)}
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Word shapes used to group the rare and unknown words.
+
+The rare words of the training file (L{fltr}) and the rare or unknown words
+of the test file (L{tag}) are replaced by group tokens depending on their
+shape: capitalized, starting with a capital or made of punctuation and
+digits. This module holds these shape tests and a L{WordClassifier} which
+caches the group token of the words it already classified: real text
+repeats the same unknown tokens (numbers, tickers, names) a lot.
+"""
+
+from __future__ import print_function
+import string
+from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
+
+NUM_PUNCT_CHARS = string.punctuation + string.digits
+DEFAULT_CACHE_SIZE = 1 << 16
+
+
+def tkn_cap_first(tkn):
+    """Check if a token starts with a capitalized letter.
+
+    @param tkn:
+        The token to check.
+    @type tkn: str
+
+    @return: True or False wether the token do starts with a capitalized letter.
+    @rtype: bool
+    """
+    return tkn.istitle()
+
+
+def tkn_all_caps(tkn):
+    """Check if a token contains only capitalized letters.
+
+    @param tkn:
+        The token to check.
+    @type tkn: str
+
+    @return: True or False wether the token contains only capitalized letters.
+    @rtype: bool
+    """
+    return tkn.isupper()
+
+
+def tkn_num_punct(tkn):
+    """Check if a token contains only punctuation or digits.
+
+    The characters are removed by a precompiled translation instead of being
+    checked one by one.
+
+    @param tkn:
+        The token to check.
+    @type tkn: str
+
+    @return: True or False wether the token contains only punctuation/digits.
+    @rtype: bool
+    """
+    return not tkn.translate(None, NUM_PUNCT_CHARS)
+
+
+def word_group(word):
+    """Get the group token replacing a rare or unknown word of a test file.
+
+    @param word:
+        The rare or unknown word.
+    @type word: str
+
+    @return: The group token of the word category.
+    @rtype: str
+    """
+    if tkn_all_caps(word):
+        return CAPITALIZED
+    elif tkn_cap_first(word):
+        return PROPER_NOUN
+    elif tkn_num_punct(word):
+        return PUNCTUATION
+    return UNCOMMON
+
+
+class WordClassifier(object):
+    """Bounded cache of the group tokens of the words.
+
+    The least recently used words are evicted by generations: the words are
+    added to a recent generation and when it is full it replaces the older
+    one, whose words are dropped unless they were used in the meantime. At
+    most twice the cache size words are kept.
+    """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        """WordClassifier creator.
+
+        @param size:
+            The number of words of a generation.
+        @type size: int
+        """
+        self.size = size
+        self.recent = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+
+    def group(self, word):
+        """Get the group token replacing a rare or unknown word.
+
+        @param word:
+            The rare or unknown word.
+        @type word: str
+
+        @return: The group token of the word category.
+        @rtype: str
+        """
+        grp = self.recent.get(word)
+        if grp is not None:
+            self.hits += 1
+            return grp
+        grp = self.older.pop(word, None)
+        if grp is None:
+            self.misses += 1
+            grp = word_group(word)
+        else:
+            self.hits += 1
+        if len(self.recent) >= self.size:
+            self.older = self.recent
+            self.recent = {}
+        self.recent[word] = grp
+        return grp
+
+
+wordClassifier = WordClassifier()
@@ -0,0 +1,418 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Long-running tagging server.
+
+The server loads its models once and tags the sentences sent by its
+clients over a local TCP or Unix socket. The protocol is made of JSON
+objects, one per line. A request holds a list of sentences, each sentence
+being a list of tokens, and an optional identifier echoed in the response::
+    {"id": 1, "sentences": [["EU", "rejects", "German", "call"]]}
+    {"id": 1, "tags": [[["I-ORG", -2.3], ["O", -4.1], ["I-MISC", -7.9],
+                        ["O", -9.2]]]}
+Each tag comes with the log probability of the tagged sequence up to its
+token. The sentences are tagged with the default model unless the request
+names another one, e.g. C{{"model": "esp", "sentences": ...}}: the models
+are held by a L{reg.ModelRegistry}, which loads them by name or path when
+first asked for and evicts the least recently used ones.
+A request C{{"reload": "path"}} makes the model of the given file the
+default one and C{{"reload": null}} reloads the default file, as the SIGHUP
+signal does, the other models being read again when next asked for. A
+request C{{"stats": null}} gets the counters of the registry. Invalid
+requests get a response C{{"error": "message"}}.
+
+Since any client of the socket can name a model file, the paths of the
+requests are only accepted in the directories of the models given on the
+command line and in the ones added with C{--model-dir}: any other file
+readable by the server could otherwise be loaded, which takes its memory and
+tells whether the file exists. The names given by C{--model} are always
+accepted.
+
+Every connection is served by a thread but the sentences are decoded by a
+single decoding thread: the requests received within a latency budget are
+grouped into a micro-batch which is decoded at once, with the NumPy engine
+of L{btch} if a batch size is given.
+
+@note: The standard library of Python 2.7 has no asyncio, hence the
+threads.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import Queue
+import signal
+import argparse
+import threading
+import collections
+import SocketServer
+from tag import tag_sentences
+from btch import np
+from reg import ModelRegistry, DEFAULT_MAX_MODELS
+from const import DEFAULT_BATCH_SIZE
+
+DEFAULT_MAX_DELAY = 5
+DEFAULT_MAX_SENTENCES = 1024
+DEFAULT_ENCODING = 'latin-1'
+
+
+class Request(object):
+    """Sentences waiting to be tagged by the decoding thread."""
+
+    def __init__(self, sentences, model=None):
+        """Request creator.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+        @param model:
+            The name or the path of the model, the default one if not given.
+        @type model: str
+        """
+        self.sentences = sentences
+        self.model = model
+        self.tags = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(threading.Thread):
+    """Decoding thread grouping the concurrent requests in micro-batches."""
+
+    def __init__(self, registry, path, batchSize=None,
+                 maxDelay=DEFAULT_MAX_DELAY,
+                 maxSentences=DEFAULT_MAX_SENTENCES):
+        """MicroBatcher creator.
+
+        @param registry:
+            The registry holding the models.
+        @type registry: L{reg.ModelRegistry}
+        @param path:
+            The name or the path of the default model, loaded at once.
+        @type path: str
+        @param batchSize:
+            If set, the micro-batches are decoded by batches of this size
+            with NumPy.
+        @type batchSize: int
+        @param maxDelay:
+            The latency budget: the maximum number of milliseconds a request
+            waits for other requests before being decoded.
+        @type maxDelay: float
+        @param maxSentences:
+            The maximum number of sentences of a micro-batch.
+        @type maxSentences: int
+
+        @raise IOError: If the file cannot be read.
+        @raise ValueError: If the binary model file is not valid.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.registry = registry
+        self.path = path
+        registry.get(path)
+        self.batchSize = batchSize
+        self.maxDelay = maxDelay / 1000.0
+        self.maxSentences = maxSentences
+        self.queue = Queue.Queue()
+        self.reloadLock = threading.Lock()
+
+    def submit(self, sentences, model=None):
+        """Tag sentences and wait for the result.
+
+        @param sentences:
+            A list of sentences, each sentence being a list of tokens.
+        @type sentences: list
+        @param model:
+            The name or the path of the model, the default one if not given.
+        @type model: str
+
+        @return: The list of predicted tags and log probabilities of each
+            sentence.
+        @rtype: list
+
+        @raise RuntimeError: If the decoding failed.
+        """
+        request = Request(sentences, model)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.tags
+
+    def reload(self, path=None):
+        """Load a new default model and use it for the next micro-batches.
+
+        The micro-batch being decoded, if any, ends with the previous model.
+        When the default file is loaded again, the other models are removed
+        from the registry so that their files are read again when next asked
+        for.
+
+        @param path:
+            The name or the path of the new default model. The current file
+            is loaded again if it is not given.
+        @type path: str
+
+        @raise IOError: If the file cannot be read.
+        @raise ValueError: If the binary model file is not valid.
+        """
+        with self.reloadLock:
+            if path is None:
+                current = self.registry.resolve(self.path)
+                for loaded in self.registry.stats()['models']:
+                    if loaded != current:
+                        self.registry.discard(loaded)
+            self.registry.reload(path or self.path)
+            self.path = path or self.path
+
+    def next_batch(self):
+        """Wait for requests and group them in a micro-batch.
+
+        @return: The list of requests of the micro-batch.
+        @rtype: list
+        """
+        batch = [self.queue.get()]
+        count = len(batch[0].sentences)
+        deadline = time.time() + self.maxDelay
+        while count < self.maxSentences:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            batch.append(request)
+            count += len(request.sentences)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            path = self.path
+            groups = collections.OrderedDict()
+            for request in batch:
+                groups.setdefault(request.model or path, []).append(request)
+            for name, requests in groups.iteritems():
+                self.decode(name, requests)
+
+    def decode(self, name, requests):
+        """Tag the sentences of the requests for a model.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+        @param requests:
+            The requests of the micro-batch for this model.
+        @type requests: list
+        """
+        sentences = [s for request in requests for s in request.sentences]
+        try:
+            model = self.registry.get(name)
+            tagged = [tags for sentence, tags in tag_sentences(
+                model, iter(sentences), self.batchSize)]
+        except Exception as e:
+            for request in requests:
+                request.error = str(e)
+                request.done.set()
+            return
+        start = 0
+        for request in requests:
+            end = start + len(request.sentences)
+            request.tags = tagged[start:end]
+            start = end
+            request.done.set()
+
+
+class TaggingHandler(SocketServer.StreamRequestHandler):
+    """Serve the JSON requests of a connection, one per line."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.respond(json.loads(line))
+            except (ValueError, TypeError, KeyError, AttributeError, IOError,
+                    RuntimeError) as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class TaggingServerMixIn:
+    """Answer the requests with a shared L{MicroBatcher}."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    modelDirs = ()
+
+    def check_model(self, name):
+        """Check that a request may ask for a model.
+
+        @param name:
+            The name or the path of the model.
+        @type name: str
+
+        @raise ValueError: If the name is not given by C{--model} and the
+            file is not in one of the directories of C{modelDirs}.
+        """
+        registry = self.batcher.registry
+        if name in registry.paths:
+            return
+        path = registry.resolve(name)
+        if not any(path.startswith(os.path.join(directory, ''))
+                   for directory in self.modelDirs):
+            raise ValueError('the model %s is not in an allowed directory'
+                             % name)
+
+    def respond(self, request):
+        """Answer a request.
+
+        @param request:
+            The decoded JSON request.
+        @type request: dict
+
+        @return: The JSON response, holding an error message if the request is
+            not valid.
+        @rtype: dict
+
+        @raise ValueError: If the request asks for a model which is not
+            allowed.
+        """
+        if not isinstance(request, dict):
+            return {'error': 'the request must be a JSON object'}
+        if 'reload' in request:
+            path = request['reload'] and \
+                request['reload'].encode(self.encoding)
+            if path:
+                self.check_model(path)
+            self.batcher.reload(path)
+            return {'reloaded': self.batcher.path}
+        if 'stats' in request:
+            return {'stats': self.batcher.registry.stats()}
+        sentences = request.get('sentences')
+        if not isinstance(sentences, list) or not all(
+                isinstance(sentence, list) and
+                all(isinstance(tkn, basestring) for tkn in sentence)
+                for sentence in sentences):
+            return {'error': 'sentences must be a list of lists of strings'}
+        sentences = [[tkn.encode(self.encoding) for tkn in sentence]
+                     for sentence in sentences]
+        model = request.get('model')
+        model = model and model.encode(self.encoding)
+        if model:
+            self.check_model(model)
+        tagged = self.batcher.submit(sentences, model)
+        return {'id': request.get('id'),
+                'tags': [[list(t) for t in tags] for tags in tagged]}
+
+
+class TCPTaggingServer(TaggingServerMixIn, SocketServer.ThreadingMixIn,
+                       SocketServer.TCPServer):
+    """Tagging server listening on a TCP socket."""
+
+
+class UnixTaggingServer(TaggingServerMixIn, SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    """Tagging server listening on a Unix socket."""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Load the model once and tag the sentences sent as JSON '
+        'lines on a local socket.')
+    parser.add_argument(
+        'counts_file', help='counts file or binary model file of the default '
+        'model, or the NAME of one given by --model')
+    parser.add_argument(
+        '-m', '--model', action='append', default=[], metavar='NAME=PATH',
+        help='name the model of a counts file or binary model file, so that '
+        'the requests can ask for it by NAME; may be repeated')
+    parser.add_argument(
+        '-M', '--model-dir', action='append', default=[], metavar='DIR',
+        help='also accept the requests naming a model file in DIR, besides '
+        'the directories of the models given on the command line; may be '
+        'repeated')
+    parser.add_argument(
+        '--max-models', type=int, default=DEFAULT_MAX_MODELS, metavar='N',
+        help='maximum number of models kept in memory (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '--max-memory', type=int, metavar='MB',
+        help='evict the least recently used models beyond MB megabytes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8642)
+    parser.add_argument(
+        '-u', '--unix', metavar='PATH',
+        help='listen on the Unix socket PATH instead of TCP')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, metavar='N',
+        help='decode batches of N sentences with NumPy (e.g. %i)'
+        % DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        '-d', '--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+        metavar='MS', help='latency budget of a micro-batch in milliseconds '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-s', '--max-sentences', type=int, default=DEFAULT_MAX_SENTENCES,
+        metavar='N', help='maximum number of sentences of a micro-batch '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-e', '--encoding', default=DEFAULT_ENCODING,
+        help='encoding of the training files (default: %(default)s)')
+    args = parser.parse_args()
+    if args.max_models < 1:
+        parser.error('--max-models must be at least 1')
+    if args.batch_size and np is None:
+        parser.error('--batch-size requires NumPy')
+    paths = {}
+    for option in args.model:
+        name, sep, path = option.partition('=')
+        if not sep or not name or not path:
+            parser.error('invalid --model %s, expected NAME=PATH' % option)
+        paths[name] = path
+    registry = ModelRegistry(
+        paths, args.max_models,
+        args.max_memory and args.max_memory << 20)
+    try:
+        batcher = MicroBatcher(registry, args.counts_file, args.batch_size,
+                               args.max_delay, args.max_sentences)
+    except (IOError, ValueError) as e:
+        print('ERROR: Cannot read input file %s (%s).' % (
+            args.counts_file, e), file=sys.stderr)
+        sys.exit(1)
+    batcher.start()
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = UnixTaggingServer(args.unix, TaggingHandler)
+    else:
+        server = TCPTaggingServer((args.host, args.port), TaggingHandler)
+    server.batcher = batcher
+    server.encoding = args.encoding
+    models = paths.values()
+    if args.counts_file not in paths:
+        models.append(args.counts_file)
+    server.modelDirs = [os.path.dirname(os.path.realpath(path))
+                        for path in models] + \
+        [os.path.realpath(directory) for directory in args.model_dir]
+
+    def reload_model(signum, frame):
+        """Reload the model file in the background on SIGHUP."""
+        def reload():
+            try:
+                batcher.reload()
+            except (IOError, ValueError) as e:
+                print('ERROR: Cannot reload %s (%s).' % (batcher.path, e),
+                      file=sys.stderr)
+        threading.Thread(target=reload).start()
+
+    signal.signal(signal.SIGHUP, reload_model)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Compressed files and standard streams.
+
+Every stage of the program reads and writes its files through L{open_stream}
+so that they can be stored compressed and chained in a pipe:
+    - the files whose name ends with .gz, .bz2 or .xz are decompressed while
+      read and compressed while written;
+    - the name '-' stands for the standard input or the standard output.
+For instance the counts of a compressed training file can be grouped and
+counted again without writing any intermediate file::
+    python src/trn.py data/eng/eng.train.xz -o - | gzip > counts.gz
+
+@note: The .xz files require the lzma module, which is part of the standard
+library from Python 3.3 only. With Python 2.7 it is provided by the
+backports.lzma package.
+"""
+
+from __future__ import print_function
+import io
+import os
+import sys
+import bz2
+import gzip
+import tempfile
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+STDIO = '-'
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz')
+IO_BUFFER_SIZE = 1 << 20
+
+
+def is_plain_file(path):
+    """Check if a path names an uncompressed file, which can be seeked.
+
+    @param path:
+        The path of the file.
+    @type path: str
+
+    @return: True or False wether the file is neither a standard stream nor
+        a compressed file.
+    @rtype: bool
+    """
+    return path != STDIO and not path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_stream(path, mode='r', bufsize=IO_BUFFER_SIZE):
+    """Open a file, a compressed file or a standard stream.
+
+    @param path:
+        The path of the file, '-' for the standard input or output.
+    @type path: str
+    @param mode:
+        'r' to read the file, 'w' to write it.
+    @type mode: str
+    @param bufsize:
+        The size of the buffer of the file.
+    @type bufsize: int
+
+    @return: The file object.
+    @rtype: FILE
+
+    @raise IOError: If the file cannot be opened or if it is an .xz file and
+        the lzma module is missing.
+    """
+    if path == STDIO:
+        return sys.stdin if mode.startswith('r') else sys.stdout
+    if path.endswith('.gz'):
+        stream = gzip.GzipFile(path, mode + 'b')
+    elif path.endswith('.bz2'):
+        stream = bz2.BZ2File(path, mode, bufsize)
+    elif path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('the lzma module (backports.lzma) is required '
+                          'to read or write %s' % path)
+        stream = lzma.LZMAFile(path, mode + 'b')
+    else:
+        return file(path, mode, bufsize)
+    if mode.startswith('r') and not path.endswith('.bz2'):
+        stream = io.BufferedReader(stream, bufsize)
+    return stream
+
+
+def close_stream(stream):
+    """Close a file opened by L{open_stream}, unless it is a standard stream.
+
+    Compressed files must be closed for their end to be written.
+
+    @param stream:
+        The file object.
+    @type stream: FILE
+    """
+    if stream is sys.stdout:
+        stream.flush()
+    elif stream is not sys.stdin:
+        stream.close()
+
+
+def temporary_path(path):
+    """Get the path of a new temporary file to be renamed over a file.
+
+    The temporary file is created in the same directory and with the same
+    extension as the file, so that it is compressed the same way.
+
+    @param path:
+        The path of the file to replace.
+    @type path: str
+
+    @return: The path of the temporary file.
+    @rtype: str
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmpPath = tempfile.mkstemp(
+        suffix=os.path.splitext(name)[1], prefix=name + '.', dir=directory)
+    os.close(fd)
+    return tmpPath
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Sweep of the rare words limit.
+
+The words occurring less than C{UNCOMMON_LIMIT} times in the training file
+are replaced by group tokens (L{fltr}). To find the best limit of a dataset,
+its training file is counted once without grouping the rare words
+(L{trn.raw_train}) and, for each limit, the grouped counts are derived from
+these raw counts by L{trn.group_counts}: only the emission counts are
+remapped, the n-grams of tags do not depend on the words. The model of each
+limit is then compiled, every test file of the dataset is tagged and compared
+to its original tags, the limits being run in a pool of worker processes.
+
+The results are printed as a single table with one row per test file and
+limit, followed by the best limit of each dataset. They can also be written
+as JSON.
+"""
+
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from btch import np
+from cmp import Comparator
+from const import DEFAULT_NGRAM_CARDINALITY, UNCOMMON_LIMIT
+from evl import find_datasets, total_comparator
+from mdl import compile_hmm
+from rdr import tagged_tokens, word_sentences
+from strm import open_stream, close_stream
+from tag import tag_sentences
+from trn import raw_train, group_counts
+
+DEFAULT_LIMITS = [1, 2, 3, 5, 8, 13]
+
+# Raw counts and test files of the datasets and decoding options of the
+# worker processes, inherited through fork.
+sweepArgs = None
+
+
+def read_dataset(trainPath, tests, n):
+    """Count a training file and read its test files.
+
+    @param trainPath:
+        The path of the training file.
+    @type trainPath: str
+    @param tests:
+        The test files of the dataset given by L{evl.find_datasets}.
+    @type tests: list
+    @param n:
+        The n-gram cardinality.
+    @type n: int
+
+    @return: A tuple containing the raw counts of the training file and a
+        list of tuples containing the name of a test file, its sentences and
+        the tokens of its original.
+    @rtype: tuple
+    """
+    tknsFile = open_stream(trainPath)
+    rawCounter = raw_train(tknsFile, n)
+    close_stream(tknsFile)
+    res = []
+    for testName, testPath, origPath in tests:
+        testFile = open_stream(testPath)
+        sentences = list(word_sentences(testFile))
+        close_stream(testFile)
+        origFile = open_stream(origPath)
+        original = list(tagged_tokens(origFile))
+        close_stream(origFile)
+        res.append((testName, sentences, original))
+    return rawCounter, res
+
+
+def sweep_limit(args):
+    """Group, compile and evaluate the model of a limit in a worker process.
+
+    @param args:
+        A tuple containing the index of the dataset and the limit.
+    @type args: tuple
+
+    @return: A tuple containing the grouping and compilation time in seconds
+        and a list of tuples containing the name of a test file, the
+        comparator holding its counts of named entities and its tagging time
+        in seconds.
+    @rtype: tuple
+
+    @raise ValueError: If the tokens of the test files do not correspond.
+    """
+    index, limit = args
+    datasets, options = sweepArgs
+    rawCounter, tests = datasets[index]
+    start = time.time()
+    model = compile_hmm(group_counts(rawCounter, limit).reloaded(), limit)
+    groupTime = time.time() - start
+    res = []
+    for testName, sentences, original in tests:
+        start = time.time()
+        predicted = []
+        for sentence, tags in tag_sentences(model, iter(sentences),
+                                            **options):
+            predicted.extend(zip(sentence, [tag for tag, logProb in tags]))
+            predicted.append((None, None))
+        evaluator = Comparator()
+        try:
+            evaluator.compare(iter(original), iter(predicted))
+        except ValueError as e:
+            raise ValueError('The test file %s: %s' % (testName, e))
+        res.append((testName, evaluator, time.time() - start))
+    return groupTime, res
+
+
+def run_sweep(datasets, limits, workers, n=DEFAULT_NGRAM_CARDINALITY,
+              **options):
+    """Evaluate every dataset with every rare words limit.
+
+    @param datasets:
+        The datasets given by L{evl.find_datasets}.
+    @type datasets: list
+    @param limits:
+        The numbers of occurrences under which a word is uncommon.
+    @type limits: list
+    @param workers:
+        The number of worker processes.
+    @type workers: int
+    @param n:
+        The n-gram cardinality of the models.
+    @type n: int
+    @param options:
+        The decoding options of L{tag.tag_sentences}.
+    @type options: dict
+
+    @return: A list of tuples containing the name of a dataset, the name of a
+        test file, the limit, its comparator, the grouping time of the limit
+        and the tagging time of the test file, in order of dataset, test file
+        and limit.
+    @rtype: list
+    """
+    global sweepArgs
+    sweepArgs = ([read_dataset(trainPath, tests, n)
+                  for name, trainPath, tests in datasets], options)
+    jobs = [(i, limit) for i in xrange(len(datasets)) for limit in limits]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(sweep_limit, jobs)
+    finally:
+        pool.terminate()
+        sweepArgs = None
+    rows = [((i, t, limit), (datasets[i][0], testName, limit, evaluator,
+                             groupTime, tagTime))
+            for (i, limit), (groupTime, tests) in zip(jobs, results)
+            for t, (testName, evaluator, tagTime) in enumerate(tests)]
+    return [row for key, row in sorted(rows)]
+
+
+def best_limits(results):
+    """Find the limit of each dataset with the best F value.
+
+    The F value of a limit is the one of the named entities of every test
+    file of the dataset.
+
+    @param results:
+        The results given by L{run_sweep}.
+    @type results: list
+
+    @return: A list of tuples containing the name of a dataset, its best
+        limit and the comparator summing its test files, in order of dataset.
+    @rtype: list
+    """
+    totals = OrderedDict()
+    for name, testName, limit, evaluator, groupTime, tagTime in results:
+        totals.setdefault((name, limit), []).append(
+            (name, testName, evaluator, groupTime, tagTime))
+    best = OrderedDict()
+    for (name, limit), rows in sorted(totals.iteritems()):
+        total = total_comparator(rows)
+        if name not in best or \
+                total.get_fscore() > best[name][1].get_fscore():
+            best[name] = (limit, total)
+    return [(name, limit, total)
+            for name, (limit, total) in best.iteritems()]
+
+
+def print_sweep(results, output=sys.stdout):
+    """Write the precision, recall and F value of every test file and limit.
+
+    @param results:
+        The results given by L{run_sweep}.
+    @type results: list
+    @param output:
+        The output where the table will be written.
+    @type output: Stream
+    """
+    output.write('test\t\t| limit\t| precision\t| recall\t| F\t| entities\n')
+    output.write('----------------+-------+---------------+---------------+'
+                 '-------+---------\n')
+    for name, testName, limit, evaluator, groupTime, tagTime in results:
+        output.write('%s\t| %i\t| %.2f%%\t| %.2f%%\t| %.2f\t| %i\n' % (
+            ('%s %s' % (name, testName)).ljust(14), limit,
+            evaluator.get_precision() * 100, evaluator.get_recall() * 100,
+            evaluator.get_fscore() * 100, evaluator.tp + evaluator.fn))
+    output.write('\n')
+    for name, limit, total in best_limits(results):
+        output.write('best limit of %s: %i (F %.2f, default %i)\n' % (
+            name, limit, total.get_fscore() * 100, UNCOMMON_LIMIT))
+
+
+def results_json(results):
+    """Convert the results of the sweep to JSON serializable objects.
+
+    @param results:
+        The results given by L{run_sweep}.
+    @type results: list
+
+    @return: A list holding one dictionary per test file and limit.
+    @rtype: list
+    """
+    return [dict(dataset=name, test=testName, limit=limit,
+                 precision=evaluator.get_precision(),
+                 recall=evaluator.get_recall(),
+                 fscore=evaluator.get_fscore(), tp=evaluator.tp,
+                 fp=evaluator.fp, fn=evaluator.fn, group_time=groupTime,
+                 tag_time=tagTime)
+            for name, testName, limit, evaluator, groupTime, tagTime
+            in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Count the training file of every dataset once, then '
+        'group its rare words with every limit and score every of its test '
+        'files in parallel.')
+    parser.add_argument(
+        'data_dir', nargs='?', default='data',
+        help='directory holding one folder per dataset (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '-d', '--dataset', action='append', metavar='NAME',
+        help='sweep this dataset only, may be repeated')
+    parser.add_argument(
+        '-l', '--limits', type=int, nargs='+', default=DEFAULT_LIMITS,
+        metavar='N', help='numbers of occurrences under which a word is '
+        'uncommon (default: %s)' % ' '.join(map(str, DEFAULT_LIMITS)))
+    parser.add_argument(
+        '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        metavar='N', help='number of worker processes (default: '
+        '%(default)s)')
+    parser.add_argument(
+        '-n', '--order', type=int, default=DEFAULT_NGRAM_CARDINALITY,
+        metavar='N', help='n-gram cardinality of the tags models '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-b', '--batch-size', type=int, metavar='N',
+        help='decode batches of N sentences with NumPy, trigram models only')
+    parser.add_argument(
+        '-j', '--json', metavar='PATH',
+        help="also write the results as JSON to PATH, '-' for stdout")
+    args = parser.parse_args()
+    if args.order < 2:
+        parser.error('the n-gram cardinality must be at least 2')
+    if args.batch_size and args.order != 3:
+        parser.error('--batch-size requires trigram models')
+    if args.batch_size and np is None:
+        parser.error('--batch-size requires NumPy')
+    if min(args.limits) < 1:
+        parser.error('the limits must be positive')
+    try:
+        datasets = [d for d in find_datasets(args.data_dir)
+                    if not args.dataset or d[0] in args.dataset]
+    except OSError:
+        print('ERROR: Cannot read data directory %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    if not datasets:
+        print('ERROR: No dataset found in %s.' % args.data_dir,
+              file=sys.stderr)
+        sys.exit(1)
+    try:
+        results = run_sweep(datasets, sorted(set(args.limits)),
+                            max(args.workers, 1), args.order,
+                            batchSize=args.batch_size)
+    except (IOError, ValueError) as e:
+        print('ERROR: %s' % e, file=sys.stderr)
+        sys.exit(1)
+    if args.json == '-':
+        json.dump(results_json(results), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_sweep(results)
+        if args.json:
+            try:
+                with open(args.json, 'w') as output:
+                    json.dump(results_json(results), output, indent=2)
+            except IOError:
+                print('ERROR: Cannot write JSON file %s.' % args.json,
+                      file=sys.stderr)
+                sys.exit(1)
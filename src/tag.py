@@ -2,88 +2,35 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
+import os
 import sys
-import operator
-import math
+import time
+import heapq
+import argparse
+import functools
 import itertools
-import string
-from collections import defaultdict
+import collections
+import tempfile
+import multiprocessing
 from cnt import HMM
-from const import UNCOMMON, PROPER_NOUN, CAPITALIZED, PUNCTUATION
-from const import TOKEN_TAG, SENTENCE_START, SENTENCE_END, UNCOMMON_LIMIT
+from pck import PackedHMM
+from mdl import NEG_INF, compile_hmm, is_model_file, load_model, write_model
+from btch import BatchViterbi, ForwardBackward, np
+from const import DEFAULT_BATCH_SIZE
+from strm import STDIO, is_plain_file, open_stream, close_stream
+from mtrc import Metrics, METRICS_FORMATS, format_for
+from rdr import word_sentences
 
+BATCH_WINDOW = 16
+CHUNK_SIZE = 128
+CHUNKS_PER_WORKER = 2
+SHARED_DIR = '/dev/shm'
 
-def usage():
-    """Print a usage message."""
-    print(
-        "python viterbi_grouped.py [counts_file] [testFile] > [output_file]"
-        "    Read in counts_file generated from training set and"
-        "    test set of data, then predict tags for each word in"
-        "    test set."
-        "    Modification on original viterbi.py to use grouped words from _Q6_"
-        "    Results are stored in the following format:"
-        "    <word> <tag> <log probability of tagged sequence up to this word>"
-    )
+# Model and batch size of the worker processes, inherited through fork.
+workerArgs = None
 
 
-def token_generator(tknsFile):
-    """Create an iterator object for each token of the tokens file.
-
-    The elements of the iterator are tokens of the file as strings. It looks
-    like:
-    C{sidelines}
-
-    @note: Iterator elements representing empty lines are None.
-
-    @warning: The input file must contain one token per line.
-
-    @param tknsFile:
-        The file containing the tokens.
-    @type tknsFile: FILE
-
-    @return: An iterator generating tokens as strings.
-    @rtype: generator
-    """
-    l = tknsFile.readline()
-    while l:
-        line = l.strip()
-        if line:
-            yield line
-        else:
-            yield None
-        l = tknsFile.readline()
-
-
-def sentence_generator(toknIterator):
-    """Create an iterator object for each sentence of the generated tokens.
-
-    The elements of the iterator are lists of strings. It looks like:
-    C{['They', 'said', 'there', 'was', 'still', 'demand', 'for', 'blue',
-    'chips', '.']}
-
-    @param toknIterator:
-        A generator iterating on each token of a file.
-    @type toknIterator: generator
-
-    @return: An iterator generating lists of tokens.
-    @rtype: generator
-    """
-    currSntnc = []
-    for l in toknIterator:
-        if l is None:
-            if currSntnc:
-                yield currSntnc
-                currSntnc = []
-            else:
-                print('WARNING: Got empty input file/stream.', file=sys.stderr)
-                raise StopIteration
-        else:
-            currSntnc.append(l)
-    if currSntnc:
-        yield currSntnc
-
-
-def viterbi(sentence):
+def viterbi(model, sentence, metrics=None):
     """Viterbi alorithm for finding the mst likely tag for every tokens.
 
     The Viterbi algorithm is a dynamic programming algorithm for finding the
@@ -112,81 +59,635 @@ def viterbi(sentence):
     k=k+1
     Repeat until k=n
 
+    The tables of the model are in log space: the products of probabilities
+    become sums and the emission term, which does not depend on the history,
+    is added once per tag.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
     @param sentence:
         A list of tokens (strings) representing a sentence.
     @type sentence: list
+    @param metrics:
+        If given, the number of trellis cells evaluated is added to these
+        metrics.
+    @type metrics: L{mtrc.Metrics}
+
+    @return: A list of tuples containing the predicted tag of each token and
+        the log probability of the tagged sequence up to this token.
+    @rtype: list
+
+    @raise ValueError: If the model is not a trigram model.
 
     @see: https://en.wikipedia.org/wiki/Viterbi_algorithm
     @see: http://courses.washington.edu/ling570/gina_fall11/slides/ling570_class12_viterbi.pdf
     """
-    n = len(sentence)
-    padSntnc = (2) * [SENTENCE_START]
-    padSntnc.extend(sentence)
-    padSntnc.append(SENTENCE_END)
-    K = [SENTENCE_START] + (n) * [counter.states] + [SENTENCE_START]
-    pi = [defaultdict(float) for i in xrange(n + 1)]
-    pi[0][(SENTENCE_START, SENTENCE_START)] = 1.0
-    for k in xrange(1, n + 1):
-        word = padSntnc[k + 1]
-        original_word = padSntnc[k + 1]
-        if word not in counter.words or \
-                counter.wordCounts[word] < UNCOMMON_LIMIT:
-            if word.isupper():
-                word = CAPITALIZED
-            elif word.istitle():
-                word = PROPER_NOUN
-            elif all(c in string.punctuation or c.isdigit() for c in word):
-                word = PUNCTUATION
-            else:
-                word = UNCOMMON
-        for u in K[k - 1]:
-            for v in K[k]:
-                candidates = defaultdict(float)
-                for w in K[k - 2]:
-                    candidates[w] = \
-                        pi[k - 1][(w, u)] * \
-                        counter.mle([w, u, v]) * \
-                        counter.emission_prob(word, v)
-                final = max(
-                    candidates.iteritems(), key=operator.itemgetter(1))
-                pi[k][(u, v)] = final[1]
-        final_k_idx = max(pi[k].iteritems(), key=operator.itemgetter(1))
-        prob = final_k_idx[1]
-        if prob == 0:
+    if model.transitions is None:
+        raise ValueError('The dense Viterbi algorithm requires a trigram '
+                         'model.')
+    q = model.transitions
+    tags = range(len(model.states))
+    start = [model.start]
+    Kw, Ku = start, start
+    pi = [None] * (model.start + 1)
+    pi[model.start] = [None] * model.start + [0.0]
+    res = []
+    for word in sentence:
+        e = model.emission_row(word)
+        cur = [None] * (model.start + 1)
+        for u in Ku:
+            hist = [(pi[w][u], q[w][u]) for w in Kw]
+            cur[u] = [
+                max([p + r[v] for p, r in hist]) + e[v]
+                if e[v] != NEG_INF else NEG_INF for v in tags]
+        best, bestTag = NEG_INF, 0
+        for u in Ku:
+            cur_u = cur[u]
+            for v in tags:
+                if cur_u[v] > best:
+                    best, bestTag = cur_u[v], v
+        if best == NEG_INF:
             logProb = 0
         else:
-            logProb = math.log(prob)
-        sys.stdout.write(
-            '%s %s %s\n' % (original_word, final_k_idx[0][1], logProb))
-    finalCandidates = defaultdict(float)
-    perms = itertools.product(K[n - 1], K[n])
-    for perm in perms:
-        finalCandidates[perm] = \
-            pi[n][perm] * \
-            counter.mle(list(perm + (SENTENCE_END,)))
-    final_sent_prob_idx = max(
-        finalCandidates.iteritems(), key=operator.itemgetter(1))
-    print('')
+            logProb = best
+        res.append((model.states[bestTag], logProb))
+        if metrics is not None:
+            metrics.cells += len(Ku) * len(tags)
+        pi = cur
+        Kw, Ku = Ku, tags
+    return res
+
+
+def sparse_viterbi(model, sentence, metrics=None):
+    """Viterbi alorithm restricted to the observed tags and transitions.
+
+    This gives the same result as L{viterbi} but only follows the histories
+    of non null probability. A token is only tagged with the tags its word
+    (or its group token) was seen with in the training file, given by the tag
+    dictionary of the model, and a history of n-1 tags is only followed by
+    the tags v seen after it. Most known words carry one or two tags, so only
+    a few of the S^(n-1) histories are kept at each position, which makes
+    the decoding of any n-gram model practical.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
+    @param sentence:
+        A list of tokens (strings) representing a sentence.
+    @type sentence: list
+    @param metrics:
+        If given, the number of trellis cells evaluated is added to these
+        metrics.
+    @type metrics: L{mtrc.Metrics}
+
+    @return: A list of tuples containing the predicted tag of each token and
+        the log probability of the tagged sequence up to this token.
+    @rtype: list
+    """
+    table = model.history_table()
+    pi = {model.startHistory: 0.0}
+    res = []
+    for word in sentence:
+        row = model.emission_index(word)
+        e = model.emissions[row]
+        allowed = model.row_tags(row)
+        cur = {}
+        for h, p in pi.iteritems():
+            if h not in table:
+                continue
+            r, succ, nexts = table[h]
+            if len(allowed) <= len(succ):
+                vs = [v for v in allowed if r[v] != NEG_INF]
+            else:
+                vs = [v for v in succ if e[v] != NEG_INF]
+            for v in vs:
+                score = p + r[v]
+                if score > cur.get(nexts[v], NEG_INF):
+                    cur[nexts[v]] = score
+        for h in cur:
+            cur[h] += e[h[-1]]
+        if cur:
+            h, logProb = min(cur.iteritems(), key=lambda (h, p): (-p, h))
+            bestTag = h[-1]
+        else:
+            bestTag, logProb = 0, 0
+        res.append((model.states[bestTag], logProb))
+        if metrics is not None:
+            metrics.cells += len(cur)
+        pi = cur
+    return res
+
+
+def beam_search(model, sentence, beamWidth, threshold=None, metrics=None):
+    """Beam search algorithm for finding the most likely tag for every tokens.
+
+    This is an approximation of L{viterbi}: instead of every history of n-1
+    tags, only the C{beamWidth} best histories are kept at each position,
+    and only those whose log probability is within C{threshold} of the best
+    one if a threshold is given. The cost of a position is then
+    proportional to the beam width times the number of tags instead of the
+    number of tags to the power n.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
+    @param sentence:
+        A list of tokens (strings) representing a sentence.
+    @type sentence: list
+    @param beamWidth:
+        The maximum number of histories kept at each position.
+    @type beamWidth: int
+    @param threshold:
+        If set, the histories whose log probability is lower than the best
+        one minus the threshold are dropped.
+    @type threshold: float
+    @param metrics:
+        If given, the number of trellis cells evaluated is added to these
+        metrics.
+    @type metrics: L{mtrc.Metrics}
+
+    @return: A list of tuples containing the predicted tag of each token and
+        the log probability of the tagged sequence up to this token.
+    @rtype: list
+    """
+    table = model.history_table()
+    beam = [(0.0, model.startHistory)]
+    res = []
+    for word in sentence:
+        e = model.emission_row(word)
+        cand = {}
+        for p, h in beam:
+            if h not in table:
+                continue
+            r, succ, nexts = table[h]
+            for v in succ:
+                if e[v] != NEG_INF:
+                    score = p + r[v]
+                    if score > cand.get(nexts[v], NEG_INF):
+                        cand[nexts[v]] = score
+        beam = heapq.nlargest(
+            beamWidth, ((score + e[h[-1]], h)
+                        for h, score in cand.iteritems()))
+        if metrics is not None:
+            metrics.cells += len(cand)
+        if threshold is not None and beam:
+            beam = [b for b in beam if b[0] >= beam[0][0] - threshold]
+        if beam:
+            logProb, h = min(beam, key=lambda (p, h): (-p, h))
+            res.append((model.states[h[-1]], logProb))
+        else:
+            res.append((model.states[0], 0))
+    return res
+
+
+def load_model_file(path, packed=False):
+    """Load the model used to tag from a counts file or a binary model file.
+
+    A binary model file is mapped in memory, so it cannot be compressed nor
+    read from the standard input, unlike a counts file.
+
+    @param path:
+        The path of the counts file or of the binary model file.
+    @type path: str
+    @param packed:
+        If set, the counts file is read into a L{pck.PackedHMM}, which takes
+        less memory until the model is compiled.
+    @type packed: bool
+
+    @return: The compiled model.
+    @rtype: L{mdl.Model}
+
+    @raise IOError: If the file cannot be read.
+    @raise ValueError: If the binary model file is not valid.
+    """
+    if is_plain_file(path) and is_model_file(path):
+        return load_model(path)
+    counter = PackedHMM() if packed else HMM()
+    counts_file = open_stream(path)
+    try:
+        counter.load_counts(counts_file)
+    finally:
+        close_stream(counts_file)
+    return compile_hmm(counter)
+
+
+def write_model_file(args):
+    """Compile a counts file into a binary model file in a helper process.
+
+    @param args:
+        A tuple containing the path of the counts file, the path of the
+        binary model file and the packed flag of L{load_model_file}.
+    @type args: tuple
+
+    @raise IOError: If a file cannot be read or written.
+    """
+    path, modelPath, packed = args
+    with open(modelPath, 'wb') as output:
+        write_model(load_model_file(path, packed), output)
+
+
+def load_shared_model(path, packed=False):
+    """Load the model to share with the worker processes.
+
+    A binary model file is mapped in memory as is. A counts file is compiled
+    by a helper process into a temporary binary model file, in C{SHARED_DIR}
+    when it exists, which is mapped then removed: the mapping outlives the
+    file. The dictionaries of the counts are thus never built in this
+    process. The workers forked from it read the model from the same pages
+    instead of copying the pages of the heap they touch, which include the
+    ones left half free by the dictionaries once released.
+
+    The standard input cannot be read by the helper process: a counts file
+    read from it is loaded by L{load_model_file}.
+
+    @param path:
+        The path of the counts file or of the binary model file.
+    @type path: str
+    @param packed:
+        If set, the counts file is read into a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The compiled model.
+    @rtype: L{mdl.Model}
+
+    @raise IOError: If the file cannot be read.
+    @raise OSError: If the temporary file cannot be created.
+    @raise ValueError: If the binary model file is not valid.
+    """
+    if path == STDIO:
+        return load_model_file(path, packed)
+    if is_plain_file(path) and is_model_file(path):
+        return load_model(path)
+    directory = SHARED_DIR if os.path.isdir(SHARED_DIR) else None
+    fd, modelPath = tempfile.mkstemp(prefix='model.', suffix='.bin',
+                                     dir=directory)
+    os.close(fd)
+    pool = multiprocessing.Pool(1)
+    try:
+        pool.apply(write_model_file, ((path, modelPath, packed),))
+        return load_model(modelPath)
+    finally:
+        pool.terminate()
+        os.remove(modelPath)
+
+
+def tag_sentences(model, sntncIterator, batchSize=None, beamWidth=None,
+                  threshold=None, dense=False, metrics=None, posterior=False):
+    """Tag every sentence of an iterator.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
+    @param sntncIterator:
+        A generator iterating on each sentence of a file.
+    @type sntncIterator: generator
+    @param batchSize:
+        If set, the sentences are decoded by batches of this size with the
+        NumPy engine of L{btch}.
+    @type batchSize: int
+    @param beamWidth:
+        If set, the sentences are decoded by L{beam_search} with this beam
+        width.
+    @type beamWidth: int
+    @param threshold:
+        The log probability threshold of L{beam_search}.
+    @type threshold: float
+    @param dense:
+        If set, the sentences are decoded by L{viterbi} over every history
+        instead of L{sparse_viterbi}.
+    @type dense: bool
+    @param metrics:
+        If given, the decoding of every sentence is recorded in these
+        metrics.
+    @type metrics: L{mtrc.Metrics}
+    @param posterior:
+        If set, the log probabilities are replaced by the posterior
+        probabilities of the predicted tags (see L{posterior_sentences}).
+    @type posterior: bool
+
+    @return: An iterator generating tuples of a sentence and the list of its
+        predicted tags and log probabilities.
+    @rtype: generator
+    """
+    if posterior:
+        for sentence, tags in posterior_sentences(
+                model, tag_sentences(model, sntncIterator, batchSize,
+                                     beamWidth, threshold, dense, metrics),
+                batchSize or DEFAULT_BATCH_SIZE):
+            yield sentence, tags
+        return
+    if batchSize and not beamWidth and not dense:
+        for sentence, tags in batch_sentences(
+                model, sntncIterator, batchSize, metrics):
+            yield sentence, tags
+        return
+    if beamWidth:
+        decode = functools.partial(
+            beam_search, beamWidth=beamWidth, threshold=threshold)
+    elif dense:
+        decode = viterbi
+    else:
+        decode = sparse_viterbi
+    if metrics is None:
+        for sentence in sntncIterator:
+            yield sentence, decode(model, sentence)
+        return
+    for sentence in sntncIterator:
+        start = time.time()
+        tags = decode(model, sentence, metrics=metrics)
+        metrics.observe(model, sentence, time.time() - start)
+        yield sentence, tags
+
+
+def batch_sentences(model, sntncIterator, batchSize, metrics=None):
+    """Tag every sentence of an iterator with the NumPy engine of L{btch}.
+
+    @param model:
+        The compiled model.
+    @type model: L{mdl.Model}
+    @param sntncIterator:
+        A generator iterating on each sentence of a file.
+    @type sntncIterator: generator
+    @param batchSize:
+        The number of sentences decoded together.
+    @type batchSize: int
+    @param metrics:
+        If given, the decoding of every sentence is recorded in these
+        metrics, the time of a window of sentences being shared by its
+        sentences in proportion to their lengths.
+    @type metrics: L{mtrc.Metrics}
+
+    @return: An iterator generating tuples of a sentence and the list of its
+        predicted tags and log probabilities.
+    @rtype: generator
+    """
+    decoder = BatchViterbi(model, batchSize)
+    N = model.start + 1
+    while True:
+        window = list(itertools.islice(
+            sntncIterator, batchSize * BATCH_WINDOW))
+        if not window:
+            break
+        start = time.time()
+        decoded = decoder.decode(window)
+        if metrics is not None:
+            elapsed = time.time() - start
+            tokens = sum(len(sentence) for sentence in window) or 1
+            for sentence in window:
+                metrics.cells += len(sentence) * N * N
+                metrics.observe(model, sentence,
+                                elapsed * len(sentence) / tokens)
+        for sentence, tags in zip(window, decoded):
+            yield sentence, tags
+
+
+def posterior_sentences(model, tagged, batchSize=DEFAULT_BATCH_SIZE):
+    """Give the posterior probabilities of the tags of tagged sentences.
+
+    The posterior probability of a tag is the probability that the token has
+    this tag given the whole sentence, summed over every tagging of the
+    sentence by the forward-backward engine of L{btch}. Unlike the log
+    probability of the best partial tagging, it is a confidence in the tag
+    between 0 and 1.
+
+    @param model:
+        The compiled trigram model.
+    @type model: L{mdl.Model}
+    @param tagged:
+        An iterator generating tuples of a sentence and the list of its
+        predicted tags and log probabilities, e.g. given by
+        L{tag_sentences}.
+    @type tagged: generator
+    @param batchSize:
+        The number of sentences processed together.
+    @type batchSize: int
+
+    @return: An iterator generating tuples of a sentence and the list of its
+        predicted tags and their posterior probabilities.
+    @rtype: generator
+    """
+    engine = ForwardBackward(model, batchSize)
+    ids = dict((tag, i) for i, tag in enumerate(model.states))
+    while True:
+        window = list(itertools.islice(tagged, batchSize * BATCH_WINDOW))
+        if not window:
+            break
+        posteriors = engine.posteriors([sentence for sentence, tags in window])
+        for (sentence, tags), probs in zip(window, posteriors):
+            yield sentence, [(tag, float(p[ids[tag]]))
+                             for (tag, logProb), p in zip(tags, probs)]
+
+
+def tag_chunk(chunk):
+    """Tag a chunk of sentences in a worker process.
+
+    @param chunk:
+        A list of sentences.
+    @type chunk: list
+
+    @return: A tuple containing the list of predicted tags and log
+        probabilities of each sentence and the metrics of the chunk, if
+        metrics are collected.
+    @rtype: tuple
+    """
+    model, options = workerArgs
+    metrics = None
+    if options.get('metrics') is not None:
+        metrics = options['metrics'] = Metrics()
+    tagged = [tags for sentence, tags in
+              tag_sentences(model, iter(chunk), **options)]
+    if metrics is not None:
+        metrics.collect_classifier()
+    return tagged, metrics
+
+
+def tag_parallel(model, sntncIterator, workers, **options):
+    """Tag every sentence of an iterator in a pool of processes.
+
+    The sentences are sent to the pool by chunks. The results are generated
+    in the order of the sentences and at most C{CHUNKS_PER_WORKER} chunks
+    per worker are in flight at any time.
+
+    @param model:
+        The compiled model, inherited by the workers through fork. If it is
+        read from a memory map (see L{load_shared_model}), the workers share
+        its pages instead of copying them.
+    @type model: L{mdl.Model}
+    @param sntncIterator:
+        A generator iterating on each sentence of a file.
+    @type sntncIterator: generator
+    @param workers:
+        The number of worker processes.
+    @type workers: int
+    @param options:
+        The decoding options of L{tag_sentences}. The metrics of the
+        workers are added to the given metrics, if any.
+    @type options: dict
+
+    @return: An iterator generating tuples of a sentence and the list of its
+        predicted tags and log probabilities.
+    @rtype: generator
+    """
+    global workerArgs
+    workerArgs = (model, options)
+    batchSize = options.get('batchSize')
+    chunkSize = batchSize and batchSize * BATCH_WINDOW or CHUNK_SIZE
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        while True:
+            while len(pending) < workers * CHUNKS_PER_WORKER:
+                chunk = list(itertools.islice(sntncIterator, chunkSize))
+                if not chunk:
+                    break
+                pending.append((chunk, pool.apply_async(tag_chunk, (chunk,))))
+            if not pending:
+                break
+            chunk, result = pending.popleft()
+            tagged, metrics = result.get()
+            if metrics is not None:
+                options['metrics'].merge(metrics)
+            for sentence, tags in zip(chunk, tagged):
+                yield sentence, tags
+    finally:
+        pool.terminate()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        usage()
+    parser = argparse.ArgumentParser(
+        description='Read in counts_file generated from training set and '
+        'test set of data, then predict tags for each word in test set. '
+        'Results are stored in the following format: '
+        '<word> <tag> <log probability of tagged sequence up to this word>')
+    parser.add_argument(
+        'counts_file', help='counts file or binary model file')
+    parser.add_argument('test_file', help="test file, '-' for stdin")
+    parser.add_argument(
+        '-o', '--output', default='-', metavar='PATH',
+        help='where to write the tags, compressed if PATH ends with .gz, '
+        '.bz2 or .xz (default: stdout)')
+    decoders = parser.add_mutually_exclusive_group()
+    decoders.add_argument(
+        '-b', '--batch-size', type=int, metavar='N',
+        help='decode batches of N sentences with NumPy (e.g. %i), trigram '
+        'models only' % DEFAULT_BATCH_SIZE)
+    decoders.add_argument(
+        '-k', '--beam', type=int, metavar='K',
+        help='decode with a beam search keeping K histories per token')
+    decoders.add_argument(
+        '-D', '--dense', action='store_true',
+        help='decode over every history instead of the observed tags and '
+        'transitions only, trigram models only')
+    parser.add_argument(
+        '-t', '--threshold', type=float, metavar='T',
+        help='with --beam, also drop the histories whose log probability is '
+        'more than T below the best one')
+    parser.add_argument(
+        '-c', '--compare', action='store_true',
+        help='with --beam, report on stderr how often the beam search '
+        'disagrees with the exact Viterbi algorithm')
+    parser.add_argument(
+        '-P', '--posterior', action='store_true',
+        help='write the posterior probability of each predicted tag, given '
+        'the whole sentence, instead of the log probability of the tagged '
+        'sequence (forward-backward with NumPy, trigram models only)')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1, metavar='N',
+        help='tag the sentences in N worker processes')
+    parser.add_argument(
+        '-p', '--packed', action='store_true',
+        help='read the counts_file into arrays of integers, which takes '
+        'less memory on large counts files')
+    parser.add_argument(
+        '-M', '--metrics', metavar='PATH',
+        help="collect runtime metrics and write them to PATH at exit, '-' "
+        "for stderr")
+    parser.add_argument(
+        '--metrics-format', choices=METRICS_FORMATS,
+        help='format of the metrics (default: json for .json files, '
+        'prometheus for .prom files, text otherwise)')
+    parser.add_argument(
+        '--metrics-every', type=int, metavar='N',
+        help='also write the metrics every N sentences')
+    args = parser.parse_args()
+    if (args.threshold is not None or args.compare) and not args.beam:
+        parser.error('--threshold and --compare require --beam')
+    if args.batch_size and np is None:
+        parser.error('--batch-size requires NumPy')
+    if args.posterior and np is None:
+        parser.error('--posterior requires NumPy')
+    metrics = None
+    if args.metrics:
+        metrics = Metrics()
+        metricsFormat = args.metrics_format or format_for(args.metrics)
+
+    def dump_metrics():
+        """Write the metrics collected so far."""
+        if args.metrics == '-':
+            metrics.dump(metricsFormat, sys.stderr)
+        else:
+            metrics.dump_file(metricsFormat, args.metrics)
+
+    start = time.time()
+    try:
+        if args.workers > 1:
+            model = load_shared_model(args.counts_file, args.packed)
+        else:
+            model = load_model_file(args.counts_file, args.packed)
+    except (IOError, OSError, ValueError) as e:
+        print('ERROR: Cannot read input file %s (%s).' % (
+            args.counts_file, e), file=sys.stderr)
         sys.exit(1)
+    if model.n != 3 and (args.batch_size or args.dense or args.posterior):
+        parser.error('--batch-size, --dense and --posterior require a '
+                     'trigram model, %s is a %i-gram model' % (
+                         args.counts_file, model.n))
+    if metrics is not None:
+        metrics.loadTime = time.time() - start
     try:
-        counts_file = file(sys.argv[1], 'r')
+        testFile = open_stream(args.test_file)
     except IOError:
-        print(
-            'ERROR: Cannot read input file %s.' % sys.argv[1], file=sys.stderr)
+        print('ERROR: Cannot read input file %s.' % args.test_file,
+              file=sys.stderr)
         sys.exit(1)
     try:
-        testFile = file(sys.argv[2], 'r')
+        output = open_stream(args.output, 'w')
     except IOError:
-        print(
-            'ERROR: Cannot read input file %s.' % sys.argv[2], file=sys.stderr)
+        print('ERROR: Cannot write output file %s.' % args.output,
+              file=sys.stderr)
         sys.exit(1)
-    counter = HMM(3)
-    counter.load_counts(counts_file)
-    sntncIterator = sentence_generator(token_generator(testFile))
-    for sentence in sntncIterator:
-        viterbi(sentence)
+    sntncIterator = word_sentences(testFile)
+    options = dict(batchSize=args.batch_size, beamWidth=args.beam,
+                   threshold=args.threshold, dense=args.dense,
+                   metrics=metrics, posterior=args.posterior)
+    if args.workers > 1:
+        tagged = tag_parallel(model, sntncIterator, args.workers, **options)
+    else:
+        tagged = tag_sentences(model, sntncIterator, **options)
+    tokens = sentences = tokenDiffs = sentenceDiffs = 0
+    try:
+        for sentence, tags in tagged:
+            for word, (tag, logProb) in zip(sentence, tags):
+                output.write('%s %s %s\n' % (word, tag, logProb))
+            output.write('\n')
+            tokens += len(sentence)
+            sentences += 1
+            if args.compare:
+                diffs = sum(tag != exact for (tag, p), (exact, q) in
+                            zip(tags, sparse_viterbi(model, sentence)))
+                tokenDiffs += diffs
+                sentenceDiffs += diffs > 0
+            if metrics is not None and args.metrics_every and \
+                    sentences % args.metrics_every == 0:
+                dump_metrics()
+    finally:
+        if metrics is not None:
+            dump_metrics()
+    close_stream(output)
+    if args.compare:
+        print('Beam search (K=%i) disagrees with Viterbi on %i/%i tokens '
+              '(%.2f%%) and %i/%i sentences.' % (
+                  args.beam, tokenDiffs, tokens,
+                  100.0 * tokenDiffs / max(tokens, 1), sentenceDiffs,
+                  sentences), file=sys.stderr)
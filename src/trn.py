@@ -0,0 +1,538 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Single-process training pipeline.
+
+The training of the program is made of three stages: counting the tokens of
+the training file (L{cnt}), replacing the rare words by group tokens in a copy
+of the training file (L{fltr}) and counting the tokens of that copy again.
+This module runs the three stages in memory: the training file is read once
+and its sentences are kept in a compact L{Corpus}, the words being replaced
+by a rewrite pass over the corpus. Neither the intermediate counts nor the
+truncated training file are written to the disk.
+
+The resulting counts are the same as the ones of the three stages.
+
+The training can also be incremental. The raw counts of the training file
+(the counts of the first stage) are kept alongside the grouped counts and
+the sentences of a new training file are added to both with L{update}: only
+the entries of the words of the new file are changed, including the words
+which are no longer rare, so that the counts are the same as the ones of a
+full training on both files.
+
+The artifacts of a training (the grouped counts, the raw counts and the
+model) can be stored in an L{cch.ArtifactCache}: L{cached_train} reuses them
+as long as neither the training file nor the settings of the training
+change.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import shutil
+import argparse
+from array import array
+from collections import defaultdict
+from cch import ArtifactCache, DEFAULT_CACHE_SIZE, COUNTS, RAW_COUNTS, MODEL
+from cch import training_key
+from cnt import HMM
+from const import DEFAULT_NGRAM_CARDINALITY, UNCOMMON_LIMIT
+from fltr import group_map
+from mdl import GROUP_TOKENS, compile_hmm, write_model
+from pck import PackedHMM
+from rdr import SentenceReader, encode
+from strm import STDIO, open_stream, close_stream, temporary_path
+
+
+class Corpus(object):
+    """Sentences of a training file stored as arrays of integers."""
+
+    def __init__(self):
+        """Corpus creator."""
+        self.vocab = {}
+        self.words = []
+        self.tagIds = {}
+        self.tags = []
+        self.tokens = array('i')
+        self.tokenTags = array('i')
+        self.ends = array('i')
+
+    def read(self, tknsFile):
+        """Add the sentences of a tokens file to the corpus.
+
+        @param tknsFile:
+            The file containing the tokens.
+        @type tknsFile: FILE
+        """
+        for words, tags in SentenceReader(tknsFile).columns():
+            self.tokens.extend(encode(words, self.vocab, self.words))
+            self.tokenTags.extend(encode(tags, self.tagIds, self.tags))
+            self.ends.append(len(self.tokens))
+
+    def word_counts(self):
+        """Count the occurrences of the words of the corpus.
+
+        The words are identified by their first field, as in a counts file.
+
+        @return: The dictionary mapping the words to their number of
+            occurrences.
+        @rtype: dict
+        """
+        idCounts = defaultdict(int)
+        for w in self.tokens:
+            idCounts[w] += 1
+        wordCounts = defaultdict(int)
+        for w, count in idCounts.iteritems():
+            wordCounts[self.words[w].split(" ")[0]] += count
+        return wordCounts
+
+    def rewrite(self, substitutions):
+        """Replace the words of the corpus.
+
+        Only the first field of a token is replaced, as
+        L{fltr.substitute_all} does.
+
+        @param substitutions:
+            The dictionary mapping the words to replace to their substitute.
+        @type substitutions: dict
+        """
+        remap = []
+        for word in self.words[:]:
+            fields = word.split(" ")
+            if fields[0] in substitutions:
+                fields[0] = substitutions[fields[0]]
+                word = " ".join(fields)
+            w = self.vocab.get(word)
+            if w is None:
+                w = self.vocab[word] = len(self.words)
+                self.words.append(word)
+            remap.append(w)
+        self.tokens = array('i', [remap[w] for w in self.tokens])
+
+    def sentences(self):
+        """Create an iterator object for each sentence of the corpus.
+
+        @return: An iterator generating lists of tuples of tokens and token
+            tags.
+        @rtype: generator
+        """
+        words, tags = self.words, self.tags
+        start = 0
+        for end in self.ends:
+            yield [(words[w], tags[t]) for w, t in
+                   zip(self.tokens[start:end], self.tokenTags[start:end])]
+            start = end
+
+
+def train(tknsFile, n=3, rawCounter=None, packed=False):
+    """Train an HMM on a training file with the rare words grouped.
+
+    @param tknsFile:
+        The training file.
+    @type tknsFile: FILE
+    @param n:
+        The n-gram cardinality.
+    @type n: int
+    @param rawCounter:
+        If given, this HMM is also trained on the training file before the
+        rare words are grouped.
+    @type rawCounter: L{cnt.HMM}
+    @param packed:
+        If set, the grouped counts are stored in a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The HMM trained on the training file with the rare words
+        replaced by their group tokens.
+    @rtype: L{cnt.HMM}
+    """
+    corpus = Corpus()
+    corpus.read(tknsFile)
+    if rawCounter is not None:
+        rawCounter.train_sentences(corpus.sentences())
+    corpus.rewrite(group_map(corpus.word_counts()))
+    counter = (PackedHMM if packed else HMM)(n)
+    counter.train_sentences(corpus.sentences())
+    return counter
+
+
+def cached_train(cache, path, n=3, raw=False, model=False, packed=False):
+    """Train on a training file unless the cache holds the artifacts.
+
+    If only the model is missing, it is compiled from the cached counts.
+
+    @param cache:
+        The cache of the artifacts.
+    @type cache: L{cch.ArtifactCache}
+    @param path:
+        The path of the training file.
+    @type path: str
+    @param n:
+        The n-gram cardinality.
+    @type n: int
+    @param raw:
+        If set, the raw counts are also wanted.
+    @type raw: bool
+    @param model:
+        If set, the compiled model is also wanted.
+    @type model: bool
+    @param packed:
+        If set, the counts are stored in a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The folder of the cache holding the grouped counts (L{COUNTS})
+        and, if wanted, the raw counts (L{RAW_COUNTS}) and the model
+        (L{MODEL}).
+    @rtype: str
+
+    @raise IOError: If the training file cannot be read or an artifact
+        cannot be written.
+    """
+    key = training_key(path, n, packed)
+    names = [COUNTS]
+    if raw:
+        names.append(RAW_COUNTS)
+    if model:
+        names.append(MODEL)
+    entry = cache.lookup(key, names)
+    if entry is not None:
+        return entry
+    artifacts = {}
+    entry = cache.lookup(key, [COUNTS])
+    if entry is not None and not raw:
+        counter = (PackedHMM if packed else HMM)(n)
+        with open(os.path.join(entry, COUNTS), 'r') as countsFile:
+            counter.load_counts(countsFile)
+    else:
+        rawCounter = (PackedHMM if packed else HMM)(n) if raw else None
+        tknsFile = open_stream(path)
+        counter = train(tknsFile, n, rawCounter, packed)
+        close_stream(tknsFile)
+        artifacts[COUNTS] = counter.output_counts
+        if raw:
+            artifacts[RAW_COUNTS] = rawCounter.output_counts
+    if model:
+        artifacts[MODEL] = lambda output: write_model(
+            compile_hmm(counter.reloaded()), output)
+    return cache.store(key, artifacts)
+
+
+def copy_artifact(entry, name, path):
+    """Replace a file by a copy of a cached artifact.
+
+    The copy is written to a temporary file renamed over the file,
+    compressed as the file.
+
+    @param entry:
+        The folder of the cache holding the artifact.
+    @type entry: str
+    @param name:
+        The name of the artifact.
+    @type name: str
+    @param path:
+        The path of the file.
+    @type path: str
+    """
+    tmpPath = temporary_path(path)
+    output = open_stream(tmpPath, 'w')
+    with open(os.path.join(entry, name), 'rb') as artifact:
+        shutil.copyfileobj(artifact, output)
+    close_stream(output)
+    os.chmod(tmpPath, 0644)
+    os.rename(tmpPath, path)
+
+
+def grouped_token(token, substitutions):
+    """Replace the first field of a token by its substitute, if any.
+
+    @param token:
+        The token, made of the fields of a line of a training file but the
+        last one.
+    @type token: str
+    @param substitutions:
+        The dictionary mapping the words to replace to their substitute.
+    @type substitutions: dict
+
+    @return: The token with its first field replaced.
+    @rtype: str
+    """
+    fields = token.split(" ")
+    if fields[0] not in substitutions:
+        return token
+    fields[0] = substitutions[fields[0]]
+    return " ".join(fields)
+
+
+def word_substitutions(wordCounts, words):
+    """Compute the substitutes of some words only.
+
+    A word of the training file equal to a group token is replaced as any
+    other word and its substitute may be replaced again, so the counts of the
+    group tokens are taken into account.
+
+    @param wordCounts:
+        The dictionary mapping every word to its number of occurrences.
+    @type wordCounts: dict
+    @param words:
+        The words whose substitute is wanted.
+    @type words: set
+
+    @return: The substitutions of L{fltr.group_map} restricted to the words.
+    @rtype: dict
+    """
+    return group_map(dict((w, wordCounts[w]) for w in
+                          words.union(GROUP_TOKENS) if w in wordCounts))
+
+
+def raw_train(tknsFile, n=3, packed=False):
+    """Train an HMM on a training file without grouping the rare words.
+
+    @param tknsFile:
+        The training file.
+    @type tknsFile: FILE
+    @param n:
+        The n-gram cardinality.
+    @type n: int
+    @param packed:
+        If set, the counts are stored in a L{pck.PackedHMM}.
+    @type packed: bool
+
+    @return: The HMM trained on the training file, its words counts being
+        indexed by the first field of the tokens as L{group_counts} expects.
+    @rtype: L{cnt.HMM}
+    """
+    corpus = Corpus()
+    corpus.read(tknsFile)
+    rawCounter = (PackedHMM if packed else HMM)(n)
+    rawCounter.train_sentences(corpus.sentences())
+    for word, count in corpus.word_counts().iteritems():
+        rawCounter.wordCounts[word] += count
+    return rawCounter
+
+
+def group_counts(rawCounter, limit=UNCOMMON_LIMIT):
+    """Group the rare words of raw counts.
+
+    @param rawCounter:
+        The HMM trained on the training file, its words counts being indexed
+        by the first field of the tokens.
+    @type rawCounter: L{cnt.HMM}
+    @param limit:
+        The number of occurrences under which a word is uncommon.
+    @type limit: int
+
+    @return: The HMM holding the same counts with the rare words replaced by
+        their group tokens, of the same class as the raw counts.
+    @rtype: L{cnt.HMM}
+    """
+    substitutions = group_map(rawCounter.wordCounts, limit)
+    counter = type(rawCounter)(rawCounter.n)
+    for (token, ne_tag), count in rawCounter.emission_counts.iteritems():
+        counter.emission_counts[
+            (grouped_token(token, substitutions), ne_tag)] += count
+    counter.merge_counts([], [counts.items()
+                              for counts in rawCounter.ngramCounts])
+    return counter
+
+
+def update(rawCounter, counter, tknsFile):
+    """Add the sentences of a training file to raw and grouped counts.
+
+    Only the emission counts of the words of the new sentences are updated:
+    the counts of each token of such a word are removed from the entry of its
+    previous substitute and added to the entry of its new one. The n-grams
+    counts only hold tags and are simply added. If the new sentences contain
+    a group token as a word, every substitution may change and the grouped
+    counts are computed again.
+
+    @param rawCounter:
+        The HMM trained on the previous training files, its words counts
+        being indexed by the first field of the tokens. It is updated.
+    @type rawCounter: L{cnt.HMM}
+    @param counter:
+        The HMM holding the grouped counts of the previous training files. It
+        is updated unless the grouped counts are computed again.
+    @type counter: L{cnt.HMM}
+    @param tknsFile:
+        The file containing the new sentences.
+    @type tknsFile: FILE
+
+    @return: The HMM holding the grouped counts of every training file.
+    @rtype: L{cnt.HMM}
+    """
+    delta = type(rawCounter)(rawCounter.n)
+    delta.train(tknsFile)
+    words = set(token.split(" ")[0] for token, ne_tag in delta.emission_counts)
+    tokens = defaultdict(set)
+    for key in rawCounter.emission_counts:
+        word = key[0].split(" ")[0]
+        if word in words:
+            tokens[word].add(key)
+    old = word_substitutions(rawCounter.wordCounts, words)
+
+    emissions = delta.emission_counts.items()
+    rawCounter.merge_counts(
+        emissions, [counts.items() for counts in delta.ngramCounts])
+    for key, count in emissions:
+        word = key[0].split(" ")[0]
+        rawCounter.wordCounts[word] += count
+        tokens[word].add(key)
+    if words.intersection(GROUP_TOKENS):
+        return group_counts(rawCounter)
+    new = word_substitutions(rawCounter.wordCounts, words)
+
+    grouped = counter.emission_counts
+    for word in words:
+        for token, ne_tag in tokens[word]:
+            count = rawCounter.emission_counts[(token, ne_tag)]
+            before = (grouped_token(token, old), ne_tag)
+            grouped[before] -= count - delta.emission_counts.get(
+                (token, ne_tag), 0)
+            if not grouped[before]:
+                del grouped[before]
+            grouped[(grouped_token(token, new), ne_tag)] += count
+    counter.merge_counts([], [counts.items() for counts in delta.ngramCounts])
+    return counter
+
+
+def write_counts(counter, path):
+    """Replace a counts file by the counts of an HMM.
+
+    The counts are written to a temporary file renamed over the counts file,
+    compressed as the counts file and with its permissions, or readable by
+    everyone if it does not exist yet.
+
+    @param counter:
+        The HMM holding the counts.
+    @type counter: L{cnt.HMM}
+    @param path:
+        The path of the counts file.
+    @type path: str
+    """
+    tmpPath = temporary_path(path)
+    output = open_stream(tmpPath, 'w')
+    counter.output_counts(output)
+    close_stream(output)
+    if os.path.exists(path):
+        shutil.copymode(path, tmpPath)
+    else:
+        os.chmod(tmpPath, 0644)
+    os.rename(tmpPath, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Count the tokens of the training file, group the rare '
+        'words and write the counts of the grouped tokens and n-grams.')
+    parser.add_argument('input_file', help="training file, '-' for stdin")
+    parser.add_argument(
+        '-o', '--output', default='-', metavar='PATH',
+        help='where to write the counts, compressed if PATH ends with .gz, '
+        '.bz2 or .xz (default: stdout)')
+    parser.add_argument(
+        '-m', '--model', metavar='PATH',
+        help='also write the compiled binary model file to PATH')
+    parser.add_argument(
+        '-n', '--order', type=int, default=DEFAULT_NGRAM_CARDINALITY,
+        metavar='N', help='n-gram cardinality of the tags model, 2 for '
+        'bigrams, 4 for 4-grams (default: %(default)s, the one of COUNTS '
+        'with --update)')
+    parser.add_argument(
+        '-p', '--packed', action='store_true',
+        help='store the counts in arrays of integers, which takes less '
+        'memory on large training files')
+    parser.add_argument(
+        '-r', '--raw-counts', metavar='PATH',
+        help='also write the counts of the tokens before the grouping to '
+        'PATH, to update them later with --update')
+    parser.add_argument(
+        '-u', '--update', metavar='COUNTS',
+        help='add the input_file to the grouped COUNTS of a previous '
+        'training and to its raw counts given by --raw-counts, which are '
+        'updated in place')
+    parser.add_argument(
+        '-c', '--cache', metavar='DIR',
+        help='reuse the counts and model of a previous training of the same '
+        'input_file with the same settings stored in DIR, or store them there')
+    parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_SIZE, metavar='MB',
+        help='size of the cache beyond which the least recently used '
+        'trainings are removed (default: %(default)s)')
+    args = parser.parse_args()
+    if args.update and not args.raw_counts:
+        parser.error('--update requires --raw-counts')
+    if args.cache and (args.update or args.input_file == STDIO):
+        parser.error('--cache requires a training file and no --update')
+    if args.cache_size <= 0:
+        parser.error('the size of the cache must be positive')
+    if args.order < 2:
+        parser.error('the n-gram cardinality must be at least 2')
+    try:
+        input = open_stream(args.input_file)
+    except IOError:
+        print("ERROR: Cannot read inputfile %s." % args.input_file,
+              file=sys.stderr)
+        sys.exit(1)
+    try:
+        output = open_stream(args.output, 'w')
+    except IOError:
+        print("ERROR: Cannot write output file %s." % args.output,
+              file=sys.stderr)
+        sys.exit(1)
+    if args.cache:
+        close_stream(input)
+        try:
+            entry = cached_train(
+                ArtifactCache(args.cache, args.cache_size << 20),
+                args.input_file, args.order, args.raw_counts is not None,
+                args.model is not None, args.packed)
+        except (IOError, OSError) as e:
+            print("ERROR: Cannot train through the cache (%s)." % e,
+                  file=sys.stderr)
+            sys.exit(1)
+        with open(os.path.join(entry, COUNTS), 'rb') as countsFile:
+            shutil.copyfileobj(countsFile, output)
+        close_stream(output)
+        for name, path in ((RAW_COUNTS, args.raw_counts),
+                           (MODEL, args.model)):
+            if path:
+                try:
+                    copy_artifact(entry, name, path)
+                except (IOError, OSError):
+                    print("ERROR: Cannot write file %s." % path,
+                          file=sys.stderr)
+                    sys.exit(1)
+        sys.exit(0)
+    rawCounter = None
+    if args.raw_counts:
+        rawCounter = (PackedHMM if args.packed else HMM)(args.order)
+    if args.update:
+        counter = (PackedHMM if args.packed else HMM)(args.order)
+        try:
+            for c, path in ((rawCounter, args.raw_counts),
+                            (counter, args.update)):
+                countsFile = open_stream(path)
+                c.load_counts(countsFile, raw=True)
+                close_stream(countsFile)
+        except IOError as e:
+            print("ERROR: Cannot read counts file (%s)." % e, file=sys.stderr)
+            sys.exit(1)
+        counter = update(rawCounter, counter, input)
+    else:
+        counter = train(input, args.order, rawCounter, args.packed)
+    counter.output_counts(output)
+    close_stream(output)
+    if args.raw_counts:
+        try:
+            write_counts(rawCounter, args.raw_counts)
+        except (IOError, OSError):
+            print("ERROR: Cannot write counts file %s." % args.raw_counts,
+                  file=sys.stderr)
+            sys.exit(1)
+    if args.model:
+        try:
+            with open(args.model, 'wb') as output:
+                write_model(compile_hmm(counter.reloaded()), output)
+        except IOError:
+            print("ERROR: Cannot write model file %s." % args.model,
+                  file=sys.stderr)
+            sys.exit(1)